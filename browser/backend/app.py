@@ -10,6 +10,8 @@ from flask import Flask, jsonify
 
 from routes import routes
 from metadata import metadata_store
+from watcher import start_watcher
+from trash import recover_trash
 
 logging.basicConfig(
     level=logging.INFO,
@@ -65,6 +67,10 @@ def create_app() -> Flask:
 
 app = create_app()
 metadata_store.initialize()
+if _should_open_browser(_is_debug_mode()):
+    # В debug режиме с перезагрузчиком наблюдатель и восстановление корзины - только в рабочем процессе
+    recover_trash()
+    start_watcher()
 
 
 def _shutdown_handler(signum, frame):
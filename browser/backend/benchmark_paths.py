@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк вычисления относительных путей.
+Сравнивает прежнюю реализацию get_relative_path (abspath, normpath и два Path.resolve на вызов)
+с текущей (корень разрешается один раз, пути от обходчиков обрезаются как строки).
+"""
+
+import os
+import time
+import argparse
+import logging
+from itertools import islice
+from pathlib import Path as PathLib
+from typing import List
+
+from config import config
+from paths import get_relative_path, walk_images
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+
+def legacy_get_relative_path(absolute_path: str, root_folder: str) -> str:
+    """Прежняя реализация get_relative_path"""
+    abs_path = os.path.normpath(os.path.abspath(absolute_path))
+    root = os.path.normpath(os.path.abspath(root_folder))
+    try:
+        return str(PathLib(abs_path).resolve().relative_to(PathLib(root).resolve())).replace("\\", "/")
+    except (ValueError, TypeError):
+        if abs_path.startswith(root):
+            return abs_path[len(root):].lstrip(os.sep).replace("\\", "/")
+        return absolute_path.replace(root_folder, "").lstrip(os.sep).replace("\\", "/")
+
+
+def sample_paths(count: int) -> List[str]:
+    """Реальные пути из папки изображений, дополненные синтетическими до count"""
+    paths = list(islice(walk_images(), count))
+    folders = max(1, count // 200)
+    i = 0
+    while len(paths) < count:
+        paths.append(os.path.join(config.IMAGE_FOLDER, f"folder_{i % folders}", f"image_{i:06d}.png"))
+        i += 1
+    return paths
+
+
+def measure(func, paths: List[str]) -> float:
+    start = time.perf_counter()
+    for path in paths:
+        func(path, config.IMAGE_FOLDER)
+    return (time.perf_counter() - start) / len(paths) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнивает стоимость вычисления относительного пути")
+    parser.add_argument("--count", type=int, default=100000, help="Количество путей (по умолчанию: 100000)")
+    args = parser.parse_args()
+
+    paths = sample_paths(args.count)
+    mismatches = sum(
+        1 for path in paths[:1000]
+        if legacy_get_relative_path(path, config.IMAGE_FOLDER) != get_relative_path(path, config.IMAGE_FOLDER)
+    )
+    if mismatches:
+        logger.warning(f"Результаты расходятся для {mismatches} из {min(1000, len(paths))} путей")
+
+    before = measure(legacy_get_relative_path, paths)
+    after = measure(get_relative_path, paths)
+    print(f"путей: {len(paths)}")
+    print(f"до:    {before:8.2f} мкс/путь, {before * len(paths) / 1e6:7.2f} с всего")
+    print(f"после: {after:8.2f} мкс/путь, {after * len(paths) / 1e6:7.2f} с всего")
+    print(f"ускорение: {before / after:.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
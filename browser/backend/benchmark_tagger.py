@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк пропускной способности WD14 Tagger в зависимости от размера батча.
+Подготавливает выборку изображений из папки config.json и для каждого размера батча
+измеряет количество изображений в секунду для одного запуска модели на батч.
+"""
+
+import time
+import random
+import argparse
+import logging
+from itertools import islice
+
+from config import config
+from paths import walk_images
+from tag import _get_tag_generator
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Измеряет пропускную способность WD14 Tagger по размерам батча")
+    parser.add_argument("--count", type=int, default=64, help="Количество изображений в выборке (по умолчанию: 64)")
+    parser.add_argument("--batch-sizes", type=int, nargs="*", default=[1, 2, 4, 8, 16, 32],
+                        help="Размеры батча (по умолчанию: 1 2 4 8 16 32)")
+    args = parser.parse_args()
+
+    paths = list(islice(walk_images(), args.count * 10))
+    random.shuffle(paths)
+    paths = paths[:args.count]
+    if not paths:
+        logger.error(f"Не найдено изображений в {config.IMAGE_FOLDER}")
+        return 1
+
+    generator = _get_tag_generator()
+    start = time.perf_counter()
+    images = generator.preprocess_batch(paths)
+    logger.info(f"Подготовка {len(images)} изображений: {(time.perf_counter() - start) * 1000 / len(images):.1f} мс на изображение")
+
+    generator.run_batch(images[:1])
+
+    print(f"{'батч':>5} {'изобр./с':>10} {'мс/батч':>10}")
+    for batch_size in args.batch_sizes:
+        runs = 0
+        start = time.perf_counter()
+        for i in range(0, len(images), batch_size):
+            generator.run_batch(images[i:i + batch_size])
+            runs += 1
+        elapsed = time.perf_counter() - start
+        print(f"{batch_size:>5} {len(images) / elapsed:>10.1f} {elapsed * 1000 / runs:>10.1f}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
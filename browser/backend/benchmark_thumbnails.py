@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк профилей кодирования миниатюр.
+Для выборки изображений из папки config.json измеряет время кодирования (мс на изображение)
+и средний размер миниатюры для каждого профиля из config.THUMBNAIL_PROFILES.
+С --check-decode сравнивает уменьшенное декодирование с полным по времени и PSNR миниатюры.
+"""
+
+import time
+import random
+import argparse
+import logging
+from itertools import islice
+from typing import List
+
+import cv2
+
+from config import config
+from paths import walk_images
+from thumbnail import encode_thumbnail, decode_for_thumbnail, suppress_stderr, _downscale
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+
+def sample_paths(count: int) -> List[str]:
+    paths = list(islice(walk_images(), count * 10))
+    random.shuffle(paths)
+    return paths[:count]
+
+
+def load_samples(paths: List[str], size: int) -> List:
+    """Декодирует выборку изображений и уменьшает их до размера миниатюры"""
+    samples = []
+    for path in paths:
+        with suppress_stderr():
+            img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is not None:
+            samples.append(_downscale(img, size))
+    return samples
+
+
+def check_decode(paths: List[str], size: int, min_psnr: float) -> bool:
+    """Сравнивает миниатюры из полного и уменьшенного декодирования. Возвращает True, если PSNR не ниже порога"""
+    full_time = 0.0
+    reduced_time = 0.0
+    psnr_values = []
+    for path in paths:
+        start = time.perf_counter()
+        with suppress_stderr():
+            full = cv2.imread(path, cv2.IMREAD_COLOR)
+        full_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        reduced = decode_for_thumbnail(path, size)
+        reduced_time += time.perf_counter() - start
+
+        if full is None or reduced is None:
+            continue
+        expected = _downscale(full, size)
+        actual = _downscale(reduced, size)
+        if actual.shape != expected.shape:
+            actual = cv2.resize(actual, (expected.shape[1], expected.shape[0]), interpolation=cv2.INTER_AREA)
+        psnr_values.append(cv2.PSNR(expected, actual))
+
+    if not psnr_values:
+        logger.error("Не удалось декодировать ни одного изображения")
+        return False
+
+    count = len(paths)
+    print(f"декодирование: полное {full_time * 1000 / count:.1f} мс, уменьшенное {reduced_time * 1000 / count:.1f} мс")
+    print(f"PSNR миниатюры {size}px: мин. {min(psnr_values):.1f} дБ, сред. {sum(psnr_values) / len(psnr_values):.1f} дБ")
+    return min(psnr_values) >= min_psnr
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнивает профили кодирования миниатюр")
+    parser.add_argument("--count", type=int, default=50, help="Количество изображений в выборке (по умолчанию: 50)")
+    parser.add_argument("--size", type=int, default=config.THUMBNAIL_SIZE,
+                        help=f"Размер миниатюры (по умолчанию: {config.THUMBNAIL_SIZE})")
+    parser.add_argument("--profiles", nargs="*", default=sorted(config.THUMBNAIL_PROFILES),
+                        help="Профили для сравнения (по умолчанию: все)")
+    parser.add_argument("--check-decode", action="store_true",
+                        help="Сравнить уменьшенное декодирование с полным вместо профилей кодирования")
+    parser.add_argument("--min-psnr", type=float, default=40.0,
+                        help="Минимально допустимый PSNR для --check-decode (по умолчанию: 40)")
+    args = parser.parse_args()
+
+    paths = sample_paths(args.count)
+    if args.check_decode:
+        if not paths:
+            logger.error(f"Не найдено изображений в {config.IMAGE_FOLDER}")
+            return 1
+        return 0 if check_decode(paths, args.size, args.min_psnr) else 1
+
+    samples = load_samples(paths, args.size)
+    if not samples:
+        logger.error(f"Не найдено изображений в {config.IMAGE_FOLDER}")
+        return 1
+
+    logger.info(f"Выборка: {len(samples)} изображений, размер {args.size}px")
+    print(f"{'профиль':<12} {'кодек':<6} {'мс/изобр.':>10} {'байт/миниат.':>13}")
+    for name in args.profiles:
+        profile = config.THUMBNAIL_PROFILES[name]
+        encode_thumbnail(samples[0], profile)
+
+        total_bytes = 0
+        start = time.perf_counter()
+        for img in samples:
+            total_bytes += len(encode_thumbnail(img, profile))
+        elapsed = time.perf_counter() - start
+
+        print(f"{name:<12} {profile['codec']:<6} {elapsed * 1000 / len(samples):>10.1f} {total_bytes // len(samples):>13}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -10,14 +10,15 @@ import argparse
 import logging
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import List
+from typing import List, Dict, Optional
 
 from tqdm import tqdm
 
 from config import config
 from metadata import metadata_store
-from thumbnail import ThumbnailService
-from paths import walk_images
+from thumbnail import ThumbnailService, phash_from_thumbnail, memory_tier_sizes, tiers_from_thumbnail
+from paths import scan_images
+from tag import ingest_max_workers
 
 logging.basicConfig(
     level=logging.INFO,
@@ -27,13 +28,19 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def process_images_batch(image_paths: List[str], max_workers: int = None) -> tuple:
+def process_images_batch(image_paths: List[str], max_workers: int = None,
+                         thumbnail_profile: str = None, sizes: Optional[Dict[str, int]] = None,
+                         changed_ids: Optional[Dict[str, str]] = None) -> tuple:
     """
     Обрабатывает батч изображений: создает метаданные и миниатюры.
     
     Args:
         image_paths: Список путей к изображениям
         max_workers: Количество потоков
+        thumbnail_profile: Профиль кодирования миниатюр
+        sizes: Размеры файлов из обхода {путь: размер}, чтобы не делать stat повторно
+        changed_ids: Изменившиеся файлы {путь: ID записи}: поля, зависящие от содержимого, и миниатюры
+            создаются заново, отметка, оценка и теги сохраняются
     
     Returns:
         Tuple[processed_count, failed_count, skipped_count, metadata_list]
@@ -42,7 +49,7 @@ def process_images_batch(image_paths: List[str], max_workers: int = None) -> tup
         return (0, 0, 0, [])
     
     if max_workers is None:
-        max_workers = min(32, (os.cpu_count() or 1) * 4, len(image_paths))
+        max_workers = ingest_max_workers(len(image_paths))
     
     processed = 0
     failed = 0
@@ -52,6 +59,14 @@ def process_images_batch(image_paths: List[str], max_workers: int = None) -> tup
     def process_single(image_path: str):
         """Обрабатывает одно изображение"""
         try:
+            if changed_ids and image_path in changed_ids:
+                existing = metadata_store.get_by_ids([changed_ids[image_path]]).get(changed_ids[image_path])
+                if existing is not None:
+                    # Файл изменился: обновляются промпт, хеш, размер и миниатюры, пользовательские поля остаются
+                    metadata = metadata_store.refresh_metadata(existing, image_path, (sizes or {}).get(image_path))
+                    updated = ThumbnailService.create_thumbnail(metadata, thumbnail_profile)
+                    return (updated or metadata, "updated")
+            
             existing_list = metadata_store.get_by_paths([image_path])
             if existing_list and existing_list[0]:
                 existing = existing_list[0]
@@ -61,7 +76,7 @@ def process_images_batch(image_paths: List[str], max_workers: int = None) -> tup
                     return (None, "skipped")
                 
                 logger.info(f"Метаданные найдены, но миниатюра отсутствует. Создание миниатюры для: {image_path}")
-                updated = ThumbnailService.create_thumbnail(metadata)
+                updated = ThumbnailService.create_thumbnail(metadata, thumbnail_profile)
                 if updated:
                     metadata = updated
                     logger.info(f"Миниатюра успешно создана для: {image_path}")
@@ -69,8 +84,8 @@ def process_images_batch(image_paths: List[str], max_workers: int = None) -> tup
                     logger.warning(f"Не удалось создать миниатюру для {image_path}, метаданные сохранены без миниатюры")
                 return (metadata, "updated")
             else:
-                metadata = metadata_store.create_metadata(image_path)
-                updated = ThumbnailService.create_thumbnail(metadata)
+                metadata = metadata_store.create_metadata(image_path, (sizes or {}).get(image_path))
+                updated = ThumbnailService.create_thumbnail(metadata, thumbnail_profile)
                 if updated:
                     metadata = updated
                 
@@ -105,6 +120,62 @@ def process_images_batch(image_paths: List[str], max_workers: int = None) -> tup
     return (processed, failed, skipped, metadata_list)
 
 
+def backfill_phashes(max_workers: int) -> int:
+    """Вычисляет перцептивные хеши (поиск nd:) по сохраненным миниатюрам записей, у которых их нет"""
+    metadata_ids = metadata_store.get_ids_without_phash()
+    if not metadata_ids:
+        return 0
+    
+    def compute(metadata_id: str):
+        try:
+            data = metadata_store.get_thumbnails([metadata_id], min(config.THUMBNAIL_SIZES)).get(metadata_id)
+            return metadata_id, phash_from_thumbnail(data) if data else None
+        except Exception as e:
+            logger.warning(f"Ошибка вычисления перцептивного хеша для {metadata_id}: {e}")
+            return metadata_id, None
+    
+    saved = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            tqdm(desc="Перцептивные хеши", total=len(metadata_ids), unit=" изображений", ncols=100) as pbar:
+        for i in range(0, len(metadata_ids), 1000):
+            phashes = {}
+            for metadata_id, phash in executor.map(compute, metadata_ids[i:i + 1000]):
+                if phash is not None:
+                    phashes[metadata_id] = phash
+                pbar.update(1)
+            saved += metadata_store.save_phashes(phashes)
+    return saved
+
+
+def backfill_tiers(max_workers: int, thumbnail_profile: str = None) -> int:
+    """Создает недостающие меньшие уровни миниатюр из сохраненной основной миниатюры
+    (записи, созданные до появления уровней или при другом config.THUMBNAIL_SIZES)"""
+    sizes = [size for size in memory_tier_sizes() if size != config.THUMBNAIL_SIZE]
+    metadata_ids = metadata_store.get_ids_missing_tiers(sizes)
+    if not metadata_ids:
+        return 0
+    
+    def create(metadata_id: str):
+        try:
+            data = metadata_store.get_thumbnails([metadata_id]).get(metadata_id)
+            return metadata_id, tiers_from_thumbnail(data, sizes, thumbnail_profile) if data else None
+        except Exception as e:
+            logger.warning(f"Ошибка создания уровней миниатюры для {metadata_id}: {e}")
+            return metadata_id, None
+    
+    saved = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            tqdm(desc="Уровни миниатюр", total=len(metadata_ids), unit=" изображений", ncols=100) as pbar:
+        for i in range(0, len(metadata_ids), 1000):
+            tiers = {}
+            for metadata_id, created in executor.map(create, metadata_ids[i:i + 1000]):
+                if created:
+                    tiers[metadata_id] = created
+                pbar.update(1)
+            saved += metadata_store.save_tiers(tiers)
+    return saved
+
+
 def backup_database(db_path: str) -> bool:
     """
     Создает бэкап БД, если она существует.
@@ -152,6 +223,12 @@ def main():
         default=100,
         help="Размер батча для обработки и сохранения (по умолчанию: 100)"
     )
+    parser.add_argument(
+        "--thumbnail-profile",
+        default=config.BUILD_THUMBNAIL_PROFILE,
+        choices=sorted(config.THUMBNAIL_PROFILES),
+        help=f"Профиль кодирования миниатюр (по умолчанию: {config.BUILD_THUMBNAIL_PROFILE})"
+    )
     parser.add_argument(
         "--skip-existing",
         action="store_true",
@@ -193,39 +270,55 @@ def main():
         logger.info("Очистка БД от невалидных записей...")
         metadata_store._db_manager._cleanup_invalid_metadata()
         
+        backfilled = backfill_phashes(args.workers or (os.cpu_count() or 1))
+        if backfilled:
+            logger.info(f"Вычислены перцептивные хеши для {backfilled} ранее обработанных изображений")
+        
+        backfilled = backfill_tiers(args.workers or (os.cpu_count() or 1), args.thumbnail_profile)
+        if backfilled:
+            logger.info(f"Созданы уровни миниатюр для {backfilled} ранее обработанных изображений")
+        
         logger.info("Поиск изображений в папке...")
         with tqdm(desc="Поиск изображений", unit=" файлов") as pbar:
-            images = []
-            for img_path in walk_images():
-                images.append(img_path)
+            records = []
+            for record in scan_images(max_workers=config.FOLDER_TREE_SCAN_WORKERS):
+                records.append(record)
                 pbar.update(1)
         
-        if not images:
+        if not records:
             logger.warning("Изображения не найдены")
             logger.info("Сохранение БД на диск...")
             metadata_store._db_manager._save_timer.cancel()
             metadata_store._db_manager._save_to_disk()
             return 0
         
-        logger.info(f"Найдено {len(images)} изображений")
+        logger.info(f"Найдено {len(records)} изображений")
+        images = [record.path for record in records]
+        sizes = {record.path: record.size for record in records}
+        changed_ids: Dict[str, str] = {}
         
         if args.skip_existing:
-            images_to_process = []
-            with tqdm(desc="Проверка существующих", total=len(images), unit=" файлов") as pbar:
-                for img_path in images:
-                    existing_list = metadata_store.get_by_paths([img_path])
-                    if existing_list and existing_list[0]:
-                        existing = existing_list[0]
-                        if existing.get("thumbnail_data"):
-                            pbar.update(1)
-                            continue
-                    images_to_process.append(img_path)
-                    pbar.update(1)
+            # Размер из обхода сравнивается с размером в БД: совпадение - файл не менялся
+            complete_sizes = metadata_store.get_complete_sizes()
+            changed_records = [
+                record for record in records
+                if record.rel_path in complete_sizes and complete_sizes[record.rel_path] != record.size
+            ]
+            if changed_records:
+                existing = metadata_store.get_by_paths([record.path for record in changed_records])
+                changed_ids = {
+                    record.path: metadata["id"]
+                    for record, metadata in zip(changed_records, existing) if metadata is not None
+                }
+                logger.info(f"Найдено {len(changed_ids)} изменившихся изображений, они будут обработаны заново")
+            images = [
+                record.path for record in records
+                if record.rel_path not in complete_sizes or record.path in changed_ids
+            ]
             
-            skipped = len(images) - len(images_to_process)
+            skipped = len(records) - len(images)
             if skipped > 0:
                 logger.info(f"Пропущено {skipped} уже полностью обработанных изображений (есть метаданные и миниатюра)")
-            images = images_to_process
         
         if not images:
             logger.info("Все изображения уже обработаны")
@@ -236,12 +329,13 @@ def main():
         
         max_workers = args.workers
         if max_workers is None:
-            max_workers = min(32, (os.cpu_count() or 1) * 4, len(images))
+            max_workers = ingest_max_workers(len(images))
         
         logger.info(f"Обработка {len(images)} изображений с использованием {max_workers} потоков...")
         logger.info(f"Используются настройки из config.json:")
         logger.info(f"  - Размер миниатюр: {config.THUMBNAIL_SIZE}px")
         logger.info(f"  - Качество миниатюр: {config.THUMBNAIL_QUALITY}")
+        logger.info(f"  - Профиль миниатюр: {args.thumbnail_profile} {config.THUMBNAIL_PROFILES[args.thumbnail_profile]}")
         logger.info(f"  - Автогенерация тегов: {'включена' if config.AUTO_TAG_ENABLED else 'выключена'}")
         if config.AUTO_TAG_ENABLED:
             logger.info(f"  - Порог тегов: {config.AUTO_TAG_THRESHOLD}")
@@ -264,7 +358,9 @@ def main():
                 
                 logger.info(f"Обработка батча {batch_num}/{total_batches} ({len(batch)} изображений)...")
                 
-                processed, failed, skipped, metadata_list = process_images_batch(batch, max_workers)
+                processed, failed, skipped, metadata_list = process_images_batch(
+                    batch, max_workers, args.thumbnail_profile, sizes, changed_ids
+                )
                 
                 if metadata_list:
                     logger.info(f"Сохранение {len(metadata_list)} метаданных в БД...")
@@ -11,14 +11,56 @@ DEFAULT_CONFIG = {
     "image_folder": "static/images",
     "favorites_folder": "static/images/favorites",
     "thumbnail_size": 512,
+    "thumbnail_sizes": [256, 512, 1600],
     "items_per_page": 20,
+    "folder_tree_scan": False,
+    "folder_tree_scan_workers": 8,
+    "watch_enabled": False,
+    "watch_debounce_ms": 500,
+    "watch_poll_interval": 2.0,
+    "library_index": True,
+    "near_duplicate_distance": 6,
+    "selection_ttl": 1800,
+    "delete_workers": 8,
+    "trash_retention_days": 7,
     "allowed_extensions": [".png", ".jpg", ".jpeg", ".webp"],
     "metadata_folder": ".metadata",
     "database_name": "metadata.db",
     "favorite_tag": "favorite",
     "thumbnail_quality": 85,
+    "thumbnail_profile": "fast",
+    "build_thumbnail_profile": "dense",
+    "thumbnail_profiles": {},
     "auto_tag_enabled": False,
-    "auto_tag_threshold": 0.3771
+    "auto_tag_method": "wd14",
+    "auto_tag_threshold": 0.3771,
+    "auto_tag_batch_size": 16,
+    "auto_tag_batch_wait_ms": 20,
+    "auto_tag_session": {},
+    "auto_tag_model_dir": "",
+    "auto_tag_offline": False,
+    "auto_tag_residency": "idle",
+    "auto_tag_idle_timeout": 600,
+    "auto_tag_stored_scores": 128
+}
+
+# Профили кодирования миниатюр: codec (avif/webp/jpeg) и параметры кодека.
+# quality по умолчанию берется из thumbnail_quality
+BUILTIN_THUMBNAIL_PROFILES = {
+    "fast": {"codec": "avif", "speed": 9},
+    "balanced": {"codec": "avif", "speed": 6},
+    "dense": {"codec": "avif", "speed": 2},
+    "webp": {"codec": "webp", "method": 4},
+    "jpeg": {"codec": "jpeg"}
+}
+
+# Параметры сессии ONNX Runtime для WD14 Tagger. intra_op_threads=0 - автоматически
+DEFAULT_AUTO_TAG_SESSION = {
+    "intra_op_threads": 0,
+    "inter_op_threads": 1,
+    "cpu_mem_arena": True,
+    "mem_pattern": True,
+    "cache_optimized_model": True
 }
 
 _config = DEFAULT_CONFIG.copy()
@@ -30,6 +72,16 @@ if os.path.exists(CONFIG_FILE):
     except Exception as e:
         logger.warning(f"Не удалось загрузить config.json: {e}")
 
+def _build_thumbnail_profiles() -> dict:
+    """Объединяет встроенные профили миниатюр с профилями из config.json"""
+    profiles = {name: dict(profile) for name, profile in BUILTIN_THUMBNAIL_PROFILES.items()}
+    for name, profile in (_config.get("thumbnail_profiles") or {}).items():
+        profiles.setdefault(name, {}).update(profile)
+    for name, profile in profiles.items():
+        profile.setdefault("codec", "avif")
+        profile.setdefault("quality", int(_config["thumbnail_quality"]))
+    return profiles
+
 def _resolve_path(path: str) -> str:
     """Разрешает относительный путь относительно директории config.json."""
     if os.path.isabs(path):
@@ -41,11 +93,34 @@ config = SimpleNamespace(
     FAVORITES_FOLDER=_resolve_path(_config["favorites_folder"]),
     ALLOWED_EXTENSIONS=set(_config["allowed_extensions"]),
     THUMBNAIL_SIZE=int(_config["thumbnail_size"]),
+    THUMBNAIL_SIZES=sorted({int(size) for size in _config["thumbnail_sizes"]} | {int(_config["thumbnail_size"])}),
     ITEMS_PER_PAGE=int(_config["items_per_page"]),
+    FOLDER_TREE_SCAN=bool(_config["folder_tree_scan"]),
+    FOLDER_TREE_SCAN_WORKERS=int(_config["folder_tree_scan_workers"]),
+    WATCH_ENABLED=bool(_config["watch_enabled"]),
+    WATCH_DEBOUNCE_MS=float(_config["watch_debounce_ms"]),
+    WATCH_POLL_INTERVAL=float(_config["watch_poll_interval"]),
+    LIBRARY_INDEX=bool(_config["library_index"]),
+    NEAR_DUPLICATE_DISTANCE=int(_config["near_duplicate_distance"]),
+    SELECTION_TTL=float(_config["selection_ttl"]),
+    DELETE_WORKERS=int(_config["delete_workers"]),
+    TRASH_RETENTION_DAYS=float(_config["trash_retention_days"]),
     METADATA_FOLDER=_config["metadata_folder"],
     DATABASE_NAME=_config["database_name"],
     FAVORITE_TAG=_config["favorite_tag"],
     THUMBNAIL_QUALITY=int(_config["thumbnail_quality"]),
+    THUMBNAIL_PROFILES=_build_thumbnail_profiles(),
+    THUMBNAIL_PROFILE=_config["thumbnail_profile"],
+    BUILD_THUMBNAIL_PROFILE=_config["build_thumbnail_profile"],
     AUTO_TAG_ENABLED=bool(_config.get("auto_tag_enabled", False)),
-    AUTO_TAG_THRESHOLD=float(_config.get("auto_tag_threshold", 0.3771))
+    AUTO_TAG_METHOD=str(_config["auto_tag_method"]),
+    AUTO_TAG_THRESHOLD=float(_config.get("auto_tag_threshold", 0.3771)),
+    AUTO_TAG_BATCH_SIZE=int(_config["auto_tag_batch_size"]),
+    AUTO_TAG_BATCH_WAIT_MS=float(_config["auto_tag_batch_wait_ms"]),
+    AUTO_TAG_SESSION={**DEFAULT_AUTO_TAG_SESSION, **(_config.get("auto_tag_session") or {})},
+    AUTO_TAG_MODEL_DIR=_resolve_path(_config["auto_tag_model_dir"]) if _config["auto_tag_model_dir"] else "",
+    AUTO_TAG_OFFLINE=bool(_config["auto_tag_offline"]),
+    AUTO_TAG_RESIDENCY=str(_config["auto_tag_residency"]),
+    AUTO_TAG_IDLE_TIMEOUT=float(_config["auto_tag_idle_timeout"]),
+    AUTO_TAG_STORED_SCORES=int(_config["auto_tag_stored_scores"])
 )
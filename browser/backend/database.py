@@ -1,15 +1,71 @@
 import os
 import sqlite3
 import json
+import time
+import uuid
 import logging
 import threading
 from pathlib import Path
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Iterable, Optional, List, Set, Tuple
 
 from config import config
+from paths import scan_images
+from library_index import LibraryIndex
 
 logger = logging.getLogger(__name__)
 
+# Колонки, добавленные после первой версии схемы: при загрузке старой БД с диска
+# они добавляются через ALTER TABLE
+MIGRATED_COLUMNS = {
+    "thumbnail_generation": "INTEGER NOT NULL DEFAULT 0",
+    "phash": "INTEGER"
+}
+
+# Колонки, которые можно обновить у множества записей одним UPDATE (update_columns)
+BULK_UPDATE_COLUMNS = {"checked", "rating", "tags"}
+
+# Колонки, которые можно читать отдельно от BLOB миниатюры
+LIGHT_COLUMNS = {
+    "prompt", "checked", "rating", "tags", "size", "hash", "image_path",
+    "created_at", "updated_at", "thumbnail_generation", "phash"
+}
+
+# Выборки (см. create_selection): наборы ID, материализованные на сервере и доступные по токену.
+# Временная таблица соединения in-memory БД, на диск не сохраняется
+SELECTIONS_TABLE_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS selection_items (
+        token TEXT NOT NULL,
+        metadata_id TEXT NOT NULL,
+        PRIMARY KEY (token, metadata_id)
+    ) WITHOUT ROWID
+"""
+
+# Список ID одним параметром (JSON массив): удаление любого количества записей одним запросом,
+# без ограничения SQLite на число параметров
+IDS_FROM_JSON = "SELECT value FROM json_each(?)"
+
+SELECTION_FILTER = "id IN (SELECT metadata_id FROM temp.selection_items WHERE token = ?)"
+
+THUMBNAIL_TIERS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS thumbnails (
+        metadata_id TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        PRIMARY KEY (metadata_id, size)
+    )
+"""
+
+# Вероятности тегов изображения (top-K, см. tag.encode_scores) и теги, добавленные моделью,
+# чтобы при повторной генерации заменить только их, сохранив теги пользователя
+TAG_SCORES_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS tag_scores (
+        metadata_id TEXT PRIMARY KEY,
+        method TEXT NOT NULL,
+        scores BLOB NOT NULL,
+        auto_tags TEXT NOT NULL DEFAULT '[]'
+    )
+"""
+
 
 class DebounceTimer:
     """Таймер с debounce для отложенного выполнения функции"""
@@ -41,8 +97,19 @@ class DatabaseManager:
         self._save_timer = DebounceTimer(save_debounce)
         self._read_lock = threading.RLock()
         self._dirty_ids = set()
+        self._dirty_tier_ids = set()
+        self._dirty_score_ids = set()
         self._dirty_deletes = set()
+        # Записи, у которых изменились только отдельные колонки: {id: {колонка}}.
+        # На диск пишутся через UPDATE этих колонок, без перезаписи строки с BLOB миниатюры
+        self._dirty_columns: Dict[str, Set[str]] = {}
         self._dirty_lock = threading.Lock()
+        # Запись в дисковую БД: сохранение dirty записей и крупные уровни миниатюр (save_large_tier).
+        # Берется только после _read_lock (или без него), никогда наоборот
+        self._disk_lock = threading.Lock()
+        self._index: Optional[LibraryIndex] = None
+        # Токен выборки -> время последнего обращения (time.monotonic)
+        self._selections: Dict[str, float] = {}
     
     def init_database(self) -> None:
         """Инициализирует БД: создает соединение, таблицу и загружает данные с диска"""
@@ -76,7 +143,9 @@ class DatabaseManager:
                     image_path TEXT NOT NULL UNIQUE,
                     thumbnail_data BLOB,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    thumbnail_generation INTEGER NOT NULL DEFAULT 0,
+                    phash INTEGER
                 )
             """)
             cursor.execute("CREATE INDEX idx_image_path ON metadata(image_path)")
@@ -88,6 +157,7 @@ class DatabaseManager:
             cursor.execute("CREATE INDEX idx_created_at ON metadata(created_at)")
             cursor.execute("CREATE INDEX idx_updated_at ON metadata(updated_at)")
             cursor.execute("CREATE INDEX idx_checked_rating ON metadata(checked, rating)")
+            cursor.execute("CREATE INDEX idx_thumbnail_path ON metadata(image_path) WHERE thumbnail_data IS NOT NULL")
             
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS bookmarks (
@@ -106,6 +176,58 @@ class DatabaseManager:
             self._memory_conn.commit()
             
             self._create_missing_indexes()
+        
+        self._ensure_side_tables(self._memory_conn)
+        self._ensure_side_tables(self._disk_conn)
+        self._drop_large_tiers()
+        self._memory_conn.execute(SELECTIONS_TABLE_SQL)
+        
+        if config.LIBRARY_INDEX:
+            self._build_index()
+    
+    def _drop_large_tiers(self) -> None:
+        """Уровни миниатюр крупнее основной хранятся только на диске: после загрузки убираются из памяти"""
+        cursor = self._memory_conn.cursor()
+        cursor.execute("DELETE FROM thumbnails WHERE size > ?", (config.THUMBNAIL_SIZE,))
+        if cursor.rowcount > 0:
+            self._memory_conn.commit()
+            self._memory_conn.execute("VACUUM")
+            logger.info(f"Крупные уровни миниатюр выгружены из памяти: {cursor.rowcount}")
+    
+    def _build_index(self) -> None:
+        """Строит колоночный индекс библиотеки; mtime файлов дочитывается в фоне одним обходом"""
+        with self._read_lock:
+            cursor = self._memory_conn.cursor()
+            cursor.execute("SELECT id, prompt, checked, rating, tags, size, hash, image_path, phash FROM metadata")
+            self._index = LibraryIndex.from_rows(cursor.fetchall())
+        logger.info(f"Индекс библиотеки построен: {len(self._index)} записей")
+        
+        def load_mtimes():
+            try:
+                self._index.set_mtimes({
+                    record.rel_path: record.mtime_ns / 1e9
+                    for record in scan_images(max_workers=config.FOLDER_TREE_SCAN_WORKERS)
+                })
+            except OSError as e:
+                logger.warning(f"Не удалось прочитать mtime изображений для индекса: {e}")
+        
+        threading.Thread(target=load_mtimes, name="library-index-mtime", daemon=True).start()
+    
+    def query_ids(self, relative_folder: Optional[str], search: str, sort_by: Optional[str] = None,
+                  order: str = "desc", hide_checked: bool = False) -> Optional[List[str]]:
+        """Фильтрует и сортирует записи по индексу библиотеки. Возвращает None, если индекс отключен"""
+        if self._index is None:
+            return None
+        return self._index.query(relative_folder, search, sort_by, order, hide_checked)
+    
+    def _ensure_side_tables(self, conn: sqlite3.Connection) -> None:
+        """Создает таблицы уровней миниатюр (thumbnails) и вероятностей тегов (tag_scores), если их нет"""
+        try:
+            conn.execute(THUMBNAIL_TIERS_TABLE_SQL)
+            conn.execute(TAG_SCORES_TABLE_SQL)
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Ошибка создания дополнительных таблиц: {e}", exc_info=True)
     
     def _ensure_disk_schema(self) -> None:
         """Создает структуру БД на диске, если её нет"""
@@ -130,7 +252,9 @@ class DatabaseManager:
                     image_path TEXT NOT NULL UNIQUE,
                     thumbnail_data BLOB,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    thumbnail_generation INTEGER NOT NULL DEFAULT 0,
+                    phash INTEGER
                 )
             """)
             
@@ -143,6 +267,7 @@ class DatabaseManager:
             cursor.execute("CREATE INDEX idx_created_at ON metadata(created_at)")
             cursor.execute("CREATE INDEX idx_updated_at ON metadata(updated_at)")
             cursor.execute("CREATE INDEX idx_checked_rating ON metadata(checked, rating)")
+            cursor.execute("CREATE INDEX idx_thumbnail_path ON metadata(image_path) WHERE thumbnail_data IS NOT NULL")
             
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS bookmarks (
@@ -181,6 +306,15 @@ class DatabaseManager:
             cursor.execute("PRAGMA table_info(metadata)")
             columns = {row[1]: row[2].upper() for row in cursor.fetchall()}
             
+            missing_migrated = [name for name in MIGRATED_COLUMNS if name not in columns]
+            if missing_migrated:
+                for name in missing_migrated:
+                    cursor.execute(f"ALTER TABLE metadata ADD COLUMN {name} {MIGRATED_COLUMNS[name]}")
+                self._disk_conn.commit()
+                logger.info(f"Добавлены колонки в таблицу на диске: {missing_migrated}")
+                cursor.execute("PRAGMA table_info(metadata)")
+                columns = {row[1]: row[2].upper() for row in cursor.fetchall()}
+            
             expected_columns = {
                 "id": "TEXT",
                 "prompt": "TEXT",
@@ -192,7 +326,9 @@ class DatabaseManager:
                 "image_path": "TEXT",
                 "thumbnail_data": "BLOB",
                 "created_at": "TIMESTAMP",
-                "updated_at": "TIMESTAMP"
+                "updated_at": "TIMESTAMP",
+                "thumbnail_generation": "INTEGER",
+                "phash": "INTEGER"
             }
             
             missing_columns = set(expected_columns.keys()) - set(columns.keys())
@@ -311,7 +447,8 @@ class DatabaseManager:
             ("idx_size", "CREATE INDEX IF NOT EXISTS idx_size ON metadata(size)"),
             ("idx_created_at", "CREATE INDEX IF NOT EXISTS idx_created_at ON metadata(created_at)"),
             ("idx_updated_at", "CREATE INDEX IF NOT EXISTS idx_updated_at ON metadata(updated_at)"),
-            ("idx_checked_rating", "CREATE INDEX IF NOT EXISTS idx_checked_rating ON metadata(checked, rating)")
+            ("idx_checked_rating", "CREATE INDEX IF NOT EXISTS idx_checked_rating ON metadata(checked, rating)"),
+            ("idx_thumbnail_path", "CREATE INDEX IF NOT EXISTS idx_thumbnail_path ON metadata(image_path) WHERE thumbnail_data IS NOT NULL")
         ]
         
         try:
@@ -327,62 +464,157 @@ class DatabaseManager:
             logger.error(f"Ошибка при создании индексов: {e}")
     
     def _save_to_disk(self) -> None:
-        """Сохраняет только dirty записи на диск (WAL режим)"""
+        """Сохраняет только dirty записи на диск (WAL режим).
+        Строки читаются из памяти под _read_lock, запись на диск идет под _disk_lock уже без него:
+        порядок блокировок везде один - _read_lock, затем _disk_lock"""
         if self._memory_conn is None or self._disk_conn is None:
             return
         
         self._save_timer.cancel()
         
-        with self._dirty_lock:
-            dirty_ids_list = list(self._dirty_ids)
-            dirty_deletes_list = list(self._dirty_deletes)
-            
-            if not dirty_ids_list and not dirty_deletes_list:
-                return
-            
-            self._dirty_ids.clear()
-            self._dirty_deletes.clear()
-        
-        try:
-            saved_count = 0
-            deleted_count = 0
+        with self._read_lock:
+            with self._dirty_lock:
+                dirty_ids_list = list(self._dirty_ids)
+                dirty_tier_ids_list = list(self._dirty_tier_ids)
+                dirty_score_ids_list = list(self._dirty_score_ids)
+                dirty_deletes_list = list(self._dirty_deletes)
+                dirty_columns = self._dirty_columns
+                
+                if (not dirty_ids_list and not dirty_tier_ids_list and not dirty_score_ids_list
+                        and not dirty_deletes_list and not dirty_columns):
+                    return
+                
+                self._dirty_columns = {}
+                self._dirty_ids.clear()
+                self._dirty_tier_ids.clear()
+                self._dirty_score_ids.clear()
+                self._dirty_deletes.clear()
             
-            if dirty_ids_list:
+            try:
                 updates_data = []
+                tier_rows = []
+                score_rows = []
+                cursor = self._memory_conn.cursor()
                 for metadata_id in dirty_ids_list:
-                    cursor = self._memory_conn.cursor()
                     cursor.execute("SELECT * FROM metadata WHERE id = ?", (metadata_id,))
                     row = cursor.fetchone()
                     if row:
                         updates_data.append(self._dict_to_row(self._row_to_dict(row)))
                 
-                if updates_data:
-                    disk_cursor = self._disk_conn.cursor()
-                    disk_cursor.executemany("""
-                        INSERT OR REPLACE INTO metadata 
-                        (id, prompt, checked, rating, tags, size, hash, image_path, thumbnail_data, updated_at)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-                    """, updates_data)
-                    self._disk_conn.commit()
-                    saved_count = len(updates_data)
+                column_updates = self._read_dirty_columns(dirty_columns)
+                
+                if dirty_tier_ids_list:
+                    cursor.execute(
+                        f"SELECT metadata_id, size, data FROM thumbnails WHERE metadata_id IN ({IDS_FROM_JSON})",
+                        (json.dumps(dirty_tier_ids_list),)
+                    )
+                    tier_rows = [tuple(row) for row in cursor.fetchall()]
+                
+                if dirty_score_ids_list:
+                    cursor.execute(
+                        f"SELECT metadata_id, method, scores, auto_tags FROM tag_scores WHERE metadata_id IN ({IDS_FROM_JSON})",
+                        (json.dumps(dirty_score_ids_list),)
+                    )
+                    score_rows = [tuple(row) for row in cursor.fetchall()]
+            except Exception as e:
+                logger.error(f"Ошибка чтения dirty записей для сохранения на диск: {e}", exc_info=True)
+                self._restore_dirty(dirty_ids_list, dirty_tier_ids_list, dirty_score_ids_list,
+                                    dirty_deletes_list, dirty_columns)
+                return
             
-            if dirty_deletes_list:
-                placeholders = ",".join("?" * len(dirty_deletes_list))
-                disk_cursor = self._disk_conn.cursor()
+            # Диск захватывается до освобождения памяти: сохранения пишутся в порядке чтения
+            self._disk_lock.acquire()
+        
+        try:
+            saved_count = 0
+            deleted_count = 0
+            disk_cursor = self._disk_conn.cursor()
+            
+            if updates_data:
+                disk_cursor.executemany("""
+                    INSERT OR REPLACE INTO metadata 
+                    (id, prompt, checked, rating, tags, size, hash, image_path, thumbnail_data, thumbnail_generation, phash, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                """, updates_data)
+                self._disk_conn.commit()
+                saved_count = len(updates_data)
+            
+            for query, rows in column_updates:
+                disk_cursor.executemany(query, rows)
+                saved_count += len(rows)
+            if column_updates:
+                self._disk_conn.commit()
+            
+            if dirty_tier_ids_list:
                 disk_cursor.execute(
-                    f"DELETE FROM metadata WHERE id IN ({placeholders})",
-                    dirty_deletes_list
+                    f"DELETE FROM thumbnails WHERE metadata_id IN ({IDS_FROM_JSON}) AND size <= ?",
+                    (json.dumps(dirty_tier_ids_list), config.THUMBNAIL_SIZE)
+                )
+                disk_cursor.executemany(
+                    "INSERT INTO thumbnails (metadata_id, size, data) VALUES (?, ?, ?)",
+                    tier_rows
+                )
+                self._disk_conn.commit()
+            
+            if score_rows:
+                disk_cursor.executemany(
+                    "INSERT OR REPLACE INTO tag_scores (metadata_id, method, scores, auto_tags) VALUES (?, ?, ?, ?)",
+                    score_rows
                 )
                 self._disk_conn.commit()
+            
+            if dirty_deletes_list:
+                ids_json = (json.dumps(dirty_deletes_list),)
+                disk_cursor.execute(f"DELETE FROM metadata WHERE id IN ({IDS_FROM_JSON})", ids_json)
                 deleted_count = disk_cursor.rowcount
+                disk_cursor.execute(f"DELETE FROM thumbnails WHERE metadata_id IN ({IDS_FROM_JSON})", ids_json)
+                disk_cursor.execute(f"DELETE FROM tag_scores WHERE metadata_id IN ({IDS_FROM_JSON})", ids_json)
+                self._disk_conn.commit()
             
             logger.info(f"Сохранено {saved_count} записей, удалено {deleted_count} записей на диск (WAL)")
-            
+        
         except Exception as e:
             logger.error(f"Ошибка сохранения dirty записей на диск: {e}", exc_info=True)
-            with self._dirty_lock:
-                self._dirty_ids.update(dirty_ids_list)
-                self._dirty_deletes.update(dirty_deletes_list)
+            self._restore_dirty(dirty_ids_list, dirty_tier_ids_list, dirty_score_ids_list,
+                                dirty_deletes_list, dirty_columns)
+        finally:
+            self._disk_lock.release()
+    
+    def _restore_dirty(self, dirty_ids: List[str], dirty_tier_ids: List[str], dirty_score_ids: List[str],
+                       dirty_deletes: List[str], dirty_columns: Dict[str, Set[str]]) -> None:
+        """Возвращает в dirty наборы записи, которые не удалось сохранить"""
+        with self._dirty_lock:
+            self._dirty_ids.update(dirty_ids)
+            self._dirty_tier_ids.update(dirty_tier_ids)
+            self._dirty_score_ids.update(dirty_score_ids)
+            self._dirty_deletes.update(dirty_deletes)
+            for metadata_id, columns in dirty_columns.items():
+                self._dirty_columns.setdefault(metadata_id, set()).update(columns)
+    
+    def _read_dirty_columns(self, dirty_columns: Dict[str, Set[str]]) -> List[Tuple[str, List[tuple]]]:
+        """Читает только изменившиеся колонки (вызывается под _read_lock).
+        Возвращает [(UPDATE на набор колонок, строки)] - по одному на набор колонок и пачку записей"""
+        by_columns: Dict[tuple, List[str]] = {}
+        for metadata_id, columns in dirty_columns.items():
+            by_columns.setdefault(tuple(sorted(columns)), []).append(metadata_id)
+        
+        updates = []
+        cursor = self._memory_conn.cursor()
+        for columns, metadata_ids in by_columns.items():
+            assignments = ", ".join(f"{column} = ?" for column in columns)
+            query = f"UPDATE metadata SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = ?"
+            for i in range(0, len(metadata_ids), 500):
+                chunk = metadata_ids[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                cursor.execute(f"SELECT id, {', '.join(columns)} FROM metadata WHERE id IN ({placeholders})", chunk)
+                updates.append((query, [(*row[1:], row[0]) for row in cursor.fetchall()]))
+        return updates
+    
+    def _mark_dirty_columns(self, metadata_ids: Iterable[str], columns: Set[str]) -> None:
+        """Помечает измененные колонки записей (вызывается под _dirty_lock)"""
+        for metadata_id in metadata_ids:
+            if metadata_id not in self._dirty_ids:
+                self._dirty_columns.setdefault(metadata_id, set()).update(columns)
     
     def _schedule_save(self) -> None:
         if self._memory_conn is None:
@@ -416,7 +648,9 @@ class DatabaseManager:
             "size": row["size"] or 0,
             "hash": row["hash"] or "",
             "image_path": row["image_path"],
-            "thumbnail_data": row["thumbnail_data"]
+            "thumbnail_data": row["thumbnail_data"],
+            "thumbnail_generation": row["thumbnail_generation"] or 0,
+            "phash": row["phash"]
         }
     
     def _dict_to_row(self, metadata: Dict[str, Any]) -> tuple:
@@ -439,6 +673,8 @@ class DatabaseManager:
         if image_path:
             image_path = str(image_path).replace("\\", "/")
         thumbnail_data = metadata.get("thumbnail_data")
+        thumbnail_generation = int(metadata.get("thumbnail_generation", 0) or 0)
+        phash = metadata.get("phash")
         
         return (
             str(metadata_id),
@@ -449,7 +685,9 @@ class DatabaseManager:
             int(size),
             str(file_hash),
             str(image_path),
-            thumbnail_data
+            thumbnail_data,
+            thumbnail_generation,
+            int(phash) if phash is not None else None
         )
     
     def get_by_ids(self, metadata_ids: List[str]) -> Dict[str, Dict[str, Any]]:
@@ -471,19 +709,281 @@ class DatabaseManager:
                 logger.warning(f"Ошибка batch чтения метаданных по ID: {e}")
         return result
     
-    def has_metadata(self, image_path: str) -> bool:
-        """Проверяет наличие метаданных для изображения"""
+    def _choose_thumbnail_tiers(self, cursor, metadata_ids: List[str], size: Optional[int],
+                                allow_smaller: bool) -> Dict[str, int]:
+        """Выбирает уровень миниатюры для каждого ID без чтения BLOB. Возвращает {id: размер уровня}"""
+        primary_size = config.THUMBNAIL_SIZE
+        target_size = primary_size if size is None else size
+        placeholders = ",".join("?" * len(metadata_ids))
+        
+        available: Dict[str, List[int]] = {}
+        cursor.execute(
+            f"SELECT id FROM metadata WHERE id IN ({placeholders}) AND thumbnail_data IS NOT NULL",
+            metadata_ids
+        )
+        for row in cursor.fetchall():
+            available.setdefault(row[0], []).append(primary_size)
+        cursor.execute(
+            f"SELECT metadata_id, size FROM thumbnails WHERE metadata_id IN ({placeholders})",
+            metadata_ids
+        )
+        for row in cursor.fetchall():
+            available.setdefault(row[0], []).append(row[1])
+        
+        if target_size > primary_size:
+            for metadata_id, sizes in self._get_large_tier_sizes(metadata_ids).items():
+                if metadata_id in available:
+                    available[metadata_id].extend(sizes)
+        
+        chosen = {}
+        for metadata_id, sizes in available.items():
+            larger = [s for s in sizes if s >= target_size]
+            if larger:
+                chosen[metadata_id] = min(larger)
+            elif allow_smaller:
+                chosen[metadata_id] = max(sizes)
+        return chosen
+    
+    def _get_large_tier_sizes(self, metadata_ids: List[str]) -> Dict[str, List[int]]:
+        """Размеры уровней на диске крупнее основной миниатюры"""
+        result: Dict[str, List[int]] = {}
+        with self._disk_lock:
+            cursor = self._disk_conn.cursor()
+            cursor.execute(
+                f"SELECT metadata_id, size FROM thumbnails WHERE metadata_id IN ({IDS_FROM_JSON}) AND size > ?",
+                (json.dumps(metadata_ids), config.THUMBNAIL_SIZE)
+            )
+            for row in cursor.fetchall():
+                result.setdefault(row[0], []).append(row[1])
+        return result
+    
+    def get_thumbnails(self, metadata_ids: List[str], size: Optional[int] = None,
+                       allow_smaller: bool = True) -> Dict[str, bytes]:
+        """Получает миниатюры для списка ID. Возвращает словарь {id: данные миниатюры}.
+        
+        Для каждого ID выбирается наименьший уровень не меньше size. Если такого нет,
+        при allow_smaller=True возвращается наибольший доступный уровень, иначе ID пропускается.
+        Без size возвращается основная миниатюра (config.THUMBNAIL_SIZE).
+        """
+        if not metadata_ids or self._memory_conn is None:
+            return {}
+        
+        result = {}
+        with self._read_lock:
+            try:
+                cursor = self._memory_conn.cursor()
+                chosen = self._choose_thumbnail_tiers(cursor, metadata_ids, size, allow_smaller)
+                
+                primary_ids = [metadata_id for metadata_id, tier in chosen.items() if tier == config.THUMBNAIL_SIZE]
+                tier_keys = [(metadata_id, tier) for metadata_id, tier in chosen.items() if tier < config.THUMBNAIL_SIZE]
+                large_keys = [(metadata_id, tier) for metadata_id, tier in chosen.items() if tier > config.THUMBNAIL_SIZE]
+                
+                if primary_ids:
+                    placeholders = ",".join("?" * len(primary_ids))
+                    cursor.execute(
+                        f"SELECT id, thumbnail_data FROM metadata WHERE id IN ({placeholders})",
+                        primary_ids
+                    )
+                    result.update((row[0], row[1]) for row in cursor.fetchall())
+                
+                if tier_keys:
+                    values = ",".join("(?, ?)" for _ in tier_keys)
+                    cursor.execute(
+                        f"SELECT metadata_id, data FROM thumbnails WHERE (metadata_id, size) IN (VALUES {values})",
+                        [value for key in tier_keys for value in key]
+                    )
+                    result.update((row[0], row[1]) for row in cursor.fetchall())
+                
+                if large_keys:
+                    values = ",".join("(?, ?)" for _ in large_keys)
+                    with self._disk_lock:
+                        disk_cursor = self._disk_conn.cursor()
+                        disk_cursor.execute(
+                            f"SELECT metadata_id, data FROM thumbnails WHERE (metadata_id, size) IN (VALUES {values})",
+                            [value for key in large_keys for value in key]
+                        )
+                        result.update((row[0], row[1]) for row in disk_cursor.fetchall())
+            except Exception as e:
+                logger.warning(f"Ошибка batch чтения миниатюр: {e}")
+        return result
+    
+    def get_thumbnail_versions(self, metadata_ids: List[str], size: Optional[int] = None,
+                               allow_smaller: bool = True) -> Dict[str, tuple]:
+        """Возвращает {id: (уровень, хеш, поколение миниатюры)} для ETag, не читая BLOB.
+        Уровень выбирается так же, как в get_thumbnails"""
+        if not metadata_ids or self._memory_conn is None:
+            return {}
+        
+        with self._read_lock:
+            try:
+                cursor = self._memory_conn.cursor()
+                chosen = self._choose_thumbnail_tiers(cursor, metadata_ids, size, allow_smaller)
+                if not chosen:
+                    return {}
+                placeholders = ",".join("?" * len(chosen))
+                cursor.execute(
+                    f"SELECT id, hash, thumbnail_generation FROM metadata WHERE id IN ({placeholders})",
+                    list(chosen)
+                )
+                return {row[0]: (chosen[row[0]], row[1], row[2]) for row in cursor.fetchall()}
+            except Exception as e:
+                logger.warning(f"Ошибка чтения версий миниатюр: {e}")
+                return {}
+    
+    @staticmethod
+    def _decode_fields(row, fields: List[str]) -> Dict[str, Any]:
+        """Значения колонок строки в том же виде, что и в _row_to_dict: tags - список, checked - bool"""
+        values = {field: row[field] for field in fields}
+        if "tags" in values:
+            values["tags"] = json.loads(values["tags"]) if values["tags"] else []
+        if "checked" in values:
+            values["checked"] = bool(values["checked"])
+        return values
+    
+    def get_fields_by_ids(self, metadata_ids: List[str], fields: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Получает только указанные колонки (без BLOB миниатюр) для списка ID. Возвращает {id: {поле: значение}}"""
+        if not metadata_ids or self._memory_conn is None:
+            return {}
+        
+        unknown = set(fields) - LIGHT_COLUMNS
+        if unknown:
+            raise ValueError(f"Недопустимые колонки: {unknown}")
+        
+        result = {}
+        with self._read_lock:
+            try:
+                columns = ", ".join(["id"] + list(fields))
+                cursor = self._memory_conn.cursor()
+                for i in range(0, len(metadata_ids), 500):
+                    chunk = metadata_ids[i:i + 500]
+                    placeholders = ",".join("?" * len(chunk))
+                    cursor.execute(f"SELECT {columns} FROM metadata WHERE id IN ({placeholders})", chunk)
+                    for row in cursor.fetchall():
+                        result[row["id"]] = self._decode_fields(row, fields)
+            except Exception as e:
+                logger.warning(f"Ошибка чтения колонок метаданных: {e}")
+        return result
+    
+    def get_complete_sizes(self) -> Dict[str, int]:
+        """Возвращает {относительный путь: размер файла} для записей с миниатюрой (BLOB не читаются)."""
         if self._memory_conn is None:
-            return False
+            return {}
         with self._read_lock:
             try:
                 cursor = self._memory_conn.cursor()
-                cursor.execute("SELECT COUNT(*) FROM metadata WHERE image_path = ?", (image_path,))
-                row = cursor.fetchone()
-                return row[0] > 0 if row else False
+                cursor.execute("SELECT image_path, size FROM metadata WHERE thumbnail_data IS NOT NULL")
+                return {row[0]: row[1] for row in cursor.fetchall()}
             except Exception as e:
-                logger.warning(f"Ошибка проверки метаданных для {image_path}: {e}")
-                return False
+                logger.error(f"Ошибка получения обработанных путей: {e}")
+                return {}
+    
+    def get_ids_without_phash(self) -> List[str]:
+        """ID записей с миниатюрой, но без перцептивного хеша (созданных до его появления)"""
+        if self._memory_conn is None:
+            return []
+        with self._read_lock:
+            cursor = self._memory_conn.cursor()
+            cursor.execute("SELECT id FROM metadata WHERE phash IS NULL AND thumbnail_data IS NOT NULL")
+            return [row[0] for row in cursor.fetchall()]
+    
+    def save_phashes(self, phashes: Dict[str, int]) -> int:
+        """Обновляет только перцептивные хеши записей {id: phash}. Возвращает количество обновленных записей"""
+        if not phashes or self._memory_conn is None:
+            return 0
+        
+        with self._read_lock:
+            try:
+                cursor = self._memory_conn.cursor()
+                cursor.executemany(
+                    "UPDATE metadata SET phash = ? WHERE id = ?",
+                    [(phash, metadata_id) for metadata_id, phash in phashes.items()]
+                )
+                updated = cursor.rowcount
+                self._memory_conn.commit()
+                if self._index is not None:
+                    self._index.set_phashes(phashes)
+                
+                with self._dirty_lock:
+                    self._mark_dirty_columns(phashes, {"phash"})
+                
+                self._schedule_save()
+                return updated
+            except Exception as e:
+                logger.error(f"Ошибка сохранения перцептивных хешей: {e}, количество: {len(phashes)}")
+                raise
+    
+    @staticmethod
+    def _folder_filter(relative_folder: Optional[str]) -> Tuple[str, tuple]:
+        """Условие WHERE и параметры для изображений папки (без рекурсии). relative_folder=None - все записи"""
+        if relative_folder is None:
+            return "1", ()
+        if relative_folder == "":
+            return "instr(image_path, '/') = 0", ()
+        normalized = relative_folder.replace("\\", "/").rstrip("/")
+        return "image_path LIKE ? AND instr(substr(image_path, ?), '/') = 0", (f"{normalized}/%", len(normalized) + 2)
+    
+    def get_folder_paths(self, relative_folder: Optional[str]) -> Set[str]:
+        """Возвращает множество относительных путей изображений папки (без рекурсии) одним запросом.
+        relative_folder=None - все пути"""
+        if self._memory_conn is None:
+            return set()
+        with self._read_lock:
+            try:
+                where, params = self._folder_filter(relative_folder)
+                cursor = self._memory_conn.cursor()
+                cursor.execute(f"SELECT image_path FROM metadata WHERE {where}", params)
+                return {row[0] for row in cursor.fetchall()}
+            except Exception as e:
+                logger.error(f"Ошибка получения путей для папки '{relative_folder}': {e}")
+                return set()
+    
+    def get_folder_ids(self, relative_folder: Optional[str]) -> List[str]:
+        """ID изображений папки (без рекурсии) без чтения строк целиком. relative_folder=None - все ID"""
+        if self._memory_conn is None:
+            return []
+        with self._read_lock:
+            try:
+                where, params = self._folder_filter(relative_folder)
+                cursor = self._memory_conn.cursor()
+                cursor.execute(f"SELECT id FROM metadata WHERE {where}", params)
+                return [row[0] for row in cursor.fetchall()]
+            except Exception as e:
+                logger.error(f"Ошибка получения ID для папки '{relative_folder}': {e}")
+                return []
+    
+    def get_paths_under(self, prefix: str) -> List[str]:
+        """Возвращает относительные пути изображений, начинающиеся с prefix (рекурсивно по папке)"""
+        if self._memory_conn is None:
+            return []
+        with self._read_lock:
+            try:
+                cursor = self._memory_conn.cursor()
+                cursor.execute(
+                    "SELECT image_path FROM metadata WHERE substr(image_path, 1, ?) = ?",
+                    (len(prefix), prefix)
+                )
+                return [row[0] for row in cursor.fetchall()]
+            except Exception as e:
+                logger.error(f"Ошибка получения путей для '{prefix}': {e}")
+                return []
+    
+    def get_folder_counts(self) -> Dict[str, int]:
+        """Возвращает {относительная папка: количество изображений} одним GROUP BY.
+        Папка - префикс image_path до последнего "/": rtrim удаляет с конца все символы, кроме "/"."""
+        if self._memory_conn is None:
+            return {}
+        with self._read_lock:
+            try:
+                cursor = self._memory_conn.cursor()
+                cursor.execute("""
+                    SELECT rtrim(image_path, replace(image_path, '/', '')) AS folder, COUNT(*)
+                    FROM metadata
+                    GROUP BY folder
+                """)
+                return {row[0].rstrip("/"): row[1] for row in cursor.fetchall()}
+            except Exception as e:
+                logger.error(f"Ошибка подсчета изображений по папкам: {e}")
+                return {}
     
     def get_all(self) -> List[Dict[str, Any]]:
         """Получает все метаданные"""
@@ -506,23 +1006,9 @@ class DatabaseManager:
         
         with self._read_lock:
             try:
+                where, params = self._folder_filter(relative_folder)
                 cursor = self._memory_conn.cursor()
-                if relative_folder is None:
-                    cursor.execute("SELECT * FROM metadata")
-                elif relative_folder == "":
-                    cursor.execute("SELECT * FROM metadata WHERE instr(image_path, '/') = 0")
-                else:
-                    normalized = relative_folder.replace("\\", "/").rstrip("/")
-                    pattern = f"{normalized}/%"
-                    start_index = len(normalized) + 2
-                    cursor.execute(
-                        """
-                        SELECT * FROM metadata
-                        WHERE image_path LIKE ?
-                          AND instr(substr(image_path, ?), '/') = 0
-                        """,
-                        (pattern, start_index)
-                    )
+                cursor.execute(f"SELECT * FROM metadata WHERE {where}", params)
                 rows = cursor.fetchall()
                 return [self._row_to_dict(row) for row in rows]
             except Exception as e:
@@ -575,13 +1061,19 @@ class DatabaseManager:
         
         with self._read_lock:
             try:
+                # INSERT OR REPLACE вытесняет по UNIQUE(image_path) запись с другим ID: она удаляется явно,
+                # вместе с уровнями миниатюр, вероятностями тегов и строкой индекса
+                evicted = self._ids_replaced_by_path(metadata_list)
+                if evicted:
+                    self.delete(evicted)
+                
                 if len(metadata_list) == 1:
                     row_data = self._dict_to_row(metadata_list[0])
                     cursor = self._memory_conn.cursor()
                     cursor.execute("""
                         INSERT OR REPLACE INTO metadata 
-                        (id, prompt, checked, rating, tags, size, hash, image_path, thumbnail_data, updated_at)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                        (id, prompt, checked, rating, tags, size, hash, image_path, thumbnail_data, thumbnail_generation, phash, updated_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
                     """, row_data)
                 else:
                     rows_data = []
@@ -600,23 +1092,405 @@ class DatabaseManager:
                     cursor = self._memory_conn.cursor()
                     cursor.executemany("""
                         INSERT OR REPLACE INTO metadata 
-                        (id, prompt, checked, rating, tags, size, hash, image_path, thumbnail_data, updated_at)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                        (id, prompt, checked, rating, tags, size, hash, image_path, thumbnail_data, thumbnail_generation, phash, updated_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
                     """, rows_data)
                 
+                tier_ids = [m["id"] for m in metadata_list if m.get("thumbnail_tiers") is not None]
+                if tier_ids:
+                    placeholders = ",".join("?" * len(tier_ids))
+                    cursor.execute(f"DELETE FROM thumbnails WHERE metadata_id IN ({placeholders})", tier_ids)
+                    cursor.executemany(
+                        "INSERT INTO thumbnails (metadata_id, size, data) VALUES (?, ?, ?)",
+                        [
+                            (m["id"], int(size), data)
+                            for m in metadata_list if m.get("thumbnail_tiers")
+                            for size, data in m["thumbnail_tiers"].items() if data
+                        ]
+                    )
+                
+                score_rows = [
+                    self._tag_scores_row(m["id"], m["tag_scores"])
+                    for m in metadata_list if m.get("tag_scores") is not None
+                ]
+                if score_rows:
+                    cursor.executemany(
+                        "INSERT OR REPLACE INTO tag_scores (metadata_id, method, scores, auto_tags) VALUES (?, ?, ?, ?)",
+                        score_rows
+                    )
+                
                 self._memory_conn.commit()
+                if tier_ids:
+                    self._delete_large_tiers(tier_ids)
+                if self._index is not None:
+                    self._index.upsert(metadata_list)
                 
                 with self._dirty_lock:
                     for metadata in metadata_list:
                         metadata_id = metadata["id"]
                         self._dirty_ids.add(metadata_id)
                         self._dirty_deletes.discard(metadata_id)
+                        self._dirty_columns.pop(metadata_id, None)
+                    self._dirty_tier_ids.update(tier_ids)
+                    self._dirty_score_ids.update(row[0] for row in score_rows)
                 
                 self._schedule_save()
             except Exception as e:
                 logger.error(f"Ошибка сохранения метаданных: {e}, количество: {len(metadata_list)}")
                 raise
     
+    def _ids_replaced_by_path(self, metadata_list: List[Dict[str, Any]]) -> List[str]:
+        """ID существующих записей с путями из metadata_list, но с другим ID"""
+        incoming_ids = {metadata["id"] for metadata in metadata_list}
+        cursor = self._memory_conn.cursor()
+        cursor.execute(
+            f"SELECT id FROM metadata WHERE image_path IN ({IDS_FROM_JSON})",
+            (json.dumps([metadata.get("image_path", "") for metadata in metadata_list]),)
+        )
+        return [row[0] for row in cursor.fetchall() if row[0] not in incoming_ids]
+    
+    def save_new(self, metadata_list: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Сохраняет только записи, путей которых еще нет в БД: проверка и вставка под одной блокировкой,
+        поэтому одновременное добавление одного файла из разных потоков не создает вторую запись.
+        Возвращает сохраненные записи"""
+        if not metadata_list or self._memory_conn is None:
+            return []
+        
+        with self._read_lock:
+            cursor = self._memory_conn.cursor()
+            cursor.execute(
+                f"SELECT image_path FROM metadata WHERE image_path IN ({IDS_FROM_JSON})",
+                (json.dumps([metadata["image_path"] for metadata in metadata_list]),)
+            )
+            existing = {row[0] for row in cursor.fetchall()}
+            new_list = [metadata for metadata in metadata_list if metadata["image_path"] not in existing]
+            self.save(new_list)
+        return new_list
+    
+    def update_columns(self, metadata_ids: List[str], values: Dict[str, Any]) -> List[str]:
+        """Записывает одинаковые значения колонок (из BULK_UPDATE_COLUMNS) всем указанным записям
+        одним UPDATE на пачку ID, не читая и не перезаписывая строки целиком.
+        Затрагиваются только записи, где значение действительно меняется. Возвращает их ID"""
+        batches = [
+            (f"id IN ({','.join('?' * len(metadata_ids[i:i + 500]))})", metadata_ids[i:i + 500])
+            for i in range(0, len(metadata_ids), 500)
+        ]
+        return self._update_columns(batches, values)
+    
+    def _update_columns(self, batches: List[Tuple[str, list]], values: Dict[str, Any]) -> List[str]:
+        """update_columns для записей, выбранных условиями WHERE: [(условие, параметры), ...]"""
+        if not batches or not values or self._memory_conn is None:
+            return []
+        
+        unknown = set(values) - BULK_UPDATE_COLUMNS
+        if unknown:
+            raise ValueError(f"Недопустимые колонки: {unknown}")
+        
+        encoded = {}
+        if "checked" in values:
+            encoded["checked"] = 1 if values["checked"] else 0
+        if "rating" in values:
+            encoded["rating"] = int(values["rating"] or 0)
+        if "tags" in values:
+            tags = values["tags"] if isinstance(values["tags"], list) else []
+            encoded["tags"] = json.dumps(tags, ensure_ascii=False)
+        assignments = ", ".join(f"{column} = ?" for column in encoded)
+        differs = " OR ".join(f"{column} IS NOT ?" for column in encoded)
+        params = list(encoded.values())
+        
+        changed = []
+        with self._read_lock:
+            try:
+                cursor = self._memory_conn.cursor()
+                for where, where_params in batches:
+                    cursor.execute(f"SELECT id FROM metadata WHERE {where} AND ({differs})", where_params + params)
+                    batch_changed = [row[0] for row in cursor.fetchall()]
+                    if batch_changed:
+                        cursor.execute(
+                            f"UPDATE metadata SET {assignments}, updated_at = CURRENT_TIMESTAMP "
+                            f"WHERE {where} AND ({differs})",
+                            params + where_params + params
+                        )
+                        changed.extend(batch_changed)
+                self._memory_conn.commit()
+                if self._index is not None:
+                    self._index.update_columns(changed, values)
+                
+                with self._dirty_lock:
+                    self._mark_dirty_columns(changed, set(encoded))
+                
+                if changed:
+                    self._schedule_save()
+                return changed
+            except Exception as e:
+                logger.error(f"Ошибка обновления колонок {list(values)}: {e}")
+                raise
+    
+    def _expire_selections(self) -> None:
+        """Удаляет выборки, к которым не обращались дольше config.SELECTION_TTL (вызывается под _read_lock)"""
+        deadline = time.monotonic() - config.SELECTION_TTL
+        expired = [token for token, used in self._selections.items() if used < deadline]
+        if not expired:
+            return
+        for token in expired:
+            del self._selections[token]
+        self._memory_conn.executemany("DELETE FROM temp.selection_items WHERE token = ?", [(t,) for t in expired])
+        self._memory_conn.commit()
+        logger.info(f"Удалено устаревших выборок: {len(expired)}")
+    
+    def _touch_selection(self, token: str) -> bool:
+        """Продлевает выборку. False, если выборки нет или она устарела"""
+        with self._read_lock:
+            self._expire_selections()
+            if token not in self._selections:
+                return False
+            self._selections[token] = time.monotonic()
+            return True
+    
+    def create_selection(self, metadata_ids: Iterable[str]) -> Tuple[str, int]:
+        """Сохраняет набор ID во временной таблице selection_items.
+        Несуществующие ID отбрасываются. Возвращает токен выборки и количество записей в ней"""
+        if self._memory_conn is None:
+            raise RuntimeError("БД не инициализирована")
+        token = uuid.uuid4().hex
+        with self._read_lock:
+            self._expire_selections()
+            cursor = self._memory_conn.cursor()
+            cursor.executemany(
+                "INSERT OR IGNORE INTO temp.selection_items (token, metadata_id) SELECT ?, id FROM metadata WHERE id = ?",
+                ((token, metadata_id) for metadata_id in metadata_ids)
+            )
+            self._memory_conn.commit()
+            cursor.execute("SELECT COUNT(*) FROM temp.selection_items WHERE token = ?", (token,))
+            count = cursor.fetchone()[0]
+            self._selections[token] = time.monotonic()
+        return token, count
+    
+    def release_selection(self, token: str) -> bool:
+        """Удаляет выборку. Возвращает True, если она существовала"""
+        if self._memory_conn is None:
+            return False
+        with self._read_lock:
+            if self._selections.pop(token, None) is None:
+                return False
+            self._memory_conn.execute("DELETE FROM temp.selection_items WHERE token = ?", (token,))
+            self._memory_conn.commit()
+            return True
+    
+    def get_selection_fields(self, token: str, fields: List[str],
+                             checked_only: bool = False) -> Optional[Dict[str, Dict[str, Any]]]:
+        """Колонки (из LIGHT_COLUMNS) записей выборки одним запросом: {id: {поле: значение}}.
+        Удаленные после создания выборки записи не возвращаются. None, если выборки нет"""
+        unknown = set(fields) - LIGHT_COLUMNS
+        if unknown:
+            raise ValueError(f"Недопустимые поля: {unknown}")
+        if self._memory_conn is None or not self._touch_selection(token):
+            return None
+        
+        columns = ", ".join(["id"] + list(fields))
+        where = SELECTION_FILTER + (" AND checked = 1" if checked_only else "")
+        with self._read_lock:
+            cursor = self._memory_conn.cursor()
+            cursor.execute(f"SELECT {columns} FROM metadata WHERE {where}", (token,))
+            rows = cursor.fetchall()
+        
+        return {row["id"]: self._decode_fields(row, fields) for row in rows}
+    
+    def update_selection(self, token: str, values: Dict[str, Any]) -> Optional[List[str]]:
+        """update_columns для всех записей выборки одним UPDATE. None, если выборки нет"""
+        if not self._touch_selection(token):
+            return None
+        return self._update_columns([(SELECTION_FILTER, [token])], values)
+    
+    def save_thumbnail(self, metadata_id: str, thumbnail_data: bytes, tiers: Optional[Dict[int, bytes]] = None,
+                       generation: int = 0, phash: Optional[int] = None) -> bool:
+        """Сохраняет только миниатюры записи (и перцептивный хеш, если передан), не перезаписывая остальные поля.
+        Возвращает False, если записи уже нет (например, удалена во время генерации)"""
+        if self._memory_conn is None:
+            return False
+        
+        with self._read_lock:
+            try:
+                cursor = self._memory_conn.cursor()
+                cursor.execute(
+                    """
+                    UPDATE metadata SET thumbnail_data = ?, thumbnail_generation = ?, phash = COALESCE(?, phash),
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                    """,
+                    (thumbnail_data, int(generation), phash, metadata_id)
+                )
+                if cursor.rowcount == 0:
+                    return False
+                if tiers is not None:
+                    cursor.execute("DELETE FROM thumbnails WHERE metadata_id = ?", (metadata_id,))
+                    cursor.executemany(
+                        "INSERT INTO thumbnails (metadata_id, size, data) VALUES (?, ?, ?)",
+                        [(metadata_id, int(size), data) for size, data in tiers.items() if data]
+                    )
+                self._memory_conn.commit()
+                if tiers is not None:
+                    self._delete_large_tiers([metadata_id])
+                if self._index is not None and phash is not None:
+                    self._index.set_phashes({metadata_id: phash})
+                
+                with self._dirty_lock:
+                    self._mark_dirty_columns([metadata_id], {"thumbnail_data", "thumbnail_generation", "phash"})
+                    if tiers is not None:
+                        self._dirty_tier_ids.add(metadata_id)
+                
+                self._schedule_save()
+                return True
+            except Exception as e:
+                logger.error(f"Ошибка сохранения миниатюры {metadata_id}: {e}")
+                raise
+    
+    def save_large_tier(self, metadata_id: str, size: int, data: bytes, generation: int) -> bool:
+        """Сохраняет уровень миниатюры крупнее основной сразу на диск, минуя память.
+        Возвращает False, если запись удалена или ее миниатюра пересоздана во время генерации"""
+        if self._memory_conn is None or self._disk_conn is None:
+            return False
+        
+        with self._read_lock:
+            cursor = self._memory_conn.cursor()
+            cursor.execute("SELECT thumbnail_generation FROM metadata WHERE id = ?", (metadata_id,))
+            row = cursor.fetchone()
+            if row is None or row[0] != generation:
+                return False
+            # Диск захватывается до освобождения памяти: пересоздание миниатюры не вклинится между проверкой и записью
+            self._disk_lock.acquire()
+        
+        try:
+            self._disk_conn.execute(
+                "INSERT OR REPLACE INTO thumbnails (metadata_id, size, data) VALUES (?, ?, ?)",
+                (metadata_id, int(size), data)
+            )
+            self._disk_conn.commit()
+        finally:
+            self._disk_lock.release()
+        return True
+    
+    def _delete_large_tiers(self, metadata_ids: List[str]) -> None:
+        """Удаляет с диска крупные уровни пересозданных миниатюр: они будут созданы заново по запросу"""
+        with self._disk_lock:
+            self._disk_conn.execute(
+                f"DELETE FROM thumbnails WHERE metadata_id IN ({IDS_FROM_JSON}) AND size > ?",
+                (json.dumps(metadata_ids), config.THUMBNAIL_SIZE)
+            )
+            self._disk_conn.commit()
+    
+    def get_ids_missing_tiers(self, sizes: List[int]) -> List[str]:
+        """ID записей с основной миниатюрой, у которых нет хотя бы одного из уровней sizes"""
+        if not sizes or self._memory_conn is None:
+            return []
+        
+        placeholders = ",".join("?" * len(sizes))
+        with self._read_lock:
+            cursor = self._memory_conn.cursor()
+            cursor.execute(
+                f"""
+                SELECT id FROM metadata WHERE thumbnail_data IS NOT NULL AND (
+                    SELECT COUNT(*) FROM thumbnails WHERE metadata_id = metadata.id AND size IN ({placeholders})
+                ) < ?
+                """,
+                [int(size) for size in sizes] + [len(sizes)]
+            )
+            return [row[0] for row in cursor.fetchall()]
+    
+    def save_tiers(self, tiers: Dict[str, Dict[int, bytes]]) -> int:
+        """Добавляет уровни миниатюр {id: {размер: данные}}, не трогая основную миниатюру и поля записи.
+        Возвращает количество записей, которым добавлены уровни"""
+        if not tiers or self._memory_conn is None:
+            return 0
+        
+        with self._read_lock:
+            cursor = self._memory_conn.cursor()
+            cursor.executemany(
+                """
+                INSERT OR REPLACE INTO thumbnails (metadata_id, size, data)
+                SELECT id, ?, ? FROM metadata WHERE id = ?
+                """,
+                [
+                    (int(size), data, metadata_id)
+                    for metadata_id, sizes in tiers.items()
+                    for size, data in sizes.items() if data
+                ]
+            )
+            self._memory_conn.commit()
+            with self._dirty_lock:
+                self._dirty_tier_ids.update(tiers)
+        
+        self._schedule_save()
+        return len(tiers)
+    
+    @staticmethod
+    def _tag_scores_row(metadata_id: str, tag_scores: Dict[str, Any]) -> tuple:
+        return (
+            metadata_id, tag_scores["method"], tag_scores["scores"],
+            json.dumps(tag_scores.get("auto_tags", []), ensure_ascii=False)
+        )
+    
+    def get_tag_scores(self, metadata_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Возвращает сохраненные вероятности тегов: {id: {"method", "scores", "auto_tags"}}"""
+        if not metadata_ids or self._memory_conn is None:
+            return {}
+        
+        result = {}
+        with self._read_lock:
+            cursor = self._memory_conn.cursor()
+            for i in range(0, len(metadata_ids), 500):
+                chunk = metadata_ids[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                cursor.execute(
+                    f"SELECT metadata_id, method, scores, auto_tags FROM tag_scores WHERE metadata_id IN ({placeholders})",
+                    chunk
+                )
+                for row in cursor.fetchall():
+                    result[row["metadata_id"]] = {
+                        "method": row["method"],
+                        "scores": row["scores"],
+                        "auto_tags": json.loads(row["auto_tags"])
+                    }
+        return result
+    
+    def save_tags(self, results: List[Dict[str, Any]]) -> int:
+        """Обновляет только теги записей и, если переданы, их вероятности (tag_scores).
+        Принимает [{"id", "tags", "tag_scores"?}, ...]. Возвращает количество обновленных записей"""
+        if not results or self._memory_conn is None:
+            return 0
+        
+        with self._read_lock:
+            try:
+                cursor = self._memory_conn.cursor()
+                cursor.executemany(
+                    "UPDATE metadata SET tags = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    [(json.dumps(r["tags"], ensure_ascii=False), r["id"]) for r in results]
+                )
+                updated = cursor.rowcount
+                score_rows = [
+                    self._tag_scores_row(r["id"], r["tag_scores"])
+                    for r in results if r.get("tag_scores") is not None
+                ]
+                if score_rows:
+                    cursor.executemany(
+                        "INSERT OR REPLACE INTO tag_scores (metadata_id, method, scores, auto_tags) "
+                        "SELECT ?1, ?2, ?3, ?4 WHERE EXISTS (SELECT 1 FROM metadata WHERE id = ?1)",
+                        score_rows
+                    )
+                self._memory_conn.commit()
+                if self._index is not None:
+                    self._index.set_tags({r["id"]: r["tags"] for r in results})
+                
+                with self._dirty_lock:
+                    self._mark_dirty_columns((r["id"] for r in results), {"tags"})
+                    self._dirty_score_ids.update(row[0] for row in score_rows)
+                
+                self._schedule_save()
+                return updated
+            except Exception as e:
+                logger.error(f"Ошибка сохранения тегов: {e}, количество: {len(results)}")
+                raise
+    
     def delete(self, metadata_ids: List[str]) -> int:
         """Удаляет метаданные. Принимает список ID для удаления. Возвращает количество удаленных записей"""
         if not metadata_ids or self._memory_conn is None:
@@ -627,18 +1501,27 @@ class DatabaseManager:
                 cursor = self._memory_conn.cursor()
                 cursor.execute("DELETE FROM metadata WHERE id = ?", (metadata_ids[0],))
                 rowcount = cursor.rowcount
+                cursor.execute("DELETE FROM thumbnails WHERE metadata_id = ?", (metadata_ids[0],))
+                cursor.execute("DELETE FROM tag_scores WHERE metadata_id = ?", (metadata_ids[0],))
             else:
-                placeholders = ",".join("?" * len(metadata_ids))
+                ids_json = (json.dumps(metadata_ids),)
                 cursor = self._memory_conn.cursor()
-                cursor.execute(f"DELETE FROM metadata WHERE id IN ({placeholders})", metadata_ids)
+                cursor.execute(f"DELETE FROM metadata WHERE id IN ({IDS_FROM_JSON})", ids_json)
                 rowcount = cursor.rowcount
+                cursor.execute(f"DELETE FROM thumbnails WHERE metadata_id IN ({IDS_FROM_JSON})", ids_json)
+                cursor.execute(f"DELETE FROM tag_scores WHERE metadata_id IN ({IDS_FROM_JSON})", ids_json)
             
             self._memory_conn.commit()
+            if self._index is not None:
+                self._index.remove(metadata_ids)
             
             with self._dirty_lock:
                 for metadata_id in metadata_ids:
                     self._dirty_deletes.add(metadata_id)
                     self._dirty_ids.discard(metadata_id)
+                    self._dirty_columns.pop(metadata_id, None)
+                    self._dirty_tier_ids.discard(metadata_id)
+                    self._dirty_score_ids.discard(metadata_id)
             
             self._schedule_save()
             return rowcount
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""
+Скачивает модели WD14 Tagger заранее (в auto_tag_model_dir или кэш Hugging Face),
+чтобы генерация тегов не обращалась к сети. Для методов с суффиксом -int8 сразу строит INT8 версию.
+"""
+
+import argparse
+import logging
+
+from config import config
+from tag import download_model, tagger_methods
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Скачивает модели WD14 Tagger для работы без сети")
+    parser.add_argument("methods", nargs="*", metavar="method",
+                        help=f"Методы auto_tag_method: {', '.join(tagger_methods())} (по умолчанию: {config.AUTO_TAG_METHOD})")
+    args = parser.parse_args()
+
+    # choices с nargs="*" проверяет и список по умолчанию целиком, поэтому методы проверяются здесь
+    methods = args.methods or [config.AUTO_TAG_METHOD]
+    unknown = [method for method in methods if method not in tagger_methods()]
+    if unknown:
+        parser.error(f"неизвестные методы: {', '.join(unknown)} (доступны: {', '.join(tagger_methods())})")
+
+    for method in methods:
+        logger.info(f"Подготовка модели {method}...")
+        download_model(method)
+    logger.info(f"Готово. Папка моделей: {config.AUTO_TAG_MODEL_DIR or 'кэш Hugging Face'}")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
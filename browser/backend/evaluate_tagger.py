@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Сравнение моделей WD14 Tagger (значений auto_tag_method) на локальной выборке.
+Для каждого метода измеряет количество изображений в секунду и согласие тегов
+с эталонным методом: точность, полноту и среднее сходство Жаккара.
+"""
+
+import time
+import random
+import argparse
+import logging
+from itertools import islice
+from typing import Dict, List
+
+from config import config
+from paths import walk_images
+from tag import TagGenerator, tagger_methods
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+
+def run_method(method: str, paths: List[str], batch_size: int, threshold: float):
+    """Возвращает (теги для каждого изображения, изображений в секунду на модели)"""
+    generator = TagGenerator(method)
+    images = generator.preprocess_batch(paths)
+    generator.run_batch(images[:1])
+
+    tags = []
+    start = time.perf_counter()
+    for i in range(0, len(images), batch_size):
+        confidences = generator.run_batch(images[i:i + batch_size])
+        tags.extend(generator.postprocess_batch(confidences, threshold))
+    elapsed = time.perf_counter() - start
+    return tags, len(images) / elapsed
+
+
+def agreement(reference: List[List[str]], tags: List[List[str]]) -> Dict[str, float]:
+    """Точность и полнота относительно эталона (микроусреднение) и среднее сходство Жаккара"""
+    matched = predicted = expected = 0
+    jaccard = []
+    for ref, got in zip(reference, tags):
+        ref, got = set(ref), set(got)
+        matched += len(ref & got)
+        predicted += len(got)
+        expected += len(ref)
+        union = ref | got
+        jaccard.append(len(ref & got) / len(union) if union else 1.0)
+    return {
+        "precision": matched / predicted if predicted else 1.0,
+        "recall": matched / expected if expected else 1.0,
+        "jaccard": sum(jaccard) / len(jaccard) if jaccard else 1.0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнивает модели WD14 Tagger по скорости и согласию тегов")
+    parser.add_argument("--count", type=int, default=100, help="Количество изображений в выборке (по умолчанию: 100)")
+    parser.add_argument("--methods", nargs="*", default=["wd14", "wd14-int8", "wd14-convnext", "wd14-vit"],
+                        choices=tagger_methods(), help="Методы для сравнения")
+    parser.add_argument("--reference", default="wd14", choices=tagger_methods(),
+                        help="Эталонный метод (по умолчанию: wd14)")
+    parser.add_argument("--batch-size", type=int, default=config.AUTO_TAG_BATCH_SIZE,
+                        help=f"Размер батча (по умолчанию: {config.AUTO_TAG_BATCH_SIZE})")
+    parser.add_argument("--threshold", type=float, default=config.AUTO_TAG_THRESHOLD,
+                        help=f"Порог тегов (по умолчанию: {config.AUTO_TAG_THRESHOLD})")
+    args = parser.parse_args()
+
+    paths = list(islice(walk_images(), args.count * 10))
+    random.shuffle(paths)
+    paths = paths[:args.count]
+    if not paths:
+        logger.error(f"Не найдено изображений в {config.IMAGE_FOLDER}")
+        return 1
+
+    methods = [args.reference] + [method for method in args.methods if method != args.reference]
+    results = {}
+    for method in methods:
+        logger.info(f"Метод {method}: {len(paths)} изображений")
+        results[method] = run_method(method, paths, max(1, args.batch_size), args.threshold)
+
+    reference_tags = results[args.reference][0]
+    print(f"{'метод':<16} {'изобр./с':>10} {'точность':>9} {'полнота':>8} {'Жаккар':>7}")
+    for method in methods:
+        tags, speed = results[method]
+        stats = agreement(reference_tags, tags)
+        print(f"{method:<16} {speed:>10.1f} {stats['precision']:>9.3f} {stats['recall']:>8.3f} {stats['jaccard']:>7.3f}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -4,11 +4,15 @@ import logging
 import threading
 from collections import Counter
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Dict, Optional, Callable
+from typing import Dict, Optional, Callable, List
+
+import numpy as np
 
 from metadata import metadata_store
-from paths import get_absolute_path, get_image_paths
+from paths import get_absolute_path, get_image_paths, get_relative_path, folder_tree_cache
 from config import config
+from tag import ingest_max_workers
+from phash import near_duplicate_groups, search_distance
 
 logger = logging.getLogger(__name__)
 
@@ -30,7 +34,7 @@ def needs_processing(folder=None):
     if not image_paths:
         return False
 
-    return any(not metadata_store.has_metadata(path) for path in image_paths)
+    return bool(metadata_store.get_missing_paths(image_paths, folder, first_only=True))
 
 
 def collect_images(folder=None, progress_callback: Optional[Callable[[int, int, str], None]] = None):
@@ -51,7 +55,7 @@ def collect_images(folder=None, progress_callback: Optional[Callable[[int, int,
                 new_images.append((idx, path))
 
         if new_images:
-            max_workers = min(32, (os.cpu_count() or 1) * 4, len(new_images))
+            max_workers = ingest_max_workers(len(new_images))
             new_metadata_list = []
             total = len(new_images)
             processed_new = 0
@@ -82,12 +86,88 @@ def collect_images(folder=None, progress_callback: Optional[Callable[[int, int,
             
             if new_metadata_list:
                 logger.info("Сохранение метаданных в БД...")
-                metadata_store.save(new_metadata_list)
-                logger.info(f"Сохранено {len(new_metadata_list)} метаданных в БД")
+                saved = metadata_store.save_new(new_metadata_list)
+                folder_tree_cache.invalidate()
+                logger.info(f"Сохранено {len(saved)} метаданных в БД")
+                if len(saved) < len(new_metadata_list):
+                    # Часть изображений тем временем добавил наблюдатель за папкой: в результат - их записи из БД
+                    unsaved_ids = {m["id"] for m in new_metadata_list} - {m["id"] for m in saved}
+                    skipped = [(idx, metadata) for idx, metadata in results if metadata["id"] in unsaved_ids]
+                    stored = metadata_store.get_by_paths([get_absolute_path(m["image_path"]) for _, m in skipped])
+                    replaced = {idx: current for (idx, _), current in zip(skipped, stored) if current is not None}
+                    results = [(idx, replaced.get(idx, metadata)) for idx, metadata in results]
     
     return [metadata for _, metadata in sorted(results)]
 
 
+def ingest_images(image_paths: List[str]) -> int:
+    """Создает метаданные для новых изображений (абсолютные пути), уже известные пропускает.
+    Возвращает количество добавленных записей"""
+    existing_metadata = metadata_store.get_by_paths(image_paths)
+    new_paths = [
+        path for path, metadata in zip(image_paths, existing_metadata)
+        if metadata is None and os.path.isfile(path)
+    ]
+    if not new_paths:
+        return 0
+    
+    with ThreadPoolExecutor(max_workers=ingest_max_workers(len(new_paths))) as pool:
+        new_metadata_list = list(pool.map(metadata_store.create_metadata, new_paths))
+    # Те же файлы может одновременно обрабатывать /processing/start (collect_images): сохраняются только новые
+    saved = metadata_store.save_new(new_metadata_list)
+    if saved:
+        folder_tree_cache.invalidate()
+    return len(saved)
+
+
+def forget_images(image_paths: List[str]) -> int:
+    """Удаляет метаданные изображений, файлов которых больше нет. Возвращает количество удаленных записей"""
+    existing_metadata = metadata_store.get_by_paths(image_paths)
+    metadata_ids = [
+        metadata["id"] for path, metadata in zip(image_paths, existing_metadata)
+        if metadata is not None and not os.path.exists(path)
+    ]
+    if not metadata_ids:
+        return 0
+    
+    deleted = metadata_store.delete(metadata_ids)
+    folder_tree_cache.invalidate()
+    return deleted
+
+
+def move_image(src_path: str, dst_path: str) -> bool:
+    """Переносит метаданные (теги, оценку, миниатюры) на новый путь файла после перемещения"""
+    src_metadata, dst_metadata = metadata_store.get_by_paths([src_path, dst_path])
+    if src_metadata is None or dst_metadata is not None:
+        return ingest_images([dst_path]) > 0
+    
+    moved = dict(src_metadata)
+    moved["image_path"] = get_relative_path(dst_path)
+    metadata_store.save([moved])
+    folder_tree_cache.invalidate()
+    return True
+
+
+def move_folder(src_folder: str, dst_folder: str) -> int:
+    """Переносит метаданные всех изображений папки (рекурсивно) на новый путь после перемещения папки.
+    Возвращает количество перенесенных записей"""
+    src_prefix = get_relative_path(src_folder).rstrip("/") + "/"
+    dst_prefix = get_relative_path(dst_folder).rstrip("/") + "/"
+    rel_paths = metadata_store.get_paths_under(src_prefix)
+    moved = 0
+    for start in range(0, len(rel_paths), 500):
+        chunk = rel_paths[start:start + 500]
+        updates = []
+        for rel_path, metadata in zip(chunk, metadata_store.get_by_paths([get_absolute_path(p) for p in chunk])):
+            if metadata is not None:
+                updates.append({**metadata, "image_path": dst_prefix + rel_path[len(src_prefix):]})
+        metadata_store.save(updates)
+        moved += len(updates)
+    if moved:
+        folder_tree_cache.invalidate()
+    return moved
+
+
 def sort_images(images, sort_by, order):
     if not images:
         return images
@@ -121,6 +201,47 @@ def sort_images(images, sort_by, order):
     return images
 
 
+def _hash_key(img):
+    return img.get("hash", "")
+
+
+def _prompt_key(img):
+    return img.get("prompt", "").strip().lower()
+
+
+def _near_group_key(img):
+    return img.get("near_group")
+
+
+def _duplicate_key(search):
+    """Ключ группы дубликатов, если поиск (в т.ч. после u:/c:) - dh:, dp: или nd:"""
+    search = search.strip().lower()
+    while search[:2] in ("u:", "c:"):
+        prefix = search[:2]
+        search = search.split(":", 1)[1].strip().lower()
+        if search.startswith(prefix):
+            return None
+    if search.startswith("dh:"):
+        return _hash_key
+    if search.startswith("dp:"):
+        return _prompt_key
+    if search.startswith("nd:"):
+        return _near_group_key
+    return None
+
+
+def group_duplicates(images, search):
+    """Для поиска дубликатов собирает отсортированные изображения в группы,
+    группы идут в порядке своего первого изображения"""
+    key = _duplicate_key(search)
+    if key is None:
+        return images
+    first = {}
+    for position, img in enumerate(images):
+        first.setdefault(key(img), position)
+    return sorted(images, key=lambda img: first[key(img)])
+
+
 def filter_images(images, search):
     search = search.strip().lower()
     if not search:
@@ -164,18 +285,25 @@ def filter_images(images, search):
         return [img for img in images if match(img.get("tags", []))]
 
     if search.startswith("dh:"):
-        hash_counts = Counter(img.get("hash", "") for img in images if img.get("hash"))
-        return [img for img in images if img.get("hash") and hash_counts[img.get("hash")] > 1]
+        hash_counts = Counter(_hash_key(img) for img in images)
+        return [img for img in images if _hash_key(img) and hash_counts[_hash_key(img)] > 1]
 
     if search.startswith("dp:"):
-        prompt_counts = Counter(img.get("prompt", "").strip().lower() for img in images if img.get("prompt", "").strip())
-        duplicate_prompts = {prompt for prompt, count in prompt_counts.items() if count > 1}
+        keys = [_prompt_key(img) for img in images]
+        prompt_counts = Counter(keys)
+        return [img for img, key in zip(images, keys) if key and prompt_counts[key] > 1]
+
+    if search.startswith("nd:"):
+        hashed = [img for img in images if img.get("phash") is not None]
+        labels = near_duplicate_groups(
+            np.array([img["phash"] for img in hashed], dtype=np.int64), search_distance(search)
+        ).tolist()
+        group_sizes = Counter(labels)
         result = []
-        for img in images:
-            prompt = img.get("prompt", "").strip().lower()
-            if prompt in duplicate_prompts:
+        for img, label in zip(hashed, labels):
+            if group_sizes[label] > 1:
+                img["near_group"] = label
                 result.append(img)
-        result.sort(key=lambda img: img.get("prompt", "").strip().lower())
         return result
 
     return [img for img in images if search in img.get("prompt", "").lower()]
@@ -0,0 +1,582 @@
+import os
+import json
+import bisect
+import logging
+import threading
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from config import config
+from phash import near_duplicate_groups, search_distance
+
+logger = logging.getLogger(__name__)
+
+# Разделитель промптов в пуле строк: в промпте и поисковом запросе его не бывает
+_POOL_SEPARATOR = "\x00"
+
+# Ключи сортировки по строкам: ранги пересчитываются только после изменения колонки
+_STRING_SORT_KEYS = ("filename", "prompt", "tags", "hash")
+
+# Сколько раз query выполняет работу вне блокировки (кластеризация nd:, чтение mtime),
+# прежде чем сделать ее под блокировкой
+_UNLOCKED_ATTEMPTS = 4
+
+
+class _ClustersNeeded(Exception):
+    """Кластеры nd: нужно посчитать заново по снимку (ключ кэша, строки, их хеши)"""
+
+    def __init__(self, key: Tuple[int, int], rows: np.ndarray, phashes: np.ndarray):
+        super().__init__(key)
+        self.key = key
+        self.rows = rows
+        self.phashes = phashes
+
+
+class _MtimesNeeded(Exception):
+    """Для сортировки по дате нужно прочитать mtime файлов (относительные пути)"""
+
+    def __init__(self, paths: List[str]):
+        super().__init__(len(paths))
+        self.paths = paths
+
+
+def _stat_mtimes(paths: List[str]) -> Dict[str, float]:
+    """mtime файлов по относительным путям; 0.0 для недоступных"""
+    mtimes = {}
+    for path in paths:
+        try:
+            mtimes[path] = os.stat(os.path.join(config.IMAGE_FOLDER, path)).st_mtime
+        except OSError:
+            mtimes[path] = 0.0
+    return mtimes
+
+
+class _Interner:
+    """Сопоставляет строкам целые id (0 зарезервирован за пустой строкой)"""
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {"": 0}
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def intern(self, value: str) -> int:
+        value_id = self._ids.get(value)
+        if value_id is None:
+            value_id = self._ids[value] = len(self._ids)
+        return value_id
+
+    def get(self, value: str) -> Optional[int]:
+        return self._ids.get(value)
+
+
+class LibraryIndex:
+    """
+    Колоночный индекс библиотеки в памяти процесса для фильтрации и сортировки.
+    Рейтинг, размер, checked и mtime хранятся массивами NumPy, теги - целыми id
+    с обратным индексом, промпты - одной строкой-пулом со смещениями записей.
+    Фильтр и сортировка выполняются как маска и argsort, наружу отдаются только id,
+    словари метаданных строит вызывающий код для нужной страницы.
+    Поддерживается DatabaseManager: save, save_tags и delete обновляют индекс.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self._count = 0
+        self._ids: List[Optional[str]] = []
+        self._row_of: Dict[str, int] = {}
+        self._paths: List[str] = []
+        self._prompts: List[str] = []
+        self._tags: List[Tuple[str, ...]] = []
+        self._hashes: List[str] = []
+
+        self._alive = np.zeros(0, dtype=bool)
+        self._checked = np.zeros(0, dtype=bool)
+        self._rating = np.zeros(0, dtype=np.int32)
+        self._size = np.zeros(0, dtype=np.int64)
+        self._mtime = np.zeros(0, dtype=np.float64)
+        self._folder = np.zeros(0, dtype=np.int32)
+        # Группы дубликатов: id группы - интернированный хеш / нормализованный промпт,
+        # размер группы по живым записям ведется инкрементально
+        self._hash_group = np.zeros(0, dtype=np.int32)
+        self._prompt_group = np.zeros(0, dtype=np.int32)
+        self._hash_group_size = np.zeros(1024, dtype=np.int64)
+        self._prompt_group_size = np.zeros(1024, dtype=np.int64)
+        self._tag_count = np.zeros(0, dtype=np.int32)
+        # Перцептивный хеш (см. phash.py); кластеры nd: по всей библиотеке кэшируются до изменения хешей
+        self._phash = np.zeros(0, dtype=np.int64)
+        self._has_phash = np.zeros(0, dtype=bool)
+        self._phash_version = 0
+        self._near_cache: Optional[Tuple[Tuple[int, int], np.ndarray, np.ndarray]] = None
+        self._row_slot = np.zeros(0, dtype=np.int64)
+
+        self._folders = _Interner()
+        self._hash_groups = _Interner()
+        self._prompt_groups = _Interner()
+        self._tag_ids = _Interner()
+        self._tag_rows: Dict[int, set] = {}
+
+        # Пул промптов в нижнем регистре: слот - одна версия промпта записи
+        self._pool = ""
+        self._pool_parts: List[str] = []
+        self._pool_length = 0
+        self._pool_dead = 0
+        self._slot_offsets: List[int] = []
+        self._slot_rows: List[int] = []
+
+        self._ranks: Dict[str, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self._row_of)
+
+    def _grow(self, needed: int) -> None:
+        capacity = len(self._alive)
+        if needed <= capacity:
+            return
+        capacity = max(needed, capacity * 2, 1024)
+        for name in ("_alive", "_checked", "_rating", "_size", "_mtime", "_folder",
+                     "_hash_group", "_prompt_group", "_tag_count", "_phash", "_has_phash", "_row_slot"):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _append_prompt(self, row: int, prompt: str) -> None:
+        text = prompt.lower()
+        self._row_slot[row] = len(self._slot_offsets)
+        self._slot_offsets.append(self._pool_length)
+        self._slot_rows.append(row)
+        self._pool_parts.append(text + _POOL_SEPARATOR)
+        self._pool_length += len(text) + 1
+
+    def _drop_prompt(self, row: int) -> None:
+        slot = int(self._row_slot[row])
+        if slot < 0:
+            return
+        end = self._slot_offsets[slot + 1] if slot + 1 < len(self._slot_offsets) else self._pool_length
+        self._pool_dead += end - self._slot_offsets[slot]
+        self._row_slot[row] = -1
+
+    def _set_tags(self, row: int, tags: List[str]) -> None:
+        if self._tags[row]:
+            for tag_id in {self._tag_ids.get(tag.strip().lower()) for tag in self._tags[row]}:
+                rows = self._tag_rows.get(tag_id)
+                if rows is not None:
+                    rows.discard(row)
+        tag_rows, intern = self._tag_rows, self._tag_ids.intern
+        for tag in {tag.strip().lower() for tag in tags}:
+            tag_id = intern(tag)
+            rows = tag_rows.get(tag_id)
+            if rows is None:
+                rows = tag_rows[tag_id] = set()
+            rows.add(row)
+        self._tags[row] = tuple(tags)
+        self._tag_count[row] = len(tags)
+
+    @staticmethod
+    def _move_to_group(groups: np.ndarray, sizes: np.ndarray, row: int, group: int, is_new: bool) -> np.ndarray:
+        """Переносит запись в группу group, обновляя размеры групп. Возвращает (возможно, расширенный) sizes"""
+        if group >= len(sizes):
+            grown = np.zeros(max(group + 1, len(sizes) * 2), dtype=sizes.dtype)
+            grown[:len(sizes)] = sizes
+            sizes = grown
+        if not is_new:
+            sizes[groups[row]] -= 1
+        groups[row] = group
+        sizes[group] += 1
+        return sizes
+
+    def _upsert_one(self, metadata: Dict[str, Any]) -> None:
+        metadata_id = metadata["id"]
+        image_path = str(metadata.get("image_path", "") or "").replace("\\", "/")
+        prompt = metadata.get("prompt", "") or ""
+        tags = metadata.get("tags", [])
+        if not isinstance(tags, list):
+            tags = []
+        file_hash = metadata.get("hash", "") or ""
+
+        row = self._row_of.get(metadata_id)
+        is_new = row is None
+        if is_new:
+            row = self._count
+            self._grow(row + 1)
+            self._count += 1
+            self._row_of[metadata_id] = row
+            self._ids.append(metadata_id)
+            self._paths.append(image_path)
+            self._prompts.append(prompt)
+            self._tags.append(())
+            self._hashes.append(file_hash)
+            self._append_prompt(row, prompt)
+            self._mtime[row] = np.nan
+            self._ranks.clear()
+            self._phash_version += 1
+        else:
+            if self._paths[row] != image_path:
+                self._paths[row] = image_path
+                self._mtime[row] = np.nan
+                self._ranks.pop("filename", None)
+            if self._prompts[row] != prompt:
+                self._prompts[row] = prompt
+                self._drop_prompt(row)
+                self._append_prompt(row, prompt)
+                self._ranks.pop("prompt", None)
+            if self._hashes[row] != file_hash:
+                self._hashes[row] = file_hash
+                self._ranks.pop("hash", None)
+                # Содержимое файла сменилось - mtime тоже
+                self._mtime[row] = np.nan
+
+        if list(self._tags[row]) != tags:
+            self._set_tags(row, tags)
+            self._ranks.pop("tags", None)
+
+        self._set_phash(row, metadata.get("phash"))
+        self._alive[row] = True
+        self._checked[row] = bool(metadata.get("checked", False))
+        self._rating[row] = int(metadata.get("rating", 0) or 0)
+        self._size[row] = int(metadata.get("size", 0) or 0)
+        self._folder[row] = self._folders.intern(image_path.rpartition("/")[0])
+        self._hash_group_size = self._move_to_group(
+            self._hash_group, self._hash_group_size, row, self._hash_groups.intern(file_hash), is_new)
+        self._prompt_group_size = self._move_to_group(
+            self._prompt_group, self._prompt_group_size, row, self._prompt_groups.intern(prompt.strip().lower()), is_new)
+
+    def upsert(self, metadata_list: Iterable[Dict[str, Any]]) -> None:
+        """Добавляет или обновляет записи по полным словарям метаданных"""
+        with self._lock:
+            for metadata in metadata_list:
+                self._upsert_one(metadata)
+
+    def _set_phash(self, row: int, phash: Optional[int]) -> None:
+        has_phash = phash is not None
+        if has_phash != self._has_phash[row] or (has_phash and phash != self._phash[row]):
+            self._has_phash[row] = has_phash
+            self._phash[row] = phash if has_phash else 0
+            self._phash_version += 1
+
+    def set_phashes(self, phashes: Dict[str, int]) -> None:
+        """Обновляет только перцептивные хеши записей"""
+        with self._lock:
+            for metadata_id, phash in phashes.items():
+                row = self._row_of.get(metadata_id)
+                if row is not None:
+                    self._set_phash(row, phash)
+
+    def set_tags(self, tags_by_id: Dict[str, List[str]]) -> None:
+        """Обновляет только теги записей"""
+        with self._lock:
+            for metadata_id, tags in tags_by_id.items():
+                row = self._row_of.get(metadata_id)
+                if row is not None and list(self._tags[row]) != tags:
+                    self._set_tags(row, tags)
+                    self._ranks.pop("tags", None)
+
+    def update_columns(self, metadata_ids: Iterable[str], values: Dict[str, Any]) -> None:
+        """Записывает одинаковые значения checked, rating и/или tags указанным записям"""
+        with self._lock:
+            rows = np.array([self._row_of[i] for i in metadata_ids if i in self._row_of], dtype=np.int64)
+            if "checked" in values:
+                self._checked[rows] = bool(values["checked"])
+            if "rating" in values:
+                self._rating[rows] = int(values["rating"] or 0)
+            if "tags" in values:
+                tags = values["tags"] if isinstance(values["tags"], list) else []
+                for row in rows.tolist():
+                    if list(self._tags[row]) != tags:
+                        self._set_tags(row, tags)
+                        self._ranks.pop("tags", None)
+
+    def remove(self, metadata_ids: Iterable[str]) -> None:
+        """Удаляет записи. Строки помечаются удаленными и освобождаются при сжатии"""
+        with self._lock:
+            for metadata_id in metadata_ids:
+                row = self._row_of.pop(metadata_id, None)
+                if row is None:
+                    continue
+                self._set_tags(row, [])
+                self._drop_prompt(row)
+                self._hash_group_size[self._hash_group[row]] -= 1
+                self._prompt_group_size[self._prompt_group[row]] -= 1
+                self._alive[row] = False
+                self._has_phash[row] = False
+                self._ids[row] = None
+                self._phash_version += 1
+            if self._count > 1024 and len(self._row_of) < self._count // 2:
+                self._compact()
+
+    def set_mtimes(self, mtimes: Dict[str, float]) -> None:
+        """Заполняет mtime по относительным путям (например, из paths.scan_images)"""
+        with self._lock:
+            for row in range(self._count):
+                if self._alive[row]:
+                    mtime = mtimes.get(self._paths[row])
+                    if mtime is not None:
+                        self._mtime[row] = mtime
+
+    def _compact(self) -> None:
+        """Перестраивает индекс только из живых строк"""
+        live = [
+            {"id": self._ids[row], "image_path": self._paths[row], "prompt": self._prompts[row],
+             "tags": list(self._tags[row]), "hash": self._hashes[row], "checked": self._checked[row],
+             "rating": self._rating[row], "size": self._size[row],
+             "phash": int(self._phash[row]) if self._has_phash[row] else None}
+            for row in range(self._count) if self._alive[row]
+        ]
+        mtimes = [self._mtime[row] for row in range(self._count) if self._alive[row]]
+        self._reset()
+        self.upsert(live)
+        self._mtime[:len(mtimes)] = mtimes
+
+    def _materialize_pool(self) -> None:
+        if self._pool_dead > 65536 and self._pool_dead > self._pool_length // 2:
+            self._pool_parts = []
+            self._pool = ""
+            self._pool_length = 0
+            self._pool_dead = 0
+            self._slot_offsets = []
+            self._slot_rows = []
+            for row in range(self._count):
+                if self._alive[row]:
+                    self._append_prompt(row, self._prompts[row])
+        if self._pool_parts:
+            self._pool += "".join(self._pool_parts)
+            self._pool_parts = []
+
+    def _prompt_contains(self, text: str) -> np.ndarray:
+        """Маска записей, в промпте которых (без учета регистра) есть text"""
+        n = self._count
+        mask = np.zeros(n, dtype=bool)
+        if _POOL_SEPARATOR in text:
+            return mask
+
+        self._materialize_pool()
+        pool, offsets, slot_rows = self._pool, self._slot_offsets, self._slot_rows
+        found = []
+        position = pool.find(text)
+        while position >= 0:
+            slot = bisect.bisect_right(offsets, position) - 1
+            found.append(slot)
+            # Остальные вхождения в той же записи не нужны - переход к следующему слоту
+            next_start = offsets[slot + 1] if slot + 1 < len(offsets) else len(pool)
+            position = pool.find(text, next_start)
+
+        if found:
+            slots = np.asarray(found, dtype=np.int64)
+            rows = np.asarray(slot_rows, dtype=np.int64)[slots]
+            current = self._row_slot[rows] == slots
+            mask[rows[current]] = True
+        return mask
+
+    def _tags_match(self, raw: str) -> np.ndarray:
+        """Маска для t:: все группы через запятую, внутри группы - любой тег через |"""
+        n = self._count
+        groups = [
+            [t.strip().lower() for t in part.split("|") if t]
+            for part in raw.split(",") if part
+        ]
+        mask = np.ones(n, dtype=bool)
+        for group in groups:
+            group_mask = np.zeros(n, dtype=bool)
+            for tag in group:
+                tag_id = self._tag_ids.get(tag)
+                rows = self._tag_rows.get(tag_id) if tag_id is not None else None
+                if rows:
+                    group_mask[np.fromiter(rows, dtype=np.int64, count=len(rows))] = True
+            mask &= group_mask
+        return mask
+
+    def _duplicates(self, mask: np.ndarray, groups: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+        """Записи из mask с непустым ключом, который встречается в mask больше одного раза.
+        Для всей библиотеки (g: без других условий) используются готовые размеры групп"""
+        groups = groups[:self._count]
+        if np.array_equal(mask, self._alive[:self._count]):
+            return mask & (groups != 0) & (sizes[groups] > 1)
+        counts = np.bincount(groups[mask], minlength=len(sizes))
+        return mask & (groups != 0) & (counts[groups] > 1)
+
+    def _near_duplicates(self, mask: np.ndarray, distance: int,
+                         clusters: Optional[Tuple] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Записи из mask с перцептивным хешем на расстоянии не больше distance от другой записи из mask.
+        Возвращает маску и метки кластеров; кластеры всей библиотеки кэшируются.
+        clusters - (ключ, строки, метки), посчитанные вне блокировки; если они не подходят к текущему
+        состоянию, бросается _ClustersNeeded со снимком хешей. None - кластеризация под блокировкой"""
+        n = self._count
+        full = np.array_equal(mask, self._alive[:n])
+        key = (distance, self._phash_version)
+        if full and self._near_cache is not None and self._near_cache[0] == key:
+            return self._near_cache[1], self._near_cache[2]
+
+        rows = np.flatnonzero(mask & self._has_phash[:n])
+        if clusters is None:
+            labels = near_duplicate_groups(self._phash[rows], distance)
+        elif clusters[0] == key and np.array_equal(clusters[1], rows):
+            labels = clusters[2]
+        else:
+            raise _ClustersNeeded(key, rows, self._phash[rows].copy())
+        groups = np.full(n, -1, dtype=np.int64)
+        groups[rows] = labels
+        result = np.zeros(n, dtype=bool)
+        if len(rows):
+            result[rows[np.bincount(labels)[labels] > 1]] = True
+        if full:
+            self._near_cache = (key, result, groups)
+        return result, groups
+
+    def _filter(self, mask: np.ndarray, search: str,
+                clusters: Optional[Tuple] = None) -> Tuple[np.ndarray, Optional[str]]:
+        """Повторяет семантику image.filter_images на маске.
+        Возвращает маску и колонку групп дубликатов для dh:/dp:/nd: (иначе None)"""
+        search = search.strip().lower()
+        if not search:
+            return mask, None
+
+        n = self._count
+        for prefix, checked in (("u:", False), ("c:", True)):
+            if search.startswith(prefix):
+                raw = search.split(":", 1)[1].strip().lower()
+                mask = mask & (self._checked[:n] == checked)
+                if not raw:
+                    return mask, None
+                if raw.startswith(prefix):
+                    return mask & self._prompt_contains(raw), None
+                return self._filter(mask, raw, clusters)
+
+        if search.startswith("t:"):
+            raw = search.split(":", 1)[1].strip().lower()
+            if not raw:
+                return mask & (self._tag_count[:n] == 0), None
+            return mask & self._tags_match(raw), None
+
+        if search.startswith("dh:"):
+            return self._duplicates(mask, self._hash_group, self._hash_group_size), self._hash_group
+
+        if search.startswith("dp:"):
+            return self._duplicates(mask, self._prompt_group, self._prompt_group_size), self._prompt_group
+
+        if search.startswith("nd:"):
+            return self._near_duplicates(mask, search_distance(search), clusters)
+
+        return mask & self._prompt_contains(search), None
+
+    def _string_rank(self, key: str) -> np.ndarray:
+        """Плотный ранг строкового ключа сортировки: равные строки получают равный ранг"""
+        rank = self._ranks.get(key)
+        if rank is not None and len(rank) == self._count:
+            return rank
+        if key == "filename":
+            values = [path.lower() for path in self._paths]
+        elif key == "prompt":
+            values = [prompt.lower() for prompt in self._prompts]
+        elif key == "tags":
+            values = [", ".join(tags).lower() for tags in self._tags]
+        else:
+            values = list(self._hashes)
+        _, rank = np.unique(np.array(values, dtype=object), return_inverse=True)
+        rank = rank.astype(np.int64).reshape(-1)
+        self._ranks[key] = rank
+        return rank
+
+    def _fill_mtimes(self, rows: np.ndarray, deferred: bool) -> None:
+        """Дочитывает mtime записей, для которых он еще неизвестен.
+        При deferred бросает _MtimesNeeded: query прочитает их вне блокировки"""
+        missing = rows[np.isnan(self._mtime[rows])]
+        if not len(missing):
+            return
+        paths = [self._paths[row] for row in missing.tolist()]
+        if deferred:
+            raise _MtimesNeeded(paths)
+        mtimes = _stat_mtimes(paths)
+        self._mtime[missing] = [mtimes[path] for path in paths]
+
+    def _publish_mtimes(self, mtimes: Dict[str, float]) -> None:
+        """Записывает прочитанные вне блокировки mtime записям, у которых он все еще неизвестен"""
+        with self._lock:
+            rows = np.flatnonzero(self._alive[:self._count] & np.isnan(self._mtime[:self._count]))
+            for row in rows.tolist():
+                mtime = mtimes.get(self._paths[row])
+                if mtime is not None:
+                    self._mtime[row] = mtime
+
+    def _sort(self, rows: np.ndarray, sort_by: Optional[str], order: str, deferred: bool = False) -> np.ndarray:
+        """Повторяет семантику image.sort_images (устойчивая сортировка, в т.ч. по убыванию)"""
+        if not sort_by or sort_by == "random" or not len(rows):
+            return rows
+        if sort_by == "date":
+            self._fill_mtimes(rows, deferred)
+            keys = self._mtime[rows]
+        elif sort_by == "rating":
+            keys = self._rating[rows]
+        elif sort_by == "size":
+            keys = self._size[rows]
+        elif sort_by in _STRING_SORT_KEYS:
+            keys = self._string_rank(sort_by)[rows]
+        else:
+            return rows
+        if order == "desc":
+            keys = -keys
+        return rows[np.argsort(keys, kind="stable")]
+
+    def query(self, folder: Optional[str], search: str, sort_by: Optional[str] = None,
+              order: str = "desc", hide_checked: bool = False) -> List[str]:
+        """
+        Возвращает id записей папки folder (относительный путь, "" - корень, None - все),
+        прошедших фильтр search, в порядке сортировки sort_by/order.
+        Кластеризация nd: и чтение неизвестных mtime для сортировки по дате идут вне блокировки;
+        если индекс успел измениться, снимок берется заново, после нескольких неудач - работа под блокировкой
+        """
+        clusters = (None, None, None)
+        for _ in range(_UNLOCKED_ATTEMPTS):
+            try:
+                return self._query(folder, search, sort_by, order, hide_checked, clusters)
+            except _ClustersNeeded as e:
+                clusters = (e.key, e.rows, near_duplicate_groups(e.phashes, e.key[0]))
+            except _MtimesNeeded as e:
+                self._publish_mtimes(_stat_mtimes(e.paths))
+        return self._query(folder, search, sort_by, order, hide_checked, None)
+
+    def _query(self, folder: Optional[str], search: str, sort_by: Optional[str], order: str,
+               hide_checked: bool, clusters: Optional[Tuple]) -> List[str]:
+        """query под блокировкой; clusters=None - без работы вне блокировки"""
+        with self._lock:
+            n = self._count
+            mask = self._alive[:n].copy()
+            if folder is not None:
+                folder_id = self._folders.get(folder)
+                if folder_id is None:
+                    return []
+                mask &= self._folder[:n] == folder_id
+            if hide_checked:
+                mask &= ~self._checked[:n]
+            mask, groups = self._filter(mask, search, clusters)
+            rows = self._sort(np.flatnonzero(mask), sort_by, order, deferred=clusters is not None)
+            if groups is not None and len(rows):
+                # Дубликаты идут группами; группы - в порядке первого элемента после сортировки
+                _, first, inverse = np.unique(groups[rows], return_index=True, return_inverse=True)
+                rows = rows[np.argsort(first[inverse.reshape(-1)], kind="stable")]
+            ids = self._ids
+            return [ids[row] for row in rows.tolist()]
+
+    @classmethod
+    def from_rows(cls, rows) -> "LibraryIndex":
+        """Строит индекс из строк SQLite с колонками id, prompt, checked, rating, tags, size, hash, image_path, phash"""
+        index = cls()
+        index.upsert(
+            {
+                "id": row["id"],
+                "prompt": row["prompt"],
+                "checked": bool(row["checked"]),
+                "rating": row["rating"],
+                "tags": json.loads(row["tags"]) if row["tags"] else [],
+                "size": row["size"],
+                "hash": row["hash"],
+                "image_path": row["image_path"],
+                "phash": row["phash"]
+            }
+            for row in rows
+        )
+        return index
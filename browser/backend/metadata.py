@@ -7,11 +7,11 @@ import hashlib
 import logging
 import uuid
 import atexit
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
 
 from paths import get_relative_path
 from config import config
-from tag import get_tags
+from tag import tag_image
 from database import DatabaseManager
 
 logger = logging.getLogger(__name__)
@@ -93,69 +93,161 @@ class MetadataStore:
         """Получает метаданные для списка ID. Возвращает словарь {id: metadata}"""
         return self._db_manager.get_by_ids(metadata_ids)
 
+    def get_thumbnails(self, metadata_ids: List[str], size: Optional[int] = None,
+                       allow_smaller: bool = True) -> Dict[str, bytes]:
+        """Получает миниатюры подходящего уровня для списка ID. Возвращает словарь {id: данные}"""
+        return self._db_manager.get_thumbnails(metadata_ids, size, allow_smaller)
+
+    def get_thumbnail_versions(self, metadata_ids: List[str], size: Optional[int] = None,
+                               allow_smaller: bool = True) -> Dict[str, tuple]:
+        """Возвращает {id: (уровень, хеш, поколение миниатюры)} без чтения данных миниатюр"""
+        return self._db_manager.get_thumbnail_versions(metadata_ids, size, allow_smaller)
+
+    def get_complete_sizes(self) -> Dict[str, int]:
+        """Возвращает {относительный путь: размер} для изображений с метаданными и миниатюрой."""
+        return self._db_manager.get_complete_sizes()
+
+    def get_ids_without_phash(self) -> List[str]:
+        return self._db_manager.get_ids_without_phash()
+
+    def save_phashes(self, phashes: Dict[str, int]) -> int:
+        return self._db_manager.save_phashes(phashes)
+
+    def get_fields_by_ids(self, metadata_ids: List[str], fields: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Получает отдельные колонки без BLOB миниатюр. Возвращает словарь {id: {поле: значение}}
+        (tags - список, checked - bool, как в остальных методах)"""
+        return self._db_manager.get_fields_by_ids(metadata_ids, fields)
+
+    def get_missing_paths(self, image_paths: List[str], folder: Optional[str] = None,
+                          first_only: bool = False) -> List[str]:
+        """Возвращает пути изображений без метаданных, сравнивая список файлов с путями папки из БД
+        (один запрос). folder - абсолютный путь папки, в которой лежат image_paths (None - все изображения).
+        С first_only останавливается на первом пропуске."""
+        if not image_paths:
+            return []
+        relative_folder = None
+        if folder:
+            relative_folder = get_relative_path(folder).replace("\\", "/").strip("/")
+            if relative_folder == ".":
+                relative_folder = ""
+        known = self._db_manager.get_folder_paths(relative_folder)
+        missing = []
+        for path in image_paths:
+            rel_path = get_relative_path(path)
+            if rel_path not in known:
+                missing.append(path)
+                if first_only:
+                    break
+        return missing
+
+    def get_paths_under(self, relative_prefix: str) -> List[str]:
+        """Возвращает относительные пути изображений внутри папки (рекурсивно), relative_prefix заканчивается на "/" """
+        return self._db_manager.get_paths_under(relative_prefix)
+
+    def get_folder_counts(self) -> Dict[str, int]:
+        """Возвращает {относительная папка: количество изображений} по данным БД"""
+        return self._db_manager.get_folder_counts()
+
+    def get_tag_scores(self, metadata_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Возвращает сохраненные вероятности тегов {id: {"method", "scores", "auto_tags"}}"""
+        return self._db_manager.get_tag_scores(metadata_ids)
+
+    def save_tags(self, results: List[Dict[str, Any]]) -> int:
+        """Обновляет только теги (и вероятности тегов) записей. Принимает [{"id", "tags", "tag_scores"?}, ...]"""
+        return self._db_manager.save_tags(results)
+
     def get_all(self) -> List[Dict[str, Any]]:
         return self._db_manager.get_all()
 
-    def has_metadata(self, image_path: str) -> bool:
-        rel_image_path = get_relative_path(image_path)
-        return self._db_manager.has_metadata(rel_image_path)
+    @staticmethod
+    def _relative_folder(folder_path: Optional[str]) -> Optional[str]:
+        """Относительный путь папки для запросов к БД: None - все папки, "" - корень"""
+        if folder_path is None:
+            return None
+        normalized = get_relative_path(folder_path).replace("\\", "/").strip("/")
+        return "" if normalized == "." else normalized
     
     def get_by_folder(self, folder_path: Optional[str]) -> List[Dict[str, Any]]:
         """Получает метаданные для изображений внутри указанной директории (без рекурсии)."""
-        if folder_path is None:
-            return self._db_manager.get_by_folder(None)
-        
-        relative = get_relative_path(folder_path).replace("\\", "/")
-        normalized = relative.strip("/")
-        
-        if not normalized:
-            return self._db_manager.get_by_folder("")
-        
-        return self._db_manager.get_by_folder(normalized)
+        return self._db_manager.get_by_folder(self._relative_folder(folder_path))
+    
+    def get_folder_ids(self, folder_path: Optional[str]) -> List[str]:
+        """ID изображений внутри указанной директории (без рекурсии), без чтения строк целиком."""
+        return self._db_manager.get_folder_ids(self._relative_folder(folder_path))
+    
+    def query_ids(self, folder_path: Optional[str], search: str, sort_by: Optional[str] = None,
+                  order: str = "desc", hide_checked: bool = False) -> Optional[List[str]]:
+        """ID изображений папки (без рекурсии), прошедших фильтр, в порядке сортировки.
+        Возвращает None, если индекс библиотеки отключен (library_index)"""
+        return self._db_manager.query_ids(self._relative_folder(folder_path), search, sort_by, order, hide_checked)
     
-    def create_metadata(self, image_path: str) -> Dict[str, Any]:
+    def _read_file_fields(self, image_path: str, size: Optional[int] = None) -> Dict[str, Any]:
+        """Поля, зависящие от содержимого файла: промпт, размер и MD5"""
         prompt = ""
-        size = 0
         file_hash = ""
-        rel_image_path = ""
-        tags = []
         
         try:
             prompt = self._extract_prompt_from_image(image_path)
         except Exception as e:
             logger.warning(f"Ошибка извлечения промпта из {image_path}: {e}")
         
-        try:
-            size = os.path.getsize(image_path)
-        except (OSError, IOError) as e:
-            logger.warning(f"Ошибка получения размера файла {image_path}: {e}")
+        if size is None:
+            try:
+                size = os.path.getsize(image_path)
+            except (OSError, IOError) as e:
+                size = 0
+                logger.warning(f"Ошибка получения размера файла {image_path}: {e}")
         
         try:
             file_hash = self._calculate_file_hash(image_path)
         except Exception as e:
             logger.warning(f"Ошибка вычисления хеша для {image_path}: {e}")
         
+        return {"prompt": prompt or "", "size": int(size) if size else 0, "hash": file_hash or ""}
+    
+    def create_metadata(self, image_path: str, size: Optional[int] = None) -> Dict[str, Any]:
+        """Создает метаданные нового изображения. size можно передать из обхода (DirEntry.stat), чтобы не делать stat повторно"""
+        file_fields = self._read_file_fields(image_path, size)
+        rel_image_path = ""
+        tags = []
+        tag_scores = None
+        
         try:
             rel_image_path = get_relative_path(image_path)
         except Exception as e:
             logger.warning(f"Ошибка получения относительного пути для {image_path}: {e}")
         
         try:
-            tags = get_tags(image_path, enabled=config.AUTO_TAG_ENABLED)
+            if config.AUTO_TAG_ENABLED:
+                result = tag_image(image_path)
+                tags = result.tags
+                tag_scores = {"method": config.AUTO_TAG_METHOD, "scores": result.scores, "auto_tags": tags}
         except Exception as e:
             logger.warning(f"Ошибка генерации тегов для {image_path}: {e}")
         
         return {
-            "prompt": prompt or "",
+            "prompt": file_fields["prompt"],
             "checked": False,
             "rating": 0,
             "tags": tags if isinstance(tags, list) else [],
-            "size": int(size) if size else 0,
-            "hash": file_hash or "",
+            "size": file_fields["size"],
+            "hash": file_fields["hash"],
             "image_path": rel_image_path or "",
+            "tag_scores": tag_scores,
             "id": str(uuid.uuid4())
         }
     
+    def refresh_metadata(self, metadata: Dict[str, Any], image_path: str, size: Optional[int] = None) -> Dict[str, Any]:
+        """Метаданные изменившегося файла: промпт, размер и хеш читаются заново, миниатюры сбрасываются
+        для пересоздания, а ID, отметка, оценка и теги сохраняются. Возвращает копию без сохранения в БД"""
+        return {
+            **metadata,
+            **self._read_file_fields(image_path, size),
+            "thumbnail_data": None,
+            "thumbnail_tiers": {},
+            "phash": None
+        }
+    
     def save(self, metadata_list: List[Dict[str, Any]]) -> None:
         """Сохраняет метаданные. Принимает список метаданных для сохранения."""
         if not metadata_list:
@@ -168,34 +260,49 @@ class MetadataStore:
             self._db_manager.save(metadata_list)
             logger.info(f"Завершено batch сохранение {len(metadata_list)} метаданных")
     
-    def update(self, updates: List[Dict[str, Any]]) -> int:
-        """Обновляет метаданные. Принимает список обновлений вида [{"id": "...", "checked": True, ...}, ...]"""
-        if not updates:
-            return 0
-        
-        metadata_ids = [update.get("id") for update in updates if update.get("id")]
-        if not metadata_ids:
-            return 0
-        
-        logger.info(f"Начало batch обновления {len(updates)} метаданных")
-        current_metadata = self.get_by_ids(metadata_ids)
-        
-        updated_metadata = []
-        allowed_keys = {"checked", "rating", "tags"}
-        for update in updates:
-            metadata_id = update.get("id")
-            if not metadata_id or metadata_id not in current_metadata:
-                continue
-            metadata = current_metadata[metadata_id].copy()
-            for key, value in update.items():
-                if key != "id" and key in allowed_keys:
-                    metadata[key] = value
-            updated_metadata.append(metadata)
-        
-        if updated_metadata:
-            self.save(updated_metadata)
-        logger.info(f"Завершено batch обновление {len(updated_metadata)} метаданных")
-        return len(updated_metadata)
+    def save_new(self, metadata_list: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Сохраняет только метаданные изображений, которых еще нет в БД. Возвращает сохраненные"""
+        return self._db_manager.save_new(metadata_list)
+    
+    def save_thumbnail(self, metadata: Dict[str, Any]) -> bool:
+        """Сохраняет миниатюры из метаданных (thumbnail_data и thumbnail_tiers), не трогая остальные поля."""
+        return self._db_manager.save_thumbnail(
+            metadata["id"], metadata["thumbnail_data"], metadata.get("thumbnail_tiers"),
+            metadata.get("thumbnail_generation", 0), metadata.get("phash")
+        )
+    
+    def save_large_tier(self, metadata_id: str, size: int, data: bytes, generation: int) -> bool:
+        """Сохраняет уровень миниатюры крупнее основной (только на диск)"""
+        return self._db_manager.save_large_tier(metadata_id, size, data, generation)
+    
+    def get_ids_missing_tiers(self, sizes: List[int]) -> List[str]:
+        return self._db_manager.get_ids_missing_tiers(sizes)
+    
+    def save_tiers(self, tiers: Dict[str, Dict[int, bytes]]) -> int:
+        """Добавляет недостающие уровни миниатюр {id: {размер: данные}}"""
+        return self._db_manager.save_tiers(tiers)
+    
+    def update_columns(self, metadata_ids: List[str], values: Dict[str, Any]) -> int:
+        """Записывает одинаковые значения checked, rating и/или tags всем указанным записям
+        частичным UPDATE, без чтения строк целиком. Возвращает количество измененных записей"""
+        return len(self._db_manager.update_columns(metadata_ids, values))
+    
+    def create_selection(self, metadata_ids: List[str]) -> Tuple[str, int]:
+        """Материализует набор ID на сервере. Возвращает токен выборки и количество записей"""
+        return self._db_manager.create_selection(metadata_ids)
+    
+    def release_selection(self, token: str) -> bool:
+        return self._db_manager.release_selection(token)
+    
+    def get_selection_fields(self, token: str, fields: List[str],
+                             checked_only: bool = False) -> Optional[Dict[str, Dict[str, Any]]]:
+        """Колонки без BLOB миниатюр для записей выборки. None, если выборки нет"""
+        return self._db_manager.get_selection_fields(token, fields, checked_only)
+    
+    def update_selection(self, token: str, values: Dict[str, Any]) -> Optional[int]:
+        """update_columns для всех записей выборки. None, если выборки нет"""
+        changed = self._db_manager.update_selection(token, values)
+        return None if changed is None else len(changed)
     
     def delete(self, metadata_ids: List[str]) -> int:
         """Удаляет метаданные. Принимает список ID для удаления."""
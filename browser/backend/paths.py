@@ -1,26 +1,16 @@
 import os
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path as PathLib
-from typing import Dict, Any, Iterator, Optional, List
+from functools import lru_cache
+from typing import Dict, Any, Iterator, Optional, List, Callable, Tuple, NamedTuple
 
 from config import config
 
 logger = logging.getLogger(__name__)
 
 
-def count_images_in_dir(dir_path: str) -> int:
-    """Подсчитывает количество изображений в директории."""
-    try:
-        count = sum(
-            1 for entry in os.scandir(dir_path)
-            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in config.ALLOWED_EXTENSIONS
-        )
-        return count
-    except OSError as e:
-        logger.warning(f"Ошибка подсчета изображений в {dir_path}: {e}")
-        return 0
-
-
 def get_absolute_path(relative_path: str, root_folder: Optional[str] = None) -> str:
     if root_folder is None:
         root_folder = config.IMAGE_FOLDER
@@ -50,67 +40,176 @@ def get_image_paths(folder: Optional[str] = None) -> List[str]:
     return list(walk_images())
 
 
+@lru_cache(maxsize=16)
+def _root_prefixes(root_folder: str) -> Tuple[str, str]:
+    """Нормализованный и разрешенный (realpath) корень с разделителем на конце. Вычисляется один раз на корень"""
+    root = os.path.normpath(os.path.abspath(root_folder))
+    resolved = str(PathLib(root).resolve())
+    return os.path.join(root, ""), os.path.join(resolved, "")
+
+
+def _strip_prefix(path: str, prefix: str) -> Optional[str]:
+    if path.startswith(prefix):
+        return path[len(prefix):].replace("\\", "/")
+    if path == prefix[:-1]:
+        return "."
+    return None
+
+
 def get_relative_path(absolute_path: str, root_folder: Optional[str] = None) -> str:
+    """Относительный путь от корня с "/" в качестве разделителя.
+
+    Пути от наших обходчиков (os.path.join от корня) обрабатываются срезом строки без обращений
+    к файловой системе; resolve() вызывается только для путей вне корня (например, через симлинки).
+    """
     if root_folder is None:
         root_folder = config.IMAGE_FOLDER
 
     if not absolute_path:
         return ""
-    
+
+    root_prefix, resolved_prefix = _root_prefixes(root_folder)
+    rel_path = _strip_prefix(absolute_path, root_prefix)
+    if rel_path is not None and ".." not in rel_path.split("/"):
+        return rel_path
+
     abs_path = os.path.normpath(os.path.abspath(absolute_path))
-    root = os.path.normpath(os.path.abspath(root_folder))
-    
+    for prefix in (root_prefix, resolved_prefix):
+        rel_path = _strip_prefix(abs_path, prefix)
+        if rel_path is not None:
+            return rel_path
+
     try:
-        abs_path_lib = PathLib(abs_path).resolve()
-        root_lib = PathLib(root).resolve()
-        rel_path = abs_path_lib.relative_to(root_lib)
+        rel_path = PathLib(abs_path).resolve().relative_to(resolved_prefix)
         return str(rel_path).replace("\\", "/")
     except (ValueError, TypeError):
-        try:
-            if abs_path.startswith(root):
-                rel_path = abs_path[len(root):].lstrip(os.sep)
-                return rel_path.replace("\\", "/")
-        except:
-            pass
         return absolute_path.replace(root_folder, "").lstrip(os.sep).replace("\\", "/")
 
 
-def walk_images(root_folder: Optional[str] = None) -> Iterator[str]:
+def _skip_dir(name: str) -> bool:
+    return name.startswith(".") or name.startswith(config.METADATA_FOLDER)
+
+
+class ImageRecord(NamedTuple):
+    """Изображение, найденное scan_images, со статистикой из DirEntry.stat()"""
+    path: str
+    rel_path: str
+    size: int
+    mtime_ns: int
+    inode: int
+
+
+def _scan_records(base_path: str, relative: str) -> Iterator[ImageRecord]:
+    """Обходит поддерево через scandir, переиспользуя stat из DirEntry. Как и os.walk, не заходит в симлинки на папки"""
+    stack = [relative]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(os.path.join(base_path, current) if current else base_path) as entries:
+                for entry in entries:
+                    rel_path = f"{current}/{entry.name}" if current else entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        if not _skip_dir(entry.name):
+                            stack.append(rel_path)
+                    elif os.path.splitext(entry.name)[1].lower() in config.ALLOWED_EXTENSIONS:
+                        try:
+                            stat = entry.stat()
+                        except OSError as e:
+                            logger.warning(f"Ошибка чтения {entry.path}: {e}")
+                            continue
+                        yield ImageRecord(entry.path, rel_path, stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        except OSError as e:
+            logger.warning(f"Ошибка чтения директории {current}: {e}")
+
+
+def scan_images(root_folder: Optional[str] = None, max_workers: int = 1) -> Iterator[ImageRecord]:
+    """Находит изображения за один проход, вместе с размером, mtime_ns и inode.
+    При max_workers > 1 поддеревья верхнего уровня обходятся параллельно."""
     if root_folder is None:
         root_folder = config.IMAGE_FOLDER
 
+    if max_workers <= 1:
+        yield from _scan_records(root_folder, "")
+        return
+
+    top_level = []
     try:
-        for root, dirs, files in os.walk(root_folder):
-            dirs[:] = [d for d in dirs if not d.startswith(config.METADATA_FOLDER)]
-            for file in files:
-                if os.path.splitext(file)[1].lower() in config.ALLOWED_EXTENSIONS:
-                    yield os.path.join(root, file)
+        with os.scandir(root_folder) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not _skip_dir(entry.name):
+                        top_level.append(entry.name)
+                elif os.path.splitext(entry.name)[1].lower() in config.ALLOWED_EXTENSIONS:
+                    stat = entry.stat()
+                    yield ImageRecord(entry.path, entry.name, stat.st_size, stat.st_mtime_ns, stat.st_ino)
     except OSError as e:
         logger.error(f"Ошибка обхода дерева директорий {root_folder}: {e}")
         raise OSError(f"Не удалось обойти дерево директорий: {e}") from e
 
+    with ThreadPoolExecutor(max_workers=min(max_workers, max(1, len(top_level)))) as pool:
+        for records in pool.map(lambda name: list(_scan_records(root_folder, name)), top_level):
+            yield from records
 
-def build_folder_tree(base_path: str, relative: str = "") -> Dict[str, Any]:
-    tree: Dict[str, Any] = {}
-    full_path = os.path.join(base_path, relative)
 
-    try:
-        for entry in os.scandir(full_path):
-            if not entry.is_dir() or entry.name.startswith("."):
-                continue
-
-            rel_path = os.path.join(relative, entry.name).replace("\\", "/")
-            total_count = count_images_in_dir(entry.path)
-            children = build_folder_tree(base_path, rel_path)
-
-            if total_count > 0 or children:
-                tree[rel_path] = {
-                    "name": entry.name,
-                    "total": total_count,
-                    "children": children
-                }
-    except OSError as e:
-        logger.error(f"Ошибка построения дерева папок для {full_path}: {e}")
-        raise
+def walk_images(root_folder: Optional[str] = None) -> Iterator[str]:
+    """Пути изображений дерева (те же правила пропуска папок, что у scan_images), по мере обхода"""
+    for record in scan_images(root_folder):
+        yield record.path
+
 
+def scan_folder_counts(base_path: str, max_workers: int = 8) -> Dict[str, int]:
+    """Считает изображения в каждой папке дерева: {относительная папка: количество}, по обходу scan_images"""
+    counts: Dict[str, int] = {}
+    for record in scan_images(base_path, max_workers):
+        folder = record.rel_path.rpartition("/")[0]
+        counts[folder] = counts.get(folder, 0) + 1
+    return counts
+
+
+def build_folder_tree(folder_counts: Dict[str, int]) -> Dict[str, Any]:
+    """Строит дерево папок из {относительная папка: количество изображений}.
+    Папка попадает в дерево, если в ней или в ее подпапках есть изображения."""
+    tree: Dict[str, Any] = {}
+    for folder, count in sorted(folder_counts.items()):
+        if not folder or count <= 0:
+            continue
+        parts = folder.split("/")
+        if any(_skip_dir(part) for part in parts):
+            continue
+        level = tree
+        for depth in range(1, len(parts) + 1):
+            rel_path = "/".join(parts[:depth])
+            node = level.get(rel_path)
+            if node is None:
+                node = level[rel_path] = {"name": parts[depth - 1], "total": 0, "children": {}}
+            level = node["children"]
+        node["total"] = count
     return tree
+
+
+class FolderTreeCache:
+    """Кэш дерева папок. Сбрасывается при добавлении и удалении изображений"""
+
+    def __init__(self):
+        self._tree: Optional[Dict[str, Any]] = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, builder: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        with self._lock:
+            if self._tree is not None:
+                return self._tree
+            generation = self._generation
+        tree = builder()
+        with self._lock:
+            if generation == self._generation:
+                self._tree = tree
+        return tree
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._tree = None
+            self._generation += 1
+
+
+folder_tree_cache = FolderTreeCache()
@@ -0,0 +1,135 @@
+from itertools import combinations
+from math import comb
+from typing import Iterator, Tuple
+
+import cv2
+import numpy as np
+
+from config import config
+
+# Поиск по расстоянию Хэмминга - multi-index hashing: 64 бита делятся на m частей.
+# Если хеши отличаются не более чем на r бит, хотя бы одна часть отличается не более чем
+# на r // m бит, поэтому кандидаты - хеши, совпадающие в части после перебора r // m бит.
+# Число частей выбирается по оценке стоимости для заданного r и числа хешей.
+_HASH_BITS = 64
+_CHUNK_COUNTS = range(3, 9)
+
+# Дальше кандидатов становится слишком много для интерактивного поиска
+MAX_DISTANCE = 8
+
+# Сколько пар кандидатов проверяется за раз (ограничивает память на больших группах)
+_PAIR_BUDGET = 1 << 20
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def compute_phash(img) -> int:
+    """pHash изображения BGR (или оттенков серого): DCT яркости 32x32,
+    бит - коэффициент низких частот 8x8 выше медианы.
+    Возвращает 64 бита как число со знаком, чтобы хеш помещался в INTEGER SQLite"""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].reshape(-1)
+    # Постоянная составляющая не входит в медиану: она отражает только общую яркость
+    bits = low > np.median(low[1:])
+    return int(np.packbits(bits).view(">i8")[0])
+
+
+def search_distance(search: str) -> int:
+    """Расстояние из поиска вида nd: или nd:<бит> (по умолчанию config.NEAR_DUPLICATE_DISTANCE)"""
+    raw = search.split(":", 1)[1].strip()
+    distance = int(raw) if raw.isdigit() else config.NEAR_DUPLICATE_DISTANCE
+    return max(0, min(distance, MAX_DISTANCE))
+
+
+def hamming(a: int, b: int) -> int:
+    return bin((a ^ b) & ((1 << 64) - 1)).count("1")
+
+
+def _popcount(values: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return _POPCOUNT[values.view(np.uint8).reshape(-1, 8)].sum(axis=1)
+
+
+def _flip_masks(width: int, radius: int) -> np.ndarray:
+    """Все маски части шириной width бит не более чем с radius единичными битами"""
+    masks = [0]
+    for count in range(1, radius + 1):
+        masks.extend(sum(1 << bit for bit in bits) for bits in combinations(range(width), count))
+    return np.array(masks, dtype=np.uint64)
+
+
+def _plan_chunks(distance: int, count: int) -> int:
+    """Число частей с наименьшей оценкой стоимости: пробы по таблице частей плюс проверка кандидатов"""
+    def cost(chunks: int) -> float:
+        width = -(-_HASH_BITS // chunks)
+        probes = sum(comb(width, k) for k in range(distance // chunks + 1))
+        return chunks * probes * (count + count * count / (1 << width))
+    return min(_CHUNK_COUNTS, key=cost)
+
+
+def _candidate_pairs(values: np.ndarray, distance: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Пары индексов (left < right) уникальных хешей на расстоянии не больше distance"""
+    chunks = _plan_chunks(distance, len(values))
+    width = -(-_HASH_BITS // chunks)
+    for chunk_index in range(chunks):
+        shift = chunk_index * width
+        chunk_width = min(width, _HASH_BITS - shift)
+        chunk = ((values >> np.uint64(shift)) & np.uint64((1 << chunk_width) - 1)).astype(np.int64)
+        # Таблица с прямой адресацией: начало и размер корзины каждого значения части
+        order = np.argsort(chunk, kind="stable")
+        bucket_sizes = np.bincount(chunk, minlength=1 << chunk_width)
+        bucket_starts = np.cumsum(bucket_sizes) - bucket_sizes
+        for flip in _flip_masks(chunk_width, distance // chunks).astype(np.int64):
+            probe = chunk ^ flip
+            counts = bucket_sizes[probe]
+            rows = np.flatnonzero(counts)
+            if not len(rows):
+                continue
+            lo = bucket_starts[probe[rows]]
+            counts = counts[rows]
+            bounds = np.searchsorted(np.cumsum(counts), np.arange(_PAIR_BUDGET, counts.sum(), _PAIR_BUDGET))
+            for block in np.split(np.arange(len(rows)), bounds):
+                block_counts = counts[block]
+                left = np.repeat(rows[block], block_counts)
+                offsets = np.cumsum(block_counts) - block_counts
+                positions = np.arange(len(left)) - np.repeat(offsets - lo[block], block_counts)
+                right = order[positions]
+                keep = left < right
+                left, right = left[keep], right[keep]
+                close = _popcount(values[left] ^ values[right]) <= distance
+                if close.any():
+                    yield left[close], right[close]
+
+
+def _components(count: int, left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """Связные компоненты графа: метка вершины - наименьший индекс в ее компоненте"""
+    labels = np.arange(count)
+    if not len(left):
+        return labels
+    while True:
+        hooked = labels.copy()
+        lowest = np.minimum(labels[left], labels[right])
+        np.minimum.at(hooked, left, lowest)
+        np.minimum.at(hooked, right, lowest)
+        hooked = hooked[hooked]
+        if np.array_equal(hooked, labels):
+            return labels
+        labels = hooked
+
+
+def near_duplicate_groups(hashes: np.ndarray, distance: int) -> np.ndarray:
+    """
+    Кластеризует хеши (int64 или uint64): хеши на расстоянии Хэмминга не больше distance
+    попадают в одну группу (транзитивно). Возвращает метку группы для каждого хеша;
+    одинаковые метки - одна группа, одиночные хеши получают собственную метку
+    """
+    if not len(hashes):
+        return np.zeros(0, dtype=np.int64)
+    distance = max(0, min(int(distance), MAX_DISTANCE))
+    unique, inverse = np.unique(hashes.astype(np.int64, copy=False).view(np.uint64), return_inverse=True)
+    pairs = list(_candidate_pairs(unique, distance)) if distance else []
+    left = np.concatenate([pair[0] for pair in pairs]) if pairs else np.zeros(0, dtype=np.int64)
+    right = np.concatenate([pair[1] for pair in pairs]) if pairs else np.zeros(0, dtype=np.int64)
+    return _components(len(unique), left, right)[inverse.reshape(-1)]
@@ -1,7 +1,7 @@
 import os
 import json
 import time
-import base64
+import struct
 import logging
 import threading
 from functools import wraps
@@ -10,16 +10,23 @@ from urllib.parse import unquote
 from flask import Blueprint, request, jsonify, render_template, send_from_directory, Response
 
 from config import config
-from paths import build_folder_tree, get_absolute_path
-from services import ImageService, MetadataService, FavoritesService, BookmarksService
+from paths import get_absolute_path
+from services import (
+    ImageService, MetadataService, FavoritesService, BookmarksService, TagService, FolderTreeService, SelectionService
+)
 from progress import progress_manager
 from image import collect_images, needs_processing
 from metadata import metadata_store
-from tag import release_model_resources
+from thumbnail import ThumbnailService, thumbnail_mimetype, thumbnail_version, thumbnail_worker
+from tag import task_finished
+from trash import list_trash, batch_folder_of, restore_batch, purge_batch
 
 logger = logging.getLogger(__name__)
 routes = Blueprint("routes", __name__)
 
+THUMBNAIL_WAIT_MAX = 30.0
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
 
 ERROR_HANDLERS = {
     FileNotFoundError: (404, lambda e: str(e)),
@@ -63,6 +70,61 @@ def _get_validated_path_and_search(data):
     return search_folder_path, search
 
 
+def _parse_thumbnail_size(value):
+    if value is None or value == "":
+        return None
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("Неверный размер миниатюры")
+    if size < 1:
+        raise ValueError("Размер миниатюры должен быть положительным")
+    return size
+
+
+def _pack_thumbnail_batch(thumbnails):
+    """Формирует бинарный пакет миниатюр: индекс и список данных в том же порядке.
+    
+    Индекс (big-endian): uint32 количество, затем для каждой миниатюры
+    uint16 длина ID, ID (utf-8), uint8 длина MIME типа, MIME тип (ascii), uint32 длина данных.
+    После индекса идут данные миниатюр подряд.
+    """
+    parts = [struct.pack("!I", len(thumbnails))]
+    blobs = []
+    for metadata_id, thumbnail_data in thumbnails.items():
+        id_bytes = metadata_id.encode("utf-8")
+        mime_bytes = thumbnail_mimetype(thumbnail_data).encode("ascii")
+        parts.append(struct.pack("!H", len(id_bytes)))
+        parts.append(id_bytes)
+        parts.append(struct.pack("!B", len(mime_bytes)))
+        parts.append(mime_bytes)
+        parts.append(struct.pack("!I", len(thumbnail_data)))
+        blobs.append(thumbnail_data)
+    return b"".join(parts), blobs
+
+
+def _conditional_response(etag: str, immutable: bool, build_response):
+    """Отвечает 304 по If-None-Match, не вызывая build_response (и не читая BLOB/файл).
+    
+    immutable - URL адресован по содержимому (?v= совпадает с текущей версией), такой ответ
+    кэшируется браузером навсегда; иначе браузер перепроверяет ответ по ETag.
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = build_response()
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL if immutable else "no-cache"
+    return response
+
+
+def _thumbnail_response(metadata_id: str, size, allow_smaller: bool = True):
+    thumbnail_data = metadata_store.get_thumbnails([metadata_id], size, allow_smaller).get(metadata_id)
+    if not thumbnail_data:
+        raise FileNotFoundError("Миниатюра не найдена в БД")
+    return Response(thumbnail_data, mimetype=thumbnail_mimetype(thumbnail_data))
+
+
 def handle_route_errors(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
@@ -108,7 +170,7 @@ def index(subpath: str = ""):
 
     return render_template(
         "index.html",
-        folder_tree=build_folder_tree(config.IMAGE_FOLDER)
+        folder_tree=FolderTreeService.get_tree()
     )
 
 
@@ -159,13 +221,14 @@ def get_metadata():
 @routes.route("/images/<metadata_id>")
 @handle_route_errors
 def get_image(metadata_id: str):
-    """Отдает оригинальное изображение по ID метаданных"""
-    metadata_dict = metadata_store.get_by_ids([metadata_id])
+    """Отдает оригинальное изображение по ID метаданных (?size=N - превью не меньше N, если есть)"""
+    metadata = metadata_store.get_fields_by_ids(
+        [metadata_id], ["image_path", "hash", "thumbnail_generation"]
+    ).get(metadata_id)
     
-    if metadata_id not in metadata_dict:
+    if not metadata:
         raise FileNotFoundError("Метаданные не найдены")
     
-    metadata = metadata_dict[metadata_id]
     image_path = metadata.get("image_path", "")
     
     if not image_path:
@@ -178,44 +241,90 @@ def get_image(metadata_id: str):
     if not os.path.abspath(path).startswith(os.path.abspath(config.IMAGE_FOLDER)):
         raise PermissionError("Доступ к файлу запрещен")
 
-    return send_from_directory(config.IMAGE_FOLDER, image_path)
+    file_hash = metadata["hash"]
+    requested_version = request.args.get("v")
+    
+    # ?size=N - отдаем уровень миниатюры не меньше N (крупный уровень создается при первом запросе),
+    # если его удалось получить, иначе оригинал. Такой URL адресуется версией миниатюры, без size - хешем файла
+    size = _parse_thumbnail_size(request.args.get("size"))
+    if size is not None:
+        version = thumbnail_version(file_hash, metadata["thumbnail_generation"])
+        ThumbnailService.create_large_tier(metadata_id, size)
+        tier = metadata_store.get_thumbnail_versions([metadata_id], size, allow_smaller=False).get(metadata_id)
+        if tier:
+            return _conditional_response(
+                f"{version}-{tier[0]}",
+                requested_version == version,
+                lambda: _thumbnail_response(metadata_id, size, allow_smaller=False)
+            )
+    else:
+        version = file_hash
+
+    if not file_hash:
+        return send_from_directory(config.IMAGE_FOLDER, image_path)
+
+    # MD5 содержимого файла - строгий валидатор для оригинала
+    return _conditional_response(
+        file_hash,
+        requested_version == version,
+        lambda: send_from_directory(config.IMAGE_FOLDER, image_path, etag=False)
+    )
 
 
 @routes.route("/thumbnails/<metadata_id>")
 @handle_route_errors
 def get_thumbnail(metadata_id: str):
-    """Отдает миниатюру из БД по ID метаданных"""
-    metadata = metadata_store.get_by_ids([metadata_id]).get(metadata_id)
-    
-    if not metadata:
-        raise FileNotFoundError("Метаданные не найдены")
-    
-    thumbnail_data = metadata.get("thumbnail_data")
-    if not thumbnail_data:
+    """Отдает миниатюру из БД по ID метаданных (?size=N - наименьший уровень не меньше N)"""
+    size = _parse_thumbnail_size(request.args.get("size"))
+    ThumbnailService.create_large_tier(metadata_id, size)
+    tier = metadata_store.get_thumbnail_versions([metadata_id], size).get(metadata_id)
+    if not tier:
         raise FileNotFoundError("Миниатюра не найдена в БД")
     
-    return Response(thumbnail_data, mimetype="image/avif")
+    tier_size, file_hash, generation = tier
+    version = thumbnail_version(file_hash, generation)
+    return _conditional_response(
+        f"{version}-{tier_size}",
+        request.args.get("v") == version,
+        lambda: _thumbnail_response(metadata_id, size)
+    )
 
 
 @routes.route("/thumbnails", methods=["POST"])
 @handle_route_errors
 def get_thumbnails_batch():
-    """Отдает миниатюры для списка ID метаданных"""
+    """Отдает миниатюры для списка ID метаданных одним бинарным пакетом (см. _pack_thumbnail_batch)"""
     data = _validate_json_request()
     metadata_ids = data.get("ids", [])
     
     if not metadata_ids or not isinstance(metadata_ids, list):
         raise ValueError("Не указаны ID метаданных")
     
-    metadata_dict = metadata_store.get_by_ids(metadata_ids)
+    size = _parse_thumbnail_size(data.get("size"))
+    try:
+        wait = min(float(data.get("wait") or 0), THUMBNAIL_WAIT_MAX)
+    except (TypeError, ValueError):
+        raise ValueError("Неверное время ожидания миниатюр")
+    
+    ready = metadata_store.get_thumbnails(metadata_ids, size)
+    if not ready and wait > 0:
+        # Long-poll: ни одна миниатюра еще не готова - ждем, пока фоновая генерация создаст хотя бы одну
+        thumbnail_worker.wait_any(metadata_ids, wait)
+        ready = metadata_store.get_thumbnails(metadata_ids, size)
+    
+    header, blobs = _pack_thumbnail_batch(ready)
+    # Сколько из отсутствующих миниатюр еще в очереди: клиент продолжает long-poll, пока их больше нуля
+    pending = thumbnail_worker.pending_count([metadata_id for metadata_id in metadata_ids if metadata_id not in ready])
     
-    thumbnails = {
-        metadata_id: base64.b64encode(metadata["thumbnail_data"]).decode('utf-8')
-        for metadata_id, metadata in metadata_dict.items()
-        if metadata.get("thumbnail_data")
-    }
+    def generate():
+        yield header
+        # BLOB из SQLite пишутся в ответ как есть, без склейки и base64
+        yield from blobs
     
-    return jsonify(thumbnails)
+    response = Response(generate(), mimetype="application/octet-stream")
+    response.headers["Content-Length"] = str(len(header) + sum(len(blob) for blob in blobs))
+    response.headers["X-Thumbnails-Pending"] = str(pending)
+    return response
 
 
 @routes.route("/images/<metadata_id>", methods=["DELETE"])
@@ -278,15 +387,149 @@ def delete_metadata():
     return jsonify({"success": True, "count": count})
 
 
+def _start_file_task(name: str, message: str, run) -> str:
+    """Запускает run(progress_callback) в фоне с прогрессом через progress_manager.
+    run возвращает сообщение о завершении. Возвращает ID задачи"""
+    task_id = progress_manager.create_task()
+
+    def file_task():
+        try:
+            progress_manager.update(task_id, 0, 0, message)
+            def progress_callback(processed, total, message):
+                progress_manager.update(task_id, processed, total, message)
+            progress_manager.complete(task_id, run(progress_callback))
+        except Exception as e:
+            logger.exception(f"Ошибка задачи {name}: {e}")
+            progress_manager.error(task_id, str(e))
+
+    threading.Thread(target=file_task, daemon=True).start()
+    return task_id
+
+
+def _deleted_message(result) -> str:
+    if result["batch"]:
+        return f"Удалено изображений: {result['count']} (корзина: {result['batch']})"
+    return f"Удалено изображений: {result['count']}"
+
+
 @routes.route("/images/checked", methods=["DELETE"])
 @handle_route_errors
 def delete_checked_images():
+    """Перемещает отмеченные изображения в корзину в фоне. Прогресс - /processing/<task_id>/progress"""
+    data = _validate_json_request()
+    search_folder_path, search = _get_validated_path_and_search(data)
+    task_id = _start_file_task(
+        "удаления изображений", "Поиск отмеченных изображений...",
+        lambda progress_callback: _deleted_message(
+            ImageService.delete_checked_images(search_folder_path, search, progress_callback)
+        )
+    )
+    return jsonify({"success": True, "task_id": task_id})
+
+
+@routes.route("/trash", methods=["GET"])
+@handle_route_errors
+def get_trash():
+    return jsonify(list_trash())
+
+
+@routes.route("/trash/<batch_id>/restore", methods=["POST"])
+@handle_route_errors
+def restore_trash(batch_id: str):
+    """Отменяет удаление пакета в фоне. Прогресс - /processing/<task_id>/progress"""
+    batch_folder_of(batch_id)
+    task_id = _start_file_task(
+        "восстановления из корзины", "Восстановление из корзины...",
+        lambda progress_callback: f"Восстановлено изображений: {restore_batch(batch_id, progress_callback)}"
+    )
+    return jsonify({"success": True, "task_id": task_id})
+
+
+@routes.route("/trash/<batch_id>", methods=["DELETE"])
+@handle_route_errors
+def purge_trash(batch_id: str):
+    purge_batch(batch_id)
+    return jsonify({"success": True})
+
+
+def _get_validated_tag_list(data, key: str):
+    tags = data.get(key, [])
+    if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+        raise ValueError(f"{key} должно быть списком строк")
+    return [tag.strip() for tag in tags if tag.strip()]
+
+
+@routes.route("/selections", methods=["POST"])
+@handle_route_errors
+def create_selection():
+    """Создает выборку по списку ids или по папке и поиску (path, search). Возвращает token и count"""
     data = _validate_json_request()
+    metadata_ids = data.get("ids")
+    if metadata_ids is not None:
+        if not isinstance(metadata_ids, list):
+            raise ValueError("ids должно быть списком")
+        return jsonify(SelectionService.create(None, "", [id for id in metadata_ids if id]))
     search_folder_path, search = _get_validated_path_and_search(data)
-    count = ImageService.delete_checked_images(search_folder_path, search)
+    return jsonify(SelectionService.create(search_folder_path, search))
+
+
+@routes.route("/selections/<token>", methods=["GET"])
+@handle_route_errors
+def get_selection(token: str):
+    checked_only = request.args.get("checked_only", "false").lower() == "true"
+    return jsonify({"token": token, "count": SelectionService.count(token, checked_only)})
+
+
+@routes.route("/selections/<token>", methods=["DELETE"])
+@handle_route_errors
+def release_selection(token: str):
+    return jsonify({"success": True, "removed": SelectionService.release(token)})
+
+
+@routes.route("/selections/<token>/metadata", methods=["POST"])
+@handle_route_errors
+def update_selection_metadata(token: str):
+    data = _validate_json_request()
+    updates = {key: data[key] for key in ("checked", "rating", "tags") if key in data}
+    if not updates:
+        raise ValueError("Нет полей метаданных для обновления")
+    count = SelectionService.update_metadata(token, updates)
     return jsonify({"success": True, "count": count})
 
 
+@routes.route("/selections/<token>/tags", methods=["POST"])
+@handle_route_errors
+def update_selection_tags(token: str):
+    data = _validate_json_request()
+    add, remove = _get_validated_tag_list(data, "add"), _get_validated_tag_list(data, "remove")
+    if not add and not remove:
+        raise ValueError("Не указаны теги для добавления или удаления")
+    count = SelectionService.update_tags(token, add, remove)
+    return jsonify({"success": True, "count": count})
+
+
+@routes.route("/selections/<token>/favorites", methods=["POST"])
+@handle_route_errors
+def copy_selection_to_favorites(token: str):
+    count = SelectionService.copy_to_favorites(token)
+    return jsonify({"success": True, "count": count})
+
+
+@routes.route("/selections/<token>/images", methods=["DELETE"])
+@handle_route_errors
+def delete_selection_images(token: str):
+    """Перемещает изображения выборки в корзину в фоне. Прогресс - /processing/<task_id>/progress"""
+    checked_only = request.args.get("checked_only", "false").lower() == "true"
+    SelectionService.count(token)
+    task_id = _start_file_task(
+        "удаления выборки", "Удаление изображений выборки...",
+        lambda progress_callback: _deleted_message(
+            SelectionService.delete_images(token, checked_only, progress_callback)
+        )
+    )
+    return jsonify({"success": True, "task_id": task_id})
+
+
 @routes.route("/prompts/unchecked", methods=["GET"])
 @handle_route_errors
 def get_unchecked_prompts():
@@ -373,14 +616,41 @@ def start_processing():
             logger.exception(f"Ошибка обработки изображений: {e}")
             progress_manager.error(task_id, str(e))
         finally:
-            # Гарантируем освобождение ресурсов модели даже при ошибке
+            # Освобождение модели по политике auto_tag_residency, в том числе при ошибке
             if config.AUTO_TAG_ENABLED:
-                release_model_resources()
+                task_finished()
 
     threading.Thread(target=process_task, daemon=True).start()
     return jsonify({"success": True, "task_id": task_id})
 
 
+@routes.route("/tags/retag", methods=["POST"])
+@handle_route_errors
+def start_retag():
+    data = _validate_json_request()
+    folder_path = _get_validated_folder_path(data.get("path", ""))
+    task_id = progress_manager.create_task()
+
+    def retag_task():
+        try:
+            progress_manager.update(task_id, 0, 0, "Пересчет тегов...")
+            def progress_callback(processed, total, message):
+                progress_manager.update(task_id, processed, total, message)
+            stats = TagService.retag(folder_path, progress_callback=progress_callback)
+            progress_manager.complete(
+                task_id,
+                f"Теги обновлены: {stats['refiltered'] + stats['inferred']}, ошибок: {stats['failed']}"
+            )
+        except Exception as e:
+            logger.exception(f"Ошибка пересчета тегов: {e}")
+            progress_manager.error(task_id, str(e))
+        finally:
+            task_finished()
+
+    threading.Thread(target=retag_task, daemon=True).start()
+    return jsonify({"success": True, "task_id": task_id})
+
+
 @routes.route("/bookmarks", methods=["GET"])
 @handle_route_errors
 def get_bookmarks():
@@ -3,13 +3,16 @@ import uuid
 import shutil
 import random
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Callable, Tuple
 
-from paths import get_absolute_path, get_relative_path
+from paths import get_absolute_path, get_relative_path, build_folder_tree, scan_folder_counts, folder_tree_cache
 from metadata import metadata_store
-from image import filter_images, sort_images
-from thumbnail import ThumbnailService
+from image import filter_images, sort_images, group_duplicates
+from thumbnail import ThumbnailService, thumbnail_worker, thumbnail_version
+from tag import tag_image, refilter_tags, ingest_max_workers
+from trash import move_to_trash
 from config import config
 
 logger = logging.getLogger(__name__)
@@ -23,6 +26,9 @@ def _filter_metadata_for_client(metadata: Dict) -> Dict:
     image_path = metadata.get("image_path", "")
     if image_path:
         filtered["filename"] = os.path.basename(image_path)
+    filtered["thumbnail_ready"] = not ThumbnailService.needs_thumbnail(metadata)
+    if filtered["thumbnail_ready"]:
+        filtered["thumbnail_version"] = thumbnail_version(metadata.get("hash", ""), metadata.get("thumbnail_generation", 0))
     return filtered
 
 
@@ -33,6 +39,36 @@ def _get_filtered_images(folder_path: Optional[str], search: str, hide_checked:
     return filter_images(images, search)
 
 
+def _get_filtered_ids(folder_path: Optional[str], search: str) -> List[str]:
+    """ID изображений, прошедших фильтр: из индекса библиотеки, без него - через _get_filtered_images"""
+    image_ids = metadata_store.query_ids(folder_path, search)
+    if image_ids is not None:
+        return image_ids
+    return [img["id"] for img in _get_filtered_images(folder_path, search) if img.get("id")]
+
+
+def _page_from_ids(image_ids: List[str], sort_by: str, limit: int, offset: int) -> Tuple[List[Dict], List[Dict]]:
+    """Строит словари метаданных только для страницы и следующей за ней (предзагрузка миниатюр)"""
+    if sort_by == "random":
+        page_ids = random.sample(image_ids, min(limit, len(image_ids)))
+        prefetch_ids = []
+    else:
+        page_ids = image_ids[offset:offset + limit]
+        prefetch_ids = image_ids[offset + limit:offset + 2 * limit]
+    found = metadata_store.get_by_ids(page_ids + prefetch_ids)
+    return (
+        [found[metadata_id] for metadata_id in page_ids if metadata_id in found],
+        [found[metadata_id] for metadata_id in prefetch_ids if metadata_id in found]
+    )
+
+
+def _get_selection_or_raise(token: str, fields: List[str], checked_only: bool = False) -> Dict[str, Dict]:
+    fields_by_id = metadata_store.get_selection_fields(token, fields, checked_only)
+    if fields_by_id is None:
+        raise FileNotFoundError(f"Выборка {token} не найдена или устарела")
+    return fields_by_id
+
+
 def _get_metadata_or_raise(metadata_id: str) -> Dict:
     all_metadata = metadata_store.get_by_ids([metadata_id])
     if metadata_id not in all_metadata:
@@ -44,17 +80,28 @@ class ImageService:
     @staticmethod
     def get_images(folder_path: Optional[str], search: str, sort_by: str,
                    order: str, limit: int, offset: int, hide_checked: bool = False) -> List[Dict]:
+        image_ids = metadata_store.query_ids(folder_path, search, sort_by, order, hide_checked)
+        if image_ids is not None:
+            page_images, prefetch_images = _page_from_ids(image_ids, sort_by, limit, offset)
+            thumbnail_worker.enqueue(page_images, thumbnail_worker.VISIBLE_PRIORITY)
+            thumbnail_worker.enqueue(prefetch_images, thumbnail_worker.PREFETCH_PRIORITY)
+            return [_filter_metadata_for_client(img) for img in page_images]
+        
         images = _get_filtered_images(folder_path, search, hide_checked)
         
+        prefetch_images = []
         if sort_by == "random":
             if not images:
                 return []
             page_images = random.sample(images, min(limit, len(images)))
         else:
-            images = sort_images(images, sort_by, order)
+            images = group_duplicates(sort_images(images, sort_by, order), search)
             page_images = images[offset:offset + limit]
+            prefetch_images = images[offset + limit:offset + 2 * limit]
         
-        ThumbnailService.ensure_thumbnails(page_images)
+        # Миниатюры генерируются в фоне: сначала видимая страница, затем следующая
+        thumbnail_worker.enqueue(page_images, thumbnail_worker.VISIBLE_PRIORITY)
+        thumbnail_worker.enqueue(prefetch_images, thumbnail_worker.PREFETCH_PRIORITY)
         return [_filter_metadata_for_client(img) for img in page_images]
 
     @staticmethod
@@ -62,51 +109,41 @@ class ImageService:
         metadata = _get_metadata_or_raise(metadata_id)
         os.remove(get_absolute_path(metadata["image_path"]))
         metadata_store.delete([metadata_id])
+        folder_tree_cache.invalidate()
 
     @staticmethod
-    def delete_checked_images(folder_path: Optional[str], search: str) -> int:
-        images = _get_filtered_images(folder_path, search)
-        metadata_ids = [
-            img.get("id") for img in images 
-            if img.get("id") and img.get("checked")
-        ]
-        if not metadata_ids:
-            return 0
-        
-        all_metadata = metadata_store.get_by_ids(metadata_ids)
-        ids_to_delete_metadata = []
-        for metadata_id, metadata in all_metadata.items():
-            try:
-                image_path = get_absolute_path(metadata.get("image_path", ""))
-                
-                if os.path.exists(image_path):
-                    try:
-                        os.remove(image_path)
-                    except OSError as e:
-                        logger.warning(f"Ошибка удаления файла изображения {image_path}: {e}")
-                        continue
-                
-                ids_to_delete_metadata.append(metadata_id)
-            except Exception as e:
-                logger.warning(f"Ошибка обработки изображения {metadata.get('image_path', 'unknown')}: {e}")
-        
-        if ids_to_delete_metadata:
-            metadata_store.delete(ids_to_delete_metadata)
-        
-        return len(ids_to_delete_metadata)
+    def delete_checked_images(folder_path: Optional[str], search: str,
+                              progress_callback: Optional[Callable[[int, int, str], None]] = None) -> Dict:
+        """Перемещает отмеченные изображения в корзину. Возвращает {"batch", "count"} (см. trash.move_to_trash)"""
+        metadata_ids = _get_filtered_ids(folder_path, search)
+        fields = metadata_store.get_fields_by_ids(metadata_ids, ["image_path", "checked"])
+        return move_to_trash(
+            {metadata_id: values["image_path"] for metadata_id, values in fields.items() if values["checked"]},
+            progress_callback
+        )
 
     @staticmethod
     def get_unchecked_prompts(folder_path: Optional[str], search: str, sort_by: str = "date", order: str = "desc") -> List[str]:
-        images = _get_filtered_images(folder_path, search)
-        unchecked_images = [
-            img for img in images 
-            if not img.get("checked", False)
-        ]
-        if sort_by == "random":
-            if unchecked_images:
-                unchecked_images = random.sample(unchecked_images, len(unchecked_images))
+        image_ids = metadata_store.query_ids(folder_path, search, sort_by, order)
+        if image_ids is not None:
+            fields = metadata_store.get_fields_by_ids(image_ids, ["prompt", "checked"])
+            unchecked_images = [
+                fields[metadata_id] for metadata_id in image_ids
+                if metadata_id in fields and not fields[metadata_id]["checked"]
+            ]
+            if sort_by == "random":
+                random.shuffle(unchecked_images)
         else:
-            unchecked_images = sort_images(unchecked_images, sort_by, order)
+            images = _get_filtered_images(folder_path, search)
+            unchecked_images = [
+                img for img in images 
+                if not img.get("checked", False)
+            ]
+            if sort_by == "random":
+                if unchecked_images:
+                    unchecked_images = random.sample(unchecked_images, len(unchecked_images))
+            else:
+                unchecked_images = group_duplicates(sort_images(unchecked_images, sort_by, order), search)
         unchecked_prompts = []
         seen = set()
         for img in unchecked_images:
@@ -124,40 +161,29 @@ class MetadataService:
         metadata_updates = {key: updates[key] for key in allowed_keys if key in updates}
         if not metadata_updates:
             return
-
-        batch_updates = [{"id": metadata_id, **metadata_updates} for metadata_id in metadata_ids]
-        updated_count = metadata_store.update(batch_updates)
-        if updated_count < len(metadata_ids):
-            logger.warning(f"Обновлено {updated_count} из {len(metadata_ids)} метаданных")
+        metadata_store.update_columns(metadata_ids, metadata_updates)
 
     @staticmethod
     def uncheck_all(folder_path: Optional[str], search: str) -> int:
-        images = _get_filtered_images(folder_path, search)
-        metadata_ids_to_update = [
-            img.get("id") for img in images 
-            if img.get("id") and img.get("checked")
-        ]
-        if not metadata_ids_to_update:
+        metadata_ids = _get_filtered_ids(folder_path, search)
+        if not metadata_ids:
             return 0
-        batch_updates = [{"id": metadata_id, "checked": False} for metadata_id in metadata_ids_to_update]
-        result = metadata_store.update(batch_updates)
-        return result
+        return metadata_store.update_columns(metadata_ids, {"checked": False})
 
     @staticmethod
     def delete_metadata(folder_path: Optional[str], search: str) -> int:
-        images = _get_filtered_images(folder_path, search)
-        metadata_ids = [img.get("id") for img in images if img.get("id")]
+        metadata_ids = _get_filtered_ids(folder_path, search)
         if not metadata_ids:
             return 0
         result = metadata_store.delete(metadata_ids)
+        folder_tree_cache.invalidate()
         return result
 
 
 class FavoritesService:
     @staticmethod
-    def copy_to_favorites(metadata_id: str) -> None:
-        metadata = _get_metadata_or_raise(metadata_id)
-
+    def _copy_file(metadata: Dict) -> Dict:
+        """Копирует изображение в папку избранного. Возвращает метаданные копии (еще не сохраненные)"""
         if not config.FAVORITES_FOLDER:
             raise ValueError("В конфиге не указана папка избранного")
 
@@ -177,8 +203,104 @@ class FavoritesService:
         tags = set(new_metadata.get("tags", []))
         tags.add(config.FAVORITE_TAG)
         new_metadata["tags"] = sorted(tags)
+        return new_metadata
+
+    @staticmethod
+    def copy_to_favorites(metadata_id: str) -> None:
+        metadata = _get_metadata_or_raise(metadata_id)
+        metadata_store.save([FavoritesService._copy_file(metadata)])
+        folder_tree_cache.invalidate()
+
+
+class SelectionService:
+    """Выборки: набор ID материализуется на сервере один раз (по фильтру или списку ID),
+    дальнейшие массовые операции ссылаются на него токеном без повторной фильтрации и передачи ID"""
+    CHUNK_SIZE = 500
+
+    @staticmethod
+    def create(folder_path: Optional[str], search: str, metadata_ids: Optional[List[str]] = None) -> Dict:
+        if metadata_ids is None:
+            metadata_ids = _get_filtered_ids(folder_path, search)
+        token, count = metadata_store.create_selection(metadata_ids)
+        return {"token": token, "count": count}
+
+    @staticmethod
+    def count(token: str, checked_only: bool = False) -> int:
+        return len(_get_selection_or_raise(token, [], checked_only))
+
+    @staticmethod
+    def release(token: str) -> bool:
+        return metadata_store.release_selection(token)
 
-        metadata_store.save([new_metadata])
+    @staticmethod
+    def update_metadata(token: str, updates: Dict) -> int:
+        """Одинаковые checked, rating и/или tags для всех записей выборки, одним UPDATE"""
+        allowed_keys = {"checked", "rating", "tags"}
+        metadata_updates = {key: updates[key] for key in allowed_keys if key in updates}
+        if not metadata_updates:
+            return 0
+        count = metadata_store.update_selection(token, metadata_updates)
+        if count is None:
+            raise FileNotFoundError(f"Выборка {token} не найдена или устарела")
+        return count
+
+    @staticmethod
+    def update_tags(token: str, add: List[str], remove: List[str]) -> int:
+        """Добавляет и удаляет теги у записей выборки, сохраняя остальные теги каждой записи"""
+        removed = set(remove)
+        results = []
+        for metadata_id, fields in _get_selection_or_raise(token, ["tags"]).items():
+            tags = [tag for tag in fields["tags"] if tag not in removed]
+            tags.extend(tag for tag in add if tag not in tags)
+            if tags != fields["tags"]:
+                results.append({"id": metadata_id, "tags": tags})
+        return metadata_store.save_tags(results) if results else 0
+
+    @staticmethod
+    def delete_images(token: str, checked_only: bool = False,
+                      progress_callback: Optional[Callable[[int, int, str], None]] = None) -> Dict:
+        """Перемещает изображения выборки в корзину (checked_only - только отмеченные)"""
+        fields = _get_selection_or_raise(token, ["image_path"], checked_only)
+        return move_to_trash(
+            {metadata_id: values["image_path"] for metadata_id, values in fields.items()}, progress_callback
+        )
+
+    @staticmethod
+    def copy_to_favorites(token: str) -> int:
+        """Копирует изображения выборки в избранное; метаданные копий сохраняются пачками"""
+        if not config.FAVORITES_FOLDER:
+            raise ValueError("В конфиге не указана папка избранного")
+        metadata_ids = list(_get_selection_or_raise(token, []))
+        copied = 0
+        for i in range(0, len(metadata_ids), SelectionService.CHUNK_SIZE):
+            new_metadata = []
+            for metadata in metadata_store.get_by_ids(metadata_ids[i:i + SelectionService.CHUNK_SIZE]).values():
+                try:
+                    new_metadata.append(FavoritesService._copy_file(metadata))
+                except (ValueError, OSError) as e:
+                    logger.warning(f"Не удалось скопировать в избранное {metadata.get('image_path')}: {e}")
+            if new_metadata:
+                metadata_store.save(new_metadata)
+                copied += len(new_metadata)
+        if copied:
+            folder_tree_cache.invalidate()
+        return copied
+
+
+class FolderTreeService:
+    @staticmethod
+    def _build() -> Dict:
+        folder_counts = metadata_store.get_folder_counts()
+        if config.FOLDER_TREE_SCAN:
+            # Папки, которых еще нет в БД, находит параллельный обход файловой системы
+            for folder, count in scan_folder_counts(config.IMAGE_FOLDER, config.FOLDER_TREE_SCAN_WORKERS).items():
+                folder_counts.setdefault(folder, count)
+        return build_folder_tree(folder_counts)
+
+    @staticmethod
+    def get_tree() -> Dict:
+        """Дерево папок с количеством изображений из БД. Кэшируется до добавления или удаления изображений"""
+        return folder_tree_cache.get(FolderTreeService._build)
 
 
 class BookmarksService:
@@ -217,3 +339,88 @@ class BookmarksService:
     @staticmethod
     def has(metadata_id: str) -> bool:
         return metadata_store._db_manager.has_bookmark(metadata_id)
+
+
+def _merge_auto_tags(tags: List[str], previous_auto: List[str], auto_tags: List[str]) -> List[str]:
+    """Заменяет теги, ранее добавленные моделью, новыми, сохраняя теги пользователя"""
+    previous = set(previous_auto)
+    user_tags = [tag for tag in tags if tag not in previous]
+    new = set(auto_tags)
+    return auto_tags + [tag for tag in user_tags if tag not in new]
+
+
+class TagService:
+    RETAG_CHUNK_SIZE = 256
+
+    @staticmethod
+    def retag(folder_path: Optional[str], progress_callback: Optional[Callable[[int, int, str], None]] = None) -> Dict[str, int]:
+        """
+        Пересчитывает автоматические теги изображений папки.
+        Если сохранены вероятности текущей модели, теги отбираются по ним с текущим порогом без запуска модели,
+        иначе (другая модель или записи без вероятностей) модель запускается заново.
+        Теги пользователя сохраняются; у записей без сохраненных вероятностей все текущие теги считаются тегами пользователя.
+        Текущие теги записей читаются непосредственно перед сохранением каждой порции,
+        чтобы не потерять правки, сделанные во время пересчета.
+        """
+        method = config.AUTO_TAG_METHOD
+        image_ids = metadata_store.get_folder_ids(folder_path)
+        total = len(image_ids)
+        stats = {"refiltered": 0, "inferred": 0, "failed": 0}
+
+        for start in range(0, total, TagService.RETAG_CHUNK_SIZE):
+            chunk = image_ids[start:start + TagService.RETAG_CHUNK_SIZE]
+            stored = metadata_store.get_tag_scores(chunk)
+            refilter = [metadata_id for metadata_id in chunk if stored.get(metadata_id, {}).get("method") == method]
+            infer = [metadata_id for metadata_id in chunk if stored.get(metadata_id, {}).get("method") != method]
+            # {id: (теги прошлой генерации, новые теги, вероятности)}
+            auto_results = {}
+
+            if refilter:
+                auto_tags_list = refilter_tags([stored[metadata_id]["scores"] for metadata_id in refilter], method)
+                for metadata_id, auto_tags in zip(refilter, auto_tags_list):
+                    entry = stored[metadata_id]
+                    auto_results[metadata_id] = (entry["auto_tags"], auto_tags, entry["scores"])
+                stats["refiltered"] += len(refilter)
+
+            if infer:
+                paths = metadata_store.get_fields_by_ids(infer, ["image_path"])
+
+                def run(metadata_id):
+                    image_path = paths.get(metadata_id, {}).get("image_path")
+                    if image_path is None:
+                        return None
+                    try:
+                        return tag_image(get_absolute_path(image_path))
+                    except Exception as e:
+                        logger.warning(f"Ошибка генерации тегов для {image_path}: {e}")
+                        return None
+
+                with ThreadPoolExecutor(max_workers=ingest_max_workers(len(infer))) as pool:
+                    tag_results = list(pool.map(run, infer))
+                for metadata_id, result in zip(infer, tag_results):
+                    if result is None:
+                        stats["failed"] += 1
+                        continue
+                    previous_auto = stored.get(metadata_id, {}).get("auto_tags", [])
+                    auto_results[metadata_id] = (previous_auto, result.tags, result.scores)
+                    stats["inferred"] += 1
+
+            current = metadata_store.get_fields_by_ids(list(auto_results), ["tags"])
+            metadata_store.save_tags([
+                {
+                    "id": metadata_id,
+                    "tags": _merge_auto_tags(current[metadata_id]["tags"], previous_auto, auto_tags),
+                    "tag_scores": {"method": method, "scores": scores, "auto_tags": auto_tags}
+                }
+                for metadata_id, (previous_auto, auto_tags, scores) in auto_results.items()
+                if metadata_id in current
+            ])
+            if progress_callback:
+                processed = min(start + len(chunk), total)
+                progress_callback(processed, total, f"Обновлено тегов: {processed} из {total}")
+
+        logger.info(
+            f"Пересчет тегов: {stats['refiltered']} по сохраненным вероятностям, "
+            f"{stats['inferred']} моделью, ошибок {stats['failed']}"
+        )
+        return stats
@@ -1,10 +1,13 @@
 """Модуль для генерации тегов используя WD14 Tagger."""
 
 import os
+import time
+import queue
 import logging
 import threading
 import gc
-from typing import List, Optional
+from concurrent.futures import Future
+from typing import Any, List, NamedTuple, Optional, Tuple
 
 import onnxruntime as ort
 from huggingface_hub import hf_hub_download
@@ -18,219 +21,600 @@ from config import config
 logger = logging.getLogger(__name__)
 
 _tag_generator = None
+_tag_batcher = None
 _wd14_model_cache = None
 _wd14_tags_cache = None
+_wd14_io_cache = None
 _wd14_loading_lock = threading.Lock()
 _wd14_loading = False
+_wd14_last_used = 0.0
+_idle_evictor: Optional[threading.Thread] = None
+_vocabulary_cache = {}
 
+# Политики удержания модели в памяти (auto_tag_residency)
+RESIDENCY_KEEP = "keep"
+RESIDENCY_IDLE = "idle"
+RESIDENCY_RELEASE = "release"
 
-def _make_square(img, target_size):
-    """Делает изображение квадратным, добавляя белые границы"""
-    old_size = img.shape[:2]
-    desired_size = max(old_size)
-    desired_size = max(desired_size, target_size)
-    delta_w = desired_size - old_size[1]
-    delta_h = desired_size - old_size[0]
-    top, bottom = delta_h // 2, delta_h - (delta_h // 2)
-    left, right = delta_w // 2, delta_w - (delta_w // 2)
-    color = [255, 255, 255]
-    return cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)
 
+class ModelIO(NamedTuple):
+    """Имена входа/выхода и размер входа модели, прочитанные один раз при загрузке"""
+    input_name: str
+    input_size: int
+    output_name: str
 
-def _smart_resize(img, size):
-    """Умный ресайз с разными интерполяциями в зависимости от размера"""
-    if img.shape[0] > size:
-        img = cv2.resize(img, (size, size), interpolation=cv2.INTER_AREA)
-    elif img.shape[0] < size:
-        img = cv2.resize(img, (size, size), interpolation=cv2.INTER_CUBIC)
-    return img
+
+class TagVocabulary:
+    """Словарь тегов модели, подготовленный один раз при загрузке.
+    Отбор тегов по порогу и top_k выполняется над массивами NumPy, в том числе сразу для батча."""
+    
+    # Категория 9 - теги рейтинга (general, sensitive, ...), в теги изображения не попадают
+    RATING_CATEGORY = 9
+    
+    def __init__(self, tags_df: pd.DataFrame):
+        self.size = len(tags_df)
+        names = tags_df['name'].to_numpy(dtype=object)
+        self.indices = np.flatnonzero(tags_df['category'].to_numpy() != self.RATING_CATEGORY)
+        self.names = names[self.indices]
+        self.display_names = np.array([name.replace('_', ' ') for name in self.names], dtype=object)
+    
+    def __len__(self) -> int:
+        return len(self.names)
+    
+    def select(self, confidences: np.ndarray, threshold: float, top_k: int) -> List[List[str]]:
+        """Отбирает теги для каждой строки матрицы вероятностей (N, количество тегов модели)"""
+        scores = np.atleast_2d(confidences)[:, self.indices]
+        k = min(top_k, scores.shape[1])
+        if k <= 0:
+            return [[] for _ in range(len(scores))]
+        
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        
+        results = []
+        for row_indices, row_scores in zip(top, top_scores):
+            selected = row_indices[row_scores >= threshold]
+            results.append(self.display_names[selected].tolist())
+        
+        if logger.isEnabledFor(logging.DEBUG) and len(top):
+            count = min(int((top_scores[0] >= threshold).sum()), 10)
+            debug = ", ".join(f"{name}({score:.3f})" for name, score in
+                              zip(self.names[top[0][:count]], top_scores[0][:count]))
+            logger.debug(f"Топ-10 тегов: {debug}")
+        return results
+    
+    def select_stored(self, stored: List[bytes], threshold: float, top_k: int) -> List[List[str]]:
+        """Отбирает теги по сохраненным вероятностям (см. encode_scores) без запуска модели"""
+        confidences = np.zeros((len(stored), self.size), dtype=np.float32)
+        for row, data in zip(confidences, stored):
+            indices, scores = decode_scores(data)
+            row[indices] = scores
+        return self.select(confidences, threshold, top_k)
+
+
+class TagResult(NamedTuple):
+    """Теги изображения и его вероятности в компактном виде (см. encode_scores)"""
+    tags: List[str]
+    scores: bytes
+
+
+def encode_scores(confidence: np.ndarray, top_k: int) -> bytes:
+    """Упаковывает top_k наибольших вероятностей: индексы тегов (uint16) и вероятности (float16).
+    Для top_k = 128 это 512 байт на изображение против 36 КБ полного вектора float32"""
+    k = min(top_k, len(confidence))
+    top = np.argpartition(-confidence, k - 1)[:k]
+    top = top[np.argsort(-confidence[top], kind='stable')]
+    return top.astype('<u2').tobytes() + confidence[top].astype('<f2').tobytes()
+
+
+def decode_scores(data: bytes):
+    """Распаковывает encode_scores. Возвращает (индексы тегов, вероятности float32)"""
+    k = len(data) // 4
+    indices = np.frombuffer(data, dtype='<u2', count=k)
+    scores = np.frombuffer(data, dtype='<f2', count=k, offset=2 * k).astype(np.float32)
+    return indices, scores
+
+
+def uses_cpu_tagging() -> bool:
+    """True, если теги генерируются на CPU (CUDA провайдер недоступен)"""
+    return config.AUTO_TAG_ENABLED and 'CUDAExecutionProvider' not in ort.get_available_providers()
+
+
+def session_intra_op_threads() -> int:
+    """Количество потоков ONNX Runtime внутри оператора.
+    
+    По умолчанию (0) на CPU модели отдается половина ядер, остальные остаются потокам обработки
+    (см. ingest_max_workers), так что в сумме потоков столько же, сколько ядер.
+    """
+    threads = int(config.AUTO_TAG_SESSION["intra_op_threads"])
+    if threads > 0:
+        return threads
+    return max(1, (os.cpu_count() or 1) // 2)
+
+
+def ingest_max_workers(items_count: int) -> int:
+    """Количество потоков обработки изображений, согласованное с потоками ONNX Runtime"""
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    if uses_cpu_tagging():
+        max_workers = max(1, (os.cpu_count() or 1) - session_intra_op_threads())
+    return max(1, min(max_workers, items_count))
+
+
+def _create_session(model_path: str, providers: List[str]) -> ort.InferenceSession:
+    """Создает сессию ONNX Runtime с параметрами из config.AUTO_TAG_SESSION.
+    
+    Оптимизированный граф сохраняется рядом с моделью отдельно для каждого провайдера
+    и при следующих запусках загружается без повторной оптимизации.
+    """
+    profile = config.AUTO_TAG_SESSION
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = session_intra_op_threads()
+    options.inter_op_num_threads = int(profile["inter_op_threads"])
+    options.execution_mode = (
+        ort.ExecutionMode.ORT_PARALLEL if options.inter_op_num_threads > 1 else ort.ExecutionMode.ORT_SEQUENTIAL
+    )
+    options.enable_cpu_mem_arena = bool(profile["cpu_mem_arena"])
+    options.enable_mem_pattern = bool(profile["mem_pattern"])
+    
+    provider_name = providers[0].replace("ExecutionProvider", "").lower()
+    optimized_path = f"{os.path.splitext(model_path)[0]}.optimized.{provider_name}.onnx"
+    
+    if profile["cache_optimized_model"] and os.path.exists(optimized_path):
+        try:
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            session = ort.InferenceSession(optimized_path, sess_options=options, providers=providers)
+            logger.info(f"Загружена оптимизированная модель: {optimized_path}")
+            return session
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить оптимизированную модель {optimized_path}: {e}")
+    
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if profile["cache_optimized_model"]:
+        options.optimized_model_filepath = optimized_path
+    logger.info(
+        f"ONNX Runtime: intra_op={options.intra_op_num_threads}, inter_op={options.inter_op_num_threads}, "
+        f"mem_arena={options.enable_cpu_mem_arena}, mem_pattern={options.enable_mem_pattern}"
+    )
+    return ort.InferenceSession(model_path, sess_options=options, providers=providers)
+
+
+# Модели WD14 Tagger по значению auto_tag_method. Суффикс "-int8" у любого метода
+# включает динамически квантованную INT8 версию, которая строится локально из скачанной модели
+TAGGER_MODELS = {
+    "wd14": "SmilingWolf/wd-v1-4-swinv2-tagger-v2",
+    "wd14-swinv2": "SmilingWolf/wd-v1-4-swinv2-tagger-v2",
+    "wd14-convnext": "SmilingWolf/wd-v1-4-convnext-tagger-v2",
+    "wd14-vit": "SmilingWolf/wd-v1-4-vit-tagger-v2"
+}
+QUANTIZED_SUFFIX = "-int8"
+
+
+def tagger_methods() -> List[str]:
+    """Все допустимые значения auto_tag_method"""
+    return [name + suffix for suffix in ("", QUANTIZED_SUFFIX) for name in TAGGER_MODELS]
+
+
+def _parse_method(method: str):
+    """Возвращает (репозиторий модели, нужна ли INT8 квантизация)"""
+    quantized = method.endswith(QUANTIZED_SUFFIX)
+    name = method[:-len(QUANTIZED_SUFFIX)] if quantized else method
+    if name not in TAGGER_MODELS:
+        raise ValueError(f"Неизвестный auto_tag_method: {method}. Доступные: {', '.join(tagger_methods())}")
+    return TAGGER_MODELS[name], quantized
+
+
+def _quantize_model(model_path: str) -> str:
+    """Строит INT8 версию модели динамической квантизацией (один раз, рядом с исходной моделью)"""
+    quantized_path = f"{os.path.splitext(model_path)[0]}.int8.onnx"
+    if os.path.exists(quantized_path):
+        return quantized_path
+    
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    
+    logger.info(f"Квантизация модели в INT8: {quantized_path}")
+    tmp_path = quantized_path + ".tmp"
+    quantize_dynamic(model_path, tmp_path, weight_type=QuantType.QUInt8)
+    os.replace(tmp_path, quantized_path)
+    return quantized_path
+
+
+def _local_model_dir(model_repo: str) -> Optional[str]:
+    """Папка модели внутри auto_tag_model_dir или None, если локальная папка не настроена"""
+    if not config.AUTO_TAG_MODEL_DIR:
+        return None
+    return os.path.join(config.AUTO_TAG_MODEL_DIR, model_repo.split("/")[-1])
+
+
+def _resolve_model_files(model_repo: str, allow_download: bool):
+    """Возвращает пути (model.onnx, selected_tags.csv) без обращения к сети, если файлы уже есть
+    в auto_tag_model_dir или в кэше Hugging Face. Скачивает их только при allow_download."""
+    filenames = ("model.onnx", "selected_tags.csv")
+    local_dir = _local_model_dir(model_repo)
+    if local_dir is not None:
+        paths = tuple(os.path.join(local_dir, filename) for filename in filenames)
+        if all(os.path.exists(path) for path in paths):
+            return paths
+    
+    try:
+        return tuple(hf_hub_download(repo_id=model_repo, filename=filename, local_files_only=True)
+                     for filename in filenames)
+    except Exception:
+        if not allow_download:
+            raise FileNotFoundError(
+                f"Модель {model_repo} не найдена локально. Скачайте ее: python backend/download_tagger.py"
+            )
+    
+    logger.info(f"Загрузка WD14 Tagger модели {model_repo} с Hugging Face...")
+    return tuple(hf_hub_download(repo_id=model_repo, filename=filename, local_dir=local_dir)
+                 for filename in filenames)
+
+
+def download_model(method: str) -> None:
+    """Скачивает модель метода (и строит INT8 версию) заранее, чтобы загрузка не обращалась к сети"""
+    model_repo, quantized = _parse_method(method)
+    model_path, _ = _resolve_model_files(model_repo, allow_download=True)
+    if quantized:
+        _quantize_model(model_path)
+
+
+def _load_tagger(method: str):
+    """Загружает модель и словарь тегов для auto_tag_method. Возвращает (сессия, TagVocabulary, ModelIO)"""
+    model_repo, quantized = _parse_method(method)
+    model_path, tags_path = _resolve_model_files(model_repo, allow_download=not config.AUTO_TAG_OFFLINE)
+    
+    if quantized:
+        model_path = _quantize_model(model_path)
+    
+    available_providers = ort.get_available_providers()
+    logger.info(f"Доступные ONNX Runtime провайдеры: {available_providers}")
+    
+    model = None
+    if 'CUDAExecutionProvider' in available_providers:
+        try:
+            providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
+            model = _create_session(model_path, providers)
+            actual_providers = model.get_providers()
+            if 'CUDAExecutionProvider' in actual_providers:
+                logger.info("WD14 Tagger использует GPU (CUDA)")
+            else:
+                logger.info("WD14 Tagger использует CPU")
+        except Exception as e:
+            logger.warning(f"Не удалось использовать CUDA: {e}")
+            model = None
+    
+    if model is None:
+        try:
+            providers = ['CPUExecutionProvider']
+            model = _create_session(model_path, providers)
+            logger.info("WD14 Tagger использует CPU")
+        except Exception as e:
+            logger.error(f"Не удалось создать ONNX Runtime сессию даже на CPU: {e}")
+            raise
+    
+    output_shape = model.get_outputs()[0].shape
+    expected_num_tags = output_shape[1] if len(output_shape) > 1 else output_shape[0]
+    logger.info(f"Модель ожидает {expected_num_tags} тегов (размер выхода: {output_shape})")
+    
+    tags_df = pd.read_csv(tags_path)
+    logger.info(f"Загружено {len(tags_df)} тегов из CSV файла")
+    
+    if len(tags_df) != expected_num_tags:
+        logger.info(f"CSV содержит {len(tags_df)} тегов, модель возвращает {expected_num_tags} вероятностей")
+    
+    model_input = model.get_inputs()[0]
+    io = ModelIO(model_input.name, int(model_input.shape[1]), model.get_outputs()[0].name)
+    
+    logger.info(f"WD14 Tagger модель {method} загружена. Тегов в словаре: {len(tags_df)}")
+    return model, TagVocabulary(tags_df), io
 
 
 class TagGenerator:
     """Генератор тегов для изображений используя WD14 Tagger"""
     
-    def __init__(self):
-        """Инициализация генератора тегов"""
+    def __init__(self, method: Optional[str] = None):
+        """Инициализация генератора тегов.
+        
+        Модель метода из config.AUTO_TAG_METHOD общая для всех генераторов,
+        модели других методов (например, в evaluate_tagger.py) загружаются отдельно.
+        """
+        self._method = method or config.AUTO_TAG_METHOD
         self._model = None
-        self._tags_df = None
+        self._vocabulary: Optional[TagVocabulary] = None
+        self._io: Optional[ModelIO] = None
+    
+    @property
+    def method(self) -> str:
+        return self._method
     
-    def _load_wd14_model(self):
-        """Загружает WD14 Tagger модель с Hugging Face"""
-        global _wd14_model_cache, _wd14_tags_cache, _wd14_loading_lock, _wd14_loading
+    def _load_wd14_model(self) -> Tuple[Any, TagVocabulary, ModelIO]:
+        """Загружает WD14 Tagger модель (из локальной папки или кэша Hugging Face).
         
-        if _wd14_model_cache is not None:
-            self._model = _wd14_model_cache
-            self._tags_df = _wd14_tags_cache
-            return
+        Возвращает (сессия, словарь тегов, вход/выход модели). Вызывающий работает с ними,
+        а не с полями генератора: release_model_resources может обнулить поля и кэш
+        во время инференса в другом потоке, а закрепленная сессия доживет до конца вызова.
+        """
+        global _wd14_model_cache, _wd14_tags_cache, _wd14_io_cache, _wd14_loading_lock, _wd14_loading, _wd14_last_used
+        
+        if self._method != config.AUTO_TAG_METHOD:
+            if self._model is None:
+                self._model, self._vocabulary, self._io = _load_tagger(self._method)
+            return self._model, self._vocabulary, self._io
+        
+        _wd14_last_used = time.monotonic()
+        loaded = _cached_wd14_model()
+        if loaded is not None:
+            self._model, self._vocabulary, self._io = loaded
+            return loaded
         
         with _wd14_loading_lock:
-            if _wd14_model_cache is not None:
-                self._model = _wd14_model_cache
-                self._tags_df = _wd14_tags_cache
-                return
+            loaded = _cached_wd14_model()
+            if loaded is not None:
+                self._model, self._vocabulary, self._io = loaded
+                return loaded
             
             if _wd14_loading:
                 while _wd14_loading:
-                    import time
                     time.sleep(0.1)
-                if _wd14_model_cache is not None:
-                    self._model = _wd14_model_cache
-                    self._tags_df = _wd14_tags_cache
-                    return
+                loaded = _cached_wd14_model()
+                if loaded is not None:
+                    self._model, self._vocabulary, self._io = loaded
+                    return loaded
             
             _wd14_loading = True
             
             try:
-                logger.info("Загрузка WD14 Tagger модели с Hugging Face...")
-                model_repo = "SmilingWolf/wd-v1-4-swinv2-tagger-v2"
-                
-                model_path = hf_hub_download(
-                    repo_id=model_repo,
-                    filename="model.onnx",
-                    cache_dir=None
-                )
-                
-                tags_path = hf_hub_download(
-                    repo_id=model_repo,
-                    filename="selected_tags.csv",
-                    cache_dir=None
-                )
-                
-                available_providers = ort.get_available_providers()
-                logger.info(f"Доступные ONNX Runtime провайдеры: {available_providers}")
-                
-                model = None
-                if 'CUDAExecutionProvider' in available_providers:
-                    try:
-                        providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
-                        model = ort.InferenceSession(model_path, providers=providers)
-                        actual_providers = model.get_providers()
-                        if 'CUDAExecutionProvider' in actual_providers:
-                            logger.info("WD14 Tagger использует GPU (CUDA)")
-                        else:
-                            logger.info("WD14 Tagger использует CPU")
-                    except Exception as e:
-                        logger.warning(f"Не удалось использовать CUDA: {e}")
-                        model = None
-                
-                if model is None:
-                    try:
-                        providers = ['CPUExecutionProvider']
-                        model = ort.InferenceSession(model_path, providers=providers)
-                        logger.info("WD14 Tagger использует CPU")
-                    except Exception as e:
-                        logger.error(f"Не удалось создать ONNX Runtime сессию даже на CPU: {e}")
-                        raise
-                
-                output_shape = model.get_outputs()[0].shape
-                expected_num_tags = output_shape[1] if len(output_shape) > 1 else output_shape[0]
-                logger.info(f"Модель ожидает {expected_num_tags} тегов (размер выхода: {output_shape})")
-                
-                tags_df = pd.read_csv(tags_path)
-                logger.info(f"Загружено {len(tags_df)} тегов из CSV файла")
-                
-                if len(tags_df) != expected_num_tags:
-                    logger.info(f"CSV содержит {len(tags_df)} тегов, модель возвращает {expected_num_tags} вероятностей")
-                
-                _wd14_model_cache = model
-                _wd14_tags_cache = tags_df
-                self._model = model
-                self._tags_df = tags_df
-                
-                logger.info(f"WD14 Tagger модель загружена. Тегов в словаре: {len(tags_df)}")
-                
+                loaded = _load_tagger(self._method)
+                _wd14_model_cache, _wd14_tags_cache, _wd14_io_cache = loaded
+                self._model, self._vocabulary, self._io = loaded
+                _start_idle_evictor()
+                return loaded
             except Exception as e:
                 logger.error(f"Ошибка загрузки WD14 модели: {e}")
                 raise
             finally:
                 _wd14_loading = False
     
-    def generate(self, image_path: str, threshold: float = 0.3771, top_k: int = 20) -> List[str]:
-        """
-        Генерирует теги используя WD14 Tagger от SmilingWolf
-        
-        Args:
-            image_path: Путь к изображению
-            threshold: Порог вероятности для включения тега (по умолчанию 0.3771 - оптимальный согласно README)
-            top_k: Максимальное количество тегов
+    @property
+    def input_size(self) -> int:
+        _, _, io = self._load_wd14_model()
+        return io.input_size
+    
+    def preprocess(self, image_path: str, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """Подготавливает изображение для модели: массив (size, size, 3) float32.
         
-        Returns:
-            Список тегов
+        Изображение уменьшается до размера входа модели (JPEG декодируется сразу в уменьшенном
+        масштабе), после чего прозрачность накладывается на белый фон и изображение вписывается
+        в белый квадрат за один проход прямо в out (например, строку буфера батча).
         """
-        self._load_wd14_model()
-        
-        image = Image.open(image_path)
-        _, target_size, _, _ = self._model.get_inputs()[0].shape
+        size = self.input_size
+        if out is None:
+            out = np.empty((size, size, 3), dtype=np.float32)
         
-        image = image.convert('RGBA')
-        new_image = Image.new('RGBA', image.size, 'WHITE')
-        new_image.paste(image, mask=image)
-        image = new_image.convert('RGB')
-        image = np.asarray(image)
+        with Image.open(image_path) as image:
+            image.draft('RGB', (size, size))
+            has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+            pixels = np.asarray(image.convert('RGBA' if has_alpha else 'RGB'))
         
-        image = _make_square(image, target_size)
-        image = _smart_resize(image, target_size)
-        image = image.astype(np.float32)
-        image = np.expand_dims(image, 0)
+        height, width = pixels.shape[:2]
+        scale = size / max(height, width)
+        if scale < 1:
+            width, height = max(1, round(width * scale)), max(1, round(height * scale))
+            pixels = cv2.resize(pixels, (width, height), interpolation=cv2.INTER_AREA)
         
-        logger.debug(f"Обработанное изображение: форма {image.shape}, диапазон [{image.min():.3f}, {image.max():.3f}]")
-        
-        input_name = self._model.get_inputs()[0].name
-        label_name = self._model.get_outputs()[0].name
-        confidence = self._model.run([label_name], {input_name: image})[0]
-        
-        logger.debug(f"Получено {len(confidence[0])} вероятностей")
-        
-        full_tags = self._tags_df[['name', 'category']].copy()
-        full_tags['confidence'] = confidence[0]
-        tags_df = full_tags[full_tags['category'] != 9].copy()
-        filtered_tags = tags_df[tags_df['confidence'] >= threshold]
-        filtered_tags = filtered_tags.sort_values('confidence', ascending=False)
-        top_tags = filtered_tags.head(top_k)
-        
-        if len(top_tags) > 0:
-            top_tags_debug = ", ".join([f"{row['name']}({row['confidence']:.3f})" for _, row in top_tags.head(10).iterrows()])
-            logger.debug(f"Топ-10 тегов для {os.path.basename(image_path)}: {top_tags_debug}")
-        
-        tags = [tag.replace('_', ' ') for tag in top_tags['name'].tolist()]
+        top, left = (size - height) // 2, (size - width) // 2
+        out.fill(255.0)
+        region = out[top:top + height, left:left + width]
+        if has_alpha:
+            alpha = pixels[:, :, 3:].astype(np.float32) * (1.0 / 255.0)
+            np.multiply(pixels[:, :, :3], alpha, out=region)
+            region += 255.0 * (1.0 - alpha)
+        else:
+            region[...] = pixels
+        return out
+    
+    def preprocess_batch(self, image_paths: List[str], out: Optional[np.ndarray] = None) -> np.ndarray:
+        """Подготавливает изображения прямо в буфер батча (N, size, size, 3) float32"""
+        size = self.input_size
+        if out is None:
+            out = np.empty((len(image_paths), size, size, 3), dtype=np.float32)
+        for i, path in enumerate(image_paths):
+            self.preprocess(path, out=out[i])
+        return out[:len(image_paths)]
+    
+    def run_batch(self, images: np.ndarray) -> np.ndarray:
+        """Запускает модель на батче (N, size, size, 3). Возвращает вероятности (N, количество тегов)"""
+        model, _, io = self._load_wd14_model()
+        return model.run([io.output_name], {io.input_name: images})[0]
+    
+    def postprocess(self, confidence: np.ndarray, threshold: float = 0.3771, top_k: int = 20,
+                    image_path: str = "") -> List[str]:
+        """Отбирает теги по вероятностям одного изображения"""
+        tags = self.postprocess_batch(np.expand_dims(confidence, 0), threshold, top_k)[0]
+        logger.debug(f"Тегов для {os.path.basename(image_path)}: {len(tags)}")
         return tags
+    
+    def postprocess_batch(self, confidences: np.ndarray, threshold: float = 0.3771,
+                          top_k: int = 20) -> List[List[str]]:
+        """Отбирает теги для батча вероятностей (N, количество тегов)"""
+        _, vocabulary, _ = self._load_wd14_model()
+        return vocabulary.select(confidences, threshold, top_k)
 
 
-def get_tags(image_path: str, enabled: bool = True, threshold: Optional[float] = None) -> List[str]:
-    """
-    Генерирует теги для изображения используя WD14 Tagger
+class TagBatcher:
+    """Собирает подготовленные изображения от потоков обработки в динамические батчи
+    (не больше batch_size изображений, ожидание не дольше max_wait секунд),
+    запускает модель один раз на батч и возвращает вероятности каждому потоку через Future"""
     
-    Args:
-        image_path: Путь к изображению
-        enabled: Включена ли генерация тегов
-        threshold: Порог вероятности (если None, используется из config)
+    def __init__(self, batch_size: int, max_wait: float):
+        self._batch_size = batch_size
+        self._max_wait = max_wait
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+        self._buffer: Optional[np.ndarray] = None
     
-    Returns:
-        Список тегов
-    """
-    if not enabled:
-        return []
+    def _batch_buffer(self, image_shape) -> np.ndarray:
+        """Буфер батча, выделяемый один раз и переиспользуемый между батчами"""
+        if self._buffer is None or self._buffer.shape[1:] != image_shape:
+            self._buffer = np.empty((self._batch_size, *image_shape), dtype=np.float32)
+        return self._buffer
+    
+    def submit(self, image: np.ndarray) -> Future:
+        future: Future = Future()
+        self._queue.put((image, future))
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="tag-batcher", daemon=True)
+                self._thread.start()
+        return future
     
+    def _collect_batch(self) -> list:
+        items = [self._queue.get()]
+        deadline = time.monotonic() + self._max_wait
+        while len(items) < self._batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+    
+    def _run(self) -> None:
+        while True:
+            items = self._collect_batch()
+            try:
+                batch = self._batch_buffer(items[0][0].shape)[:len(items)]
+                for row, (image, _) in zip(batch, items):
+                    row[...] = image
+                confidences = _get_tag_generator().run_batch(batch)
+                for (_, future), confidence in zip(items, confidences):
+                    future.set_result(confidence)
+            except Exception as e:
+                logger.error(f"Ошибка генерации тегов для батча из {len(items)} изображений: {e}")
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+def _get_tag_generator() -> TagGenerator:
     global _tag_generator
     
     if _tag_generator is None:
         _tag_generator = TagGenerator()
+    return _tag_generator
+
+
+def _get_tag_batcher() -> TagBatcher:
+    global _tag_batcher
     
+    if _tag_batcher is None:
+        with _wd14_loading_lock:
+            if _tag_batcher is None:
+                _tag_batcher = TagBatcher(config.AUTO_TAG_BATCH_SIZE, config.AUTO_TAG_BATCH_WAIT_MS / 1000)
+    return _tag_batcher
+
+
+def get_tag_vocabulary(method: Optional[str] = None) -> TagVocabulary:
+    """Словарь тегов метода без загрузки модели (для повторного отбора по сохраненным вероятностям)"""
+    method = method or config.AUTO_TAG_METHOD
+    if method == config.AUTO_TAG_METHOD and _wd14_tags_cache is not None:
+        return _wd14_tags_cache
+    
+    with _wd14_loading_lock:
+        if method not in _vocabulary_cache:
+            model_repo, _ = _parse_method(method)
+            _, tags_path = _resolve_model_files(model_repo, allow_download=not config.AUTO_TAG_OFFLINE)
+            _vocabulary_cache[method] = TagVocabulary(pd.read_csv(tags_path))
+        return _vocabulary_cache[method]
+
+
+def refilter_tags(stored: List[bytes], method: Optional[str] = None, threshold: Optional[float] = None,
+                  top_k: int = 20) -> List[List[str]]:
+    """Повторно отбирает теги по сохраненным вероятностям с текущим порогом, без запуска модели"""
+    if threshold is None:
+        threshold = config.AUTO_TAG_THRESHOLD
+    return get_tag_vocabulary(method).select_stored(stored, threshold, top_k)
+
+
+def tag_image(image_path: str, threshold: Optional[float] = None) -> TagResult:
+    """
+    Генерирует теги для изображения и возвращает их вместе с сохраняемыми вероятностями
+    
+    Args:
+        image_path: Путь к изображению
+        threshold: Порог вероятности (если None, используется из config)
+    
+    Returns:
+        TagResult
+    """
     if threshold is None:
         threshold = 0.3771
         if hasattr(config, 'AUTO_TAG_THRESHOLD'):
             threshold = config.AUTO_TAG_THRESHOLD
     
     abs_image_path = os.path.abspath(image_path) if not os.path.isabs(image_path) else image_path
-    return _tag_generator.generate(abs_image_path, threshold=threshold)
+    generator = _get_tag_generator()
+    if config.AUTO_TAG_BATCH_SIZE <= 1:
+        confidence = generator.run_batch(generator.preprocess_batch([abs_image_path]))[0]
+    else:
+        image = generator.preprocess(abs_image_path)
+        confidence = _get_tag_batcher().submit(image).result()
+    tags = generator.postprocess(confidence, threshold, image_path=abs_image_path)
+    return TagResult(tags, encode_scores(confidence, config.AUTO_TAG_STORED_SCORES))
+
+
+def _cached_wd14_model() -> Optional[Tuple[Any, TagVocabulary, ModelIO]]:
+    """Общая модель из кэша или None. Поля кэша читаются в локальные переменные и проверяются все:
+    release_model_resources может обнулить их между чтениями"""
+    model, vocabulary, io = _wd14_model_cache, _wd14_tags_cache, _wd14_io_cache
+    if model is None or vocabulary is None or io is None:
+        return None
+    return model, vocabulary, io
+
+
+def _start_idle_evictor() -> None:
+    """Запускает поток, выгружающий модель после auto_tag_idle_timeout секунд без использования.
+    Вызывается под _wd14_loading_lock при загрузке модели."""
+    global _idle_evictor
+    
+    if config.AUTO_TAG_RESIDENCY != RESIDENCY_IDLE:
+        return
+    if _idle_evictor is not None and _idle_evictor.is_alive():
+        return
+    _idle_evictor = threading.Thread(target=_idle_evictor_loop, name="tagger-idle-evictor", daemon=True)
+    _idle_evictor.start()
+
+
+def _idle_evictor_loop() -> None:
+    timeout = config.AUTO_TAG_IDLE_TIMEOUT
+    while _wd14_model_cache is not None:
+        idle = time.monotonic() - _wd14_last_used
+        if idle >= timeout:
+            logger.info(f"WD14 Tagger не использовался {idle:.0f} с, модель выгружается")
+            release_model_resources()
+            return
+        time.sleep(min(timeout - idle, 60.0))
+
+
+def task_finished() -> None:
+    """Вызывается после завершения задачи обработки изображений.
+    Освобождает модель только при политике auto_tag_residency = "release";
+    при "idle" модель выгрузит поток простоя, при "keep" она остается загруженной."""
+    if config.AUTO_TAG_RESIDENCY == RESIDENCY_RELEASE:
+        release_model_resources()
 
 
 def release_model_resources():
     """
     Освобождает ресурсы модели WD14 Tagger из памяти GPU/CPU.
-    Вызывается после завершения batch обработки изображений.
+    Вызывается политикой удержания модели (см. task_finished).
     """
-    global _tag_generator, _wd14_model_cache, _wd14_tags_cache
+    global _tag_generator, _wd14_model_cache, _wd14_tags_cache, _wd14_io_cache
     
     with _wd14_loading_lock:
         model_was_loaded = _wd14_model_cache is not None
@@ -247,21 +631,17 @@ def release_model_resources():
             except Exception:
                 pass
             
-            # Закрываем сессию ONNX Runtime, если есть метод close
-            try:
-                if hasattr(_wd14_model_cache, 'close'):
-                    _wd14_model_cache.close()
-            except Exception as e:
-                logger.debug(f"Ошибка при закрытии ONNX сессии: {e}")
-            
-            # Очищаем кэш модели
+            # Сессия не закрывается явно: ее может использовать инференс в другом потоке
+            # (см. TagGenerator._load_wd14_model). Она освобождается, когда на нее не останется ссылок
             _wd14_model_cache = None
             _wd14_tags_cache = None
+            _wd14_io_cache = None
         
         # Очищаем генератор тегов
         if _tag_generator is not None:
             _tag_generator._model = None
-            _tag_generator._tags_df = None
+            _tag_generator._vocabulary = None
+            _tag_generator._io = None
             _tag_generator = None
         
         if model_was_loaded:
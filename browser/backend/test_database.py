@@ -0,0 +1,73 @@
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from config import config
+from database import DatabaseManager
+
+
+class ConcurrentSaveTest(unittest.TestCase):
+    """Сохранение в память параллельно со сбросом на диск не блокирует потоки и ничего не теряет"""
+
+    def setUp(self):
+        self._image_folder = config.IMAGE_FOLDER
+        self.folder = tempfile.mkdtemp()
+        config.IMAGE_FOLDER = self.folder
+        self.db = DatabaseManager(save_debounce=0.001)
+        self.db.init_database()
+
+    def tearDown(self):
+        self.db.close()
+        config.IMAGE_FOLDER = self._image_folder
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    @staticmethod
+    def _metadata(i: int) -> dict:
+        return {
+            "id": f"id{i}", "prompt": f"prompt {i}", "checked": False, "rating": 0, "tags": [],
+            "size": i, "hash": f"h{i}", "image_path": f"{i}.png",
+            "thumbnail_data": b"thumb", "thumbnail_tiers": {256: b"tier"}
+        }
+
+    def test_save_during_flush(self):
+        count = 300
+        stop = threading.Event()
+
+        def save():
+            for i in range(count):
+                self.db.save([self._metadata(i)])
+                self.db.save_thumbnail(f"id{i}", b"thumb2", {256: b"tier2"}, generation=1)
+                self.db.update_columns([f"id{i}"], {"rating": 3})
+
+        def flush():
+            while not stop.is_set():
+                self.db._save_to_disk()
+
+        savers = [threading.Thread(target=save)]
+        flusher = threading.Thread(target=flush)
+        flusher.start()
+        for thread in savers:
+            thread.start()
+        for thread in savers:
+            thread.join(timeout=30)
+        stop.set()
+        flusher.join(timeout=30)
+        self.assertFalse(any(thread.is_alive() for thread in savers), "save завис")
+        self.assertFalse(flusher.is_alive(), "сброс на диск завис")
+
+        self.db._save_to_disk()
+        conn = sqlite3.connect(self.db._get_db_path())
+        try:
+            rows = conn.execute("SELECT rating, thumbnail_data FROM metadata").fetchall()
+            tiers = conn.execute("SELECT data FROM thumbnails").fetchall()
+        finally:
+            conn.close()
+        self.assertEqual(len(rows), count)
+        self.assertTrue(all(row == (3, b"thumb2") for row in rows))
+        self.assertEqual(tiers, [(b"tier2",)] * count)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from config import config
+from database import DatabaseManager
+from metadata import metadata_store
+import trash
+
+
+class TrashRoundTripTest(unittest.TestCase):
+    """Удаление в корзину и восстановление сохраняют пользовательские поля"""
+
+    def setUp(self):
+        self._image_folder = config.IMAGE_FOLDER
+        self._db_manager = metadata_store._db_manager
+        self.folder = tempfile.mkdtemp()
+        config.IMAGE_FOLDER = self.folder
+        metadata_store._db_manager = DatabaseManager()
+        metadata_store._db_manager.init_database()
+
+    def tearDown(self):
+        metadata_store._db_manager.close()
+        metadata_store._db_manager = self._db_manager
+        config.IMAGE_FOLDER = self._image_folder
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _add_image(self, metadata_id: str, image_path: str) -> None:
+        abs_path = os.path.join(self.folder, image_path)
+        os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+        with open(abs_path, "wb") as f:
+            f.write(b"image")
+        metadata_store.save([{
+            "id": metadata_id, "prompt": "prompt", "checked": True, "rating": 4,
+            "tags": ["cat", "dog"], "size": 5, "hash": "h", "image_path": image_path
+        }])
+
+    def _fields(self, metadata_id: str) -> dict:
+        return metadata_store.get_fields_by_ids([metadata_id], ["checked", "rating", "tags", "image_path"]).get(metadata_id)
+
+    def test_restore_keeps_tags_and_checked(self):
+        self._add_image("a", "sub/a.png")
+        result = trash.move_to_trash({"a": "sub/a.png"})
+        self.assertEqual(result["count"], 1)
+        self.assertIsNone(self._fields("a"))
+        self.assertFalse(os.path.exists(os.path.join(self.folder, "sub/a.png")))
+
+        self.assertEqual(trash.restore_batch(result["batch"]), 1)
+        self.assertTrue(os.path.exists(os.path.join(self.folder, "sub/a.png")))
+        self.assertEqual(self._fields("a"),
+                         {"checked": True, "rating": 4, "tags": ["cat", "dog"], "image_path": "sub/a.png"})
+
+    def test_restore_old_journal(self):
+        # Журналы до исправления хранили tags JSON-строкой, а checked - числом
+        self._add_image("b", "b.png")
+        batch_folder = os.path.join(trash.trash_folder(), "old")
+        os.makedirs(batch_folder)
+        os.replace(os.path.join(self.folder, "b.png"), os.path.join(batch_folder, "000000_b.png"))
+        metadata_store.delete(["b"])
+        entry = {
+            "id": "b", "path": "b.png", "trash": "000000_b.png",
+            "metadata": {"prompt": "prompt", "checked": 1, "rating": 4, "tags": json.dumps(["cat", "dog"]),
+                         "size": 5, "hash": "h", "image_path": "b.png", "phash": None}
+        }
+        with open(os.path.join(batch_folder, trash.JOURNAL_NAME), "w", encoding="utf-8") as f:
+            for record in ({"batch": "old", "created": 0, "count": 1}, entry, {"committed": True}):
+                f.write(json.dumps(record) + "\n")
+
+        self.assertEqual(trash.restore_batch("old"), 1)
+        self.assertEqual(self._fields("b"),
+                         {"checked": True, "rating": 4, "tags": ["cat", "dog"], "image_path": "b.png"})
+
+
+if __name__ == "__main__":
+    unittest.main()
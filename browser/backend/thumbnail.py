@@ -1,18 +1,23 @@
 import os
 import sys
+import time
 import logging
 import io
-from typing import Dict, Any, List, Optional
+import itertools
+import threading
+from queue import PriorityQueue
+from typing import Dict, Any, List, Optional, Iterable, Set
 from contextlib import contextmanager
-from concurrent.futures import ThreadPoolExecutor
 
 import cv2
+import numpy as np
 import pillow_avif
 from PIL import Image
 
 from paths import get_absolute_path
 from config import config
 from metadata import metadata_store
+from phash import compute_phash
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +33,132 @@ def suppress_stderr():
             sys.stderr = old_stderr
 
 
+_REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+def _pick_decode_flag(image_path: str, min_size: int) -> int:
+    """Выбирает флаг cv2.imread с уменьшенным декодированием по размерам из заголовка файла.
+    
+    Уменьшенное декодирование есть только у JPEG (масштабирование DCT в libjpeg):
+    выбирается наибольший коэффициент, при котором большая сторона не меньше min_size.
+    Для остальных форматов декодирование полное.
+    """
+    try:
+        with Image.open(image_path) as header:
+            if header.format != "JPEG":
+                return cv2.IMREAD_COLOR
+            long_side = max(header.size)
+    except Exception:
+        return cv2.IMREAD_COLOR
+    
+    for factor, flag in _REDUCED_FLAGS:
+        if long_side // factor >= min_size:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def decode_for_thumbnail(image_path: str, min_size: int):
+    """Декодирует изображение с минимальным разрешением, достаточным для миниатюры min_size"""
+    flag = _pick_decode_flag(image_path, min_size)
+    with suppress_stderr():
+        img = cv2.imread(image_path, flag)
+    if flag != cv2.IMREAD_COLOR and (img is None or max(img.shape[:2]) < min_size):
+        with suppress_stderr():
+            img = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    return img
+
+
+def _downscale(img, size: int):
+    """Уменьшает изображение так, чтобы большая сторона не превышала size (без увеличения)"""
+    height, width = img.shape[:2]
+    if max(height, width) <= size:
+        return img
+    if height > width:
+        new_height = size
+        new_width = int(width * size / height)
+    else:
+        new_width = size
+        new_height = int(height * size / width)
+    return cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_AREA)
+
+
+def _get_profile(profile_name: Optional[str]) -> Dict[str, Any]:
+    """Возвращает профиль кодирования миниатюр по имени (по умолчанию config.THUMBNAIL_PROFILE)"""
+    name = profile_name or config.THUMBNAIL_PROFILE
+    if name not in config.THUMBNAIL_PROFILES:
+        raise ValueError(f"Неизвестный профиль миниатюр: {name}")
+    return config.THUMBNAIL_PROFILES[name]
+
+
+def encode_thumbnail(img, profile: Dict[str, Any]) -> bytes:
+    """Кодирует BGR изображение согласно профилю (codec: avif, webp или jpeg)"""
+    codec = profile["codec"]
+    quality = int(profile["quality"])
+    if codec == "jpeg":
+        # cv2 собран с libjpeg-turbo и кодирует BGR без конвертации в PIL
+        ok, encoded = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        return encoded.tobytes() if ok else b""
+    
+    pil_image = Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+    buffer = io.BytesIO()
+    if codec == "avif":
+        pil_image.save(buffer, format="AVIF", quality=quality, speed=int(profile.get("speed", 6)))
+    elif codec == "webp":
+        pil_image.save(buffer, format="WEBP", quality=quality, method=int(profile.get("method", 4)))
+    else:
+        raise ValueError(f"Неизвестный кодек миниатюр: {codec}")
+    return buffer.getvalue()
+
+
+def memory_tier_sizes() -> List[int]:
+    """Уровни миниатюр, создаваемые вместе с основной и хранимые в памяти (не крупнее основной), от большего к меньшему"""
+    return sorted({size for size in config.THUMBNAIL_SIZES if size <= config.THUMBNAIL_SIZE} | {config.THUMBNAIL_SIZE},
+                  reverse=True)
+
+
+def large_tier_size(size: Optional[int]) -> Optional[int]:
+    """Уровень крупнее основной миниатюры для запрошенного размера: наименьший не меньше size, иначе наибольший.
+    None, если size покрывается уровнями в памяти. Такие уровни создаются по запросу и хранятся только на диске"""
+    if size is None or size <= config.THUMBNAIL_SIZE:
+        return None
+    large = sorted(tier for tier in config.THUMBNAIL_SIZES if tier > config.THUMBNAIL_SIZE)
+    if not large:
+        return None
+    return next((tier for tier in large if tier >= size), large[-1])
+
+
+def tiers_from_thumbnail(data: bytes, sizes: List[int], profile_name: Optional[str] = None) -> Dict[int, bytes]:
+    """Меньшие уровни из сохраненной основной миниатюры (для записей, созданных до появления уровней)"""
+    profile = _get_profile(profile_name)
+    with Image.open(io.BytesIO(data)) as image:
+        img = cv2.cvtColor(np.asarray(image.convert("RGB")), cv2.COLOR_RGB2BGR)
+    return {size: encode_thumbnail(_downscale(img, size), profile) for size in sizes}
+
+
+def phash_from_thumbnail(data: bytes) -> int:
+    """Перцептивный хеш по сохраненной миниатюре (для записей, созданных до появления phash)"""
+    with Image.open(io.BytesIO(data)) as image:
+        return compute_phash(np.asarray(image.convert("L")))
+
+
+def thumbnail_version(file_hash: str, generation: int) -> str:
+    """Версия миниатюры для адресации по содержимому: хеш файла и поколение миниатюры"""
+    return f"{file_hash}-{generation}"
+
+
+def thumbnail_mimetype(data: bytes) -> str:
+    """Определяет MIME тип миниатюры по сигнатуре данных"""
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/avif"
+
+
 class ThumbnailService:
     @staticmethod
     def needs_thumbnail(metadata: Dict[str, Any]) -> bool:
@@ -35,11 +166,18 @@ class ThumbnailService:
         return not bool(metadata.get("thumbnail_data"))
 
     @staticmethod
-    def create_thumbnail(metadata: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-        """Создает миниатюру и возвращает обновленные метаданные (без сохранения в БД)"""
+    def create_thumbnail(metadata: Dict[str, Any], profile_name: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Создает основную миниатюру и меньшие уровни (memory_tier_sizes) за одно декодирование
+        и возвращает обновленные метаданные (без сохранения в БД).
+        Основной уровень пишется в thumbnail_data, остальные - в thumbnail_tiers,
+        крупные уровни создаются позже по запросу (create_large_tier),
+        перцептивный хеш (для поиска nd:) - в phash.
+        profile_name - профиль кодирования из config.THUMBNAIL_PROFILES."""
         if metadata.get("thumbnail_data"):
             return None
 
+        profile = _get_profile(profile_name)
+
         image_path = get_absolute_path(metadata.get("image_path", ""))
         if not image_path:
             logger.warning(f"Не удалось получить абсолютный путь для {metadata.get('image_path', '')}")
@@ -50,34 +188,34 @@ class ThumbnailService:
                 logger.warning(f"Файл не существует: {image_path}")
                 return None
             
-            with suppress_stderr():
-                img = cv2.imread(image_path, cv2.IMREAD_COLOR)
+            img = decode_for_thumbnail(image_path, config.THUMBNAIL_SIZE)
             if img is None:
                 logger.warning(f"Не удалось загрузить изображение: {image_path}")
                 return None
             
-            height, width = img.shape[:2]
-            if height > width:
-                new_height = config.THUMBNAIL_SIZE
-                new_width = int(width * config.THUMBNAIL_SIZE / height)
-            else:
-                new_width = config.THUMBNAIL_SIZE
-                new_height = int(height * config.THUMBNAIL_SIZE / width)
+            # Каждый уровень получается из предыдущего (большего), а не из оригинала
+            tiers = {}
+            current = img
+            encoded = None
+            for size in memory_tier_sizes():
+                resized = _downscale(current, size)
+                if encoded is None or resized is not current:
+                    encoded = encode_thumbnail(resized, profile)
+                current = resized
+                tiers[size] = encoded
             
-            thumbnail = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_AREA)
-            
-            thumbnail_rgb = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2RGB)
-            pil_image = Image.fromarray(thumbnail_rgb)
-            
-            buffer = io.BytesIO()
-            pil_image.save(buffer, format='AVIF', quality=config.THUMBNAIL_QUALITY, method=6)
-            thumbnail_bytes = buffer.getvalue()
+            # Перцептивный хеш - из наименьшего уровня, уже уменьшенного для миниатюр
+            phash = compute_phash(current)
             
+            thumbnail_bytes = tiers.pop(config.THUMBNAIL_SIZE)
             if not thumbnail_bytes:
                 logger.error(f"Созданная миниатюра пуста для {image_path}")
                 return None
             
             metadata["thumbnail_data"] = thumbnail_bytes
+            metadata["thumbnail_tiers"] = tiers
+            metadata["thumbnail_generation"] = int(metadata.get("thumbnail_generation", 0) or 0) + 1
+            metadata["phash"] = phash
             
             return metadata
         except Exception as e:
@@ -85,32 +223,141 @@ class ThumbnailService:
             return None
 
     @staticmethod
-    def ensure_thumbnails(metadata_list: List[Dict[str, Any]]) -> None:
-        """Обеспечивает наличие миниатюр для списка метаданных"""
-        if not metadata_list:
+    def create_large_tier(metadata_id: str, size: Optional[int]) -> bool:
+        """Создает уровень миниатюры крупнее основной для запрошенного размера, если его еще нет.
+        Декодирование - с минимальным разрешением для этого уровня. Возвращает True, если уровень доступен"""
+        tier_size = large_tier_size(size)
+        if tier_size is None:
+            return False
+        if metadata_store.get_thumbnail_versions([metadata_id], tier_size, allow_smaller=False):
+            return True
+
+        fields = metadata_store.get_fields_by_ids([metadata_id], ["image_path", "thumbnail_generation"])
+        if metadata_id not in fields:
+            return False
+        image_path = get_absolute_path(fields[metadata_id]["image_path"])
+        try:
+            img = decode_for_thumbnail(image_path, tier_size) if os.path.exists(image_path) else None
+            if img is None:
+                logger.warning(f"Не удалось загрузить изображение: {image_path}")
+                return False
+            encoded = encode_thumbnail(_downscale(img, tier_size), _get_profile(None))
+        except Exception as e:
+            logger.error(f"Не удалось создать уровень {tier_size} миниатюры для {image_path}: {e}", exc_info=True)
+            return False
+        return bool(encoded) and metadata_store.save_large_tier(
+            metadata_id, tier_size, encoded, fields[metadata_id]["thumbnail_generation"]
+        )
+
+
+class ThumbnailWorker:
+    """Фоновая генерация миниатюр с приоритетной очередью.
+    
+    Меньший priority обрабатывается раньше (0 - видимая страница, 1+ - предзагрузка следующих),
+    внутри одного приоритета - сначала последние добавленные.
+    """
+
+    VISIBLE_PRIORITY = 0
+    PREFETCH_PRIORITY = 1
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self._max_workers = max_workers or min(8, (os.cpu_count() or 1) * 2)
+        self._queue: PriorityQueue = PriorityQueue()
+        self._pending: Dict[str, tuple] = {}
+        # ID, для которых последняя генерация не дала миниатюры: wait_any не считает их готовыми.
+        # Нужны только ждущим wait_any: записываются, пока они есть, и очищаются, когда ответ получил последний
+        self._failed: Set[str] = set()
+        self._waiters = 0
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+
+    def _ensure_started(self) -> None:
+        if self._threads:
             return
+        for i in range(self._max_workers):
+            thread = threading.Thread(target=self._run, name=f"thumbnail-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def enqueue(self, metadata_list: Iterable[Dict[str, Any]], priority: int = VISIBLE_PRIORITY) -> None:
+        """Ставит в очередь генерацию миниатюр для метаданных без миниатюры"""
+        with self._cond:
+            for metadata in metadata_list:
+                metadata_id = metadata.get("id")
+                if not metadata_id or not ThumbnailService.needs_thumbnail(metadata):
+                    continue
+                current = self._pending.get(metadata_id)
+                if current is not None and current[0] <= priority:
+                    continue
+                self._failed.discard(metadata_id)
+                key = (priority, -next(self._counter))
+                self._pending[metadata_id] = (priority, key, {
+                    "id": metadata_id,
+                    "image_path": metadata.get("image_path", ""),
+                    "thumbnail_generation": metadata.get("thumbnail_generation", 0)
+                })
+                self._queue.put((key, metadata_id))
+            if self._pending:
+                self._ensure_started()
+
+    def is_pending(self, metadata_id: str) -> bool:
+        with self._cond:
+            return metadata_id in self._pending
 
-        def process_single(metadata: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    def pending_count(self, metadata_ids: List[str]) -> int:
+        """Количество миниатюр из списка, еще ожидающих генерации"""
+        with self._cond:
+            return sum(1 for metadata_id in metadata_ids if metadata_id in self._pending)
+
+    def wait_any(self, metadata_ids: List[str], timeout: float) -> None:
+        """Ждет, пока хотя бы одна из миниатюр будет создана, ни одной не останется в очереди, или истечет timeout.
+        Миниатюры, генерация которых не удалась, готовыми не считаются"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            waiting = {metadata_id for metadata_id in metadata_ids if metadata_id in self._pending}
+            if not waiting:
+                return
+            self._waiters += 1
             try:
-                if ThumbnailService.needs_thumbnail(metadata):
-                    return ThumbnailService.create_thumbnail(metadata)
-                return None
+                while waiting:
+                    done = {metadata_id for metadata_id in waiting if metadata_id not in self._pending}
+                    if done - self._failed:
+                        return
+                    waiting -= done
+                    remaining = deadline - time.monotonic()
+                    if not waiting or remaining <= 0:
+                        return
+                    self._cond.wait(remaining)
+            finally:
+                self._waiters -= 1
+                if not self._waiters:
+                    self._failed.clear()
+
+    def _run(self) -> None:
+        while True:
+            key, metadata_id = self._queue.get()
+            with self._cond:
+                entry = self._pending.get(metadata_id)
+                if entry is None or entry[1] != key:
+                    # Уже обработана или переставлена с более высоким приоритетом
+                    continue
+                metadata = entry[2]
+                # Приоритет -1 помечает миниатюру как обрабатываемую, повторная постановка игнорируется
+                self._pending[metadata_id] = (-1, key, metadata)
+            saved = False
+            try:
+                updated = ThumbnailService.create_thumbnail(metadata)
+                if updated:
+                    saved = metadata_store.save_thumbnail(updated)
             except Exception as e:
-                image_path = metadata.get("image_path", "unknown")
-                logger.error(f"Ошибка при создании миниатюры для {image_path}: {e}", exc_info=True)
-                return None
+                logger.error(f"Ошибка фоновой генерации миниатюры для {metadata.get('image_path', 'unknown')}: {e}", exc_info=True)
+            finally:
+                with self._cond:
+                    self._pending.pop(metadata_id, None)
+                    if not saved and self._waiters:
+                        self._failed.add(metadata_id)
+                    self._cond.notify_all()
 
-        updated_metadata_list = []
-        if len(metadata_list) == 1:
-            updated = process_single(metadata_list[0])
-            if updated:
-                updated_metadata_list.append(updated)
-        else:
-            max_workers = min(8, (os.cpu_count() or 1) * 2, len(metadata_list))
-            with ThreadPoolExecutor(max_workers=max_workers) as pool:
-                results = pool.map(process_single, metadata_list)
-                updated_metadata_list = [m for m in results if m is not None]
-        
-        if updated_metadata_list:
-            metadata_store.save(updated_metadata_list)
 
+thumbnail_worker = ThumbnailWorker()
@@ -0,0 +1,266 @@
+import os
+import json
+import time
+import uuid
+import errno
+import shutil
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from config import config
+from paths import get_absolute_path, folder_tree_cache
+from metadata import metadata_store
+
+logger = logging.getLogger(__name__)
+
+# Корзина: каждый пакет удаления - папка {image_folder}/{metadata_folder}/trash/<id> с файлами и журналом.
+# Журнал (JSON Lines): заголовок, записи (ID, путь, имя в корзине, метаданные) и отметка commit.
+# Записи пишутся на диск до первого перемещения, отметка - после удаления метаданных.
+# При запуске пакет без отметки откатывается (файлы возвращаются), с отметкой - доводится до конца
+JOURNAL_NAME = "journal.jsonl"
+
+# Поля метаданных, сохраняемые в журнале для восстановления (миниатюра создается заново)
+RESTORED_FIELDS = ["prompt", "checked", "rating", "tags", "size", "hash", "image_path", "phash"]
+
+PROGRESS_STEP = 100
+
+_lock = threading.Lock()
+
+
+def trash_folder() -> str:
+    return os.path.join(config.IMAGE_FOLDER, config.METADATA_FOLDER, "trash")
+
+
+def batch_folder_of(batch_id: str) -> str:
+    """Папка пакета корзины. FileNotFoundError, если пакета нет"""
+    if not batch_id or os.path.basename(batch_id) != batch_id or batch_id.startswith("."):
+        raise ValueError(f"Неверный ID пакета корзины: {batch_id}")
+    folder = os.path.join(trash_folder(), batch_id)
+    if not os.path.isdir(folder):
+        raise FileNotFoundError(f"Пакет корзины {batch_id} не найден")
+    return folder
+
+
+def _move(src: str, dst: str) -> None:
+    """Переименование в пределах тома; между томами - копирование и удаление"""
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+
+
+def _append_journal(batch_folder: str, records: List[Dict]) -> None:
+    with open(os.path.join(batch_folder, JOURNAL_NAME), "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_journal(batch_folder: str) -> Tuple[Dict, List[Dict], bool]:
+    """Заголовок, записи и отметка commit. Оборванная при сбое строка пропускается"""
+    header, entries, committed = {}, [], False
+    try:
+        with open(os.path.join(batch_folder, JOURNAL_NAME), "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if "batch" in record:
+                    header = record
+                elif record.get("committed"):
+                    committed = True
+                elif "id" in record:
+                    entries.append(record)
+    except FileNotFoundError:
+        pass
+    return header, entries, committed
+
+
+def _journal_metadata(metadata: Dict) -> Dict:
+    """Метаданные записи журнала в виде для save: в старых журналах tags - JSON-строка, checked - 0/1"""
+    metadata = dict(metadata)
+    tags = metadata.get("tags")
+    if isinstance(tags, str):
+        try:
+            tags = json.loads(tags) if tags else []
+        except ValueError:
+            tags = []
+    metadata["tags"] = tags if isinstance(tags, list) else []
+    metadata["checked"] = bool(metadata.get("checked", False))
+    return metadata
+
+
+def _parallel(func, items: List, progress_callback: Optional[Callable[[int, int, str], None]],
+              message: str) -> List:
+    """Выполняет func над items в пуле потоков. Возвращает элементы, для которых func завершилась без OSError"""
+    done_items = []
+    total = len(items)
+    with ThreadPoolExecutor(max_workers=max(1, min(config.DELETE_WORKERS, total))) as pool:
+        futures = {pool.submit(func, item): item for item in items}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                future.result()
+                done_items.append(futures[future])
+            except OSError as e:
+                logger.warning(f"Ошибка перемещения {futures[future]['path']}: {e}")
+            if progress_callback and (done % PROGRESS_STEP == 0 or done == total):
+                progress_callback(done, total, f"{message}: {done} из {total}")
+    return done_items
+
+
+def _remove_if_empty(batch_folder: str) -> bool:
+    """Удаляет папку пакета, если в ней не осталось файлов, кроме журнала"""
+    if any(name != JOURNAL_NAME for name in os.listdir(batch_folder)):
+        return False
+    shutil.rmtree(batch_folder, ignore_errors=True)
+    return True
+
+
+def move_to_trash(image_paths: Dict[str, str],
+                  progress_callback: Optional[Callable[[int, int, str], None]] = None) -> Dict:
+    """
+    Удаляет изображения {id: относительный путь}: файлы перемещаются в корзину параллельно,
+    затем метаданные удаляются одним запросом. Файлы, которых уже нет, считаются удаленными.
+    Возвращает {"batch": ID пакета корзины или None, "count": количество удаленных}
+    """
+    if not image_paths:
+        return {"batch": None, "count": 0}
+
+    batch_id = datetime.now().strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:8]
+    batch_folder = os.path.join(trash_folder(), batch_id)
+    os.makedirs(batch_folder)
+
+    metadata = metadata_store.get_fields_by_ids(list(image_paths), RESTORED_FIELDS)
+    entries = [
+        {
+            "id": metadata_id,
+            "path": image_path,
+            "trash": f"{i:06d}_{os.path.basename(image_path)}",
+            "metadata": metadata.get(metadata_id, {})
+        }
+        for i, (metadata_id, image_path) in enumerate(image_paths.items())
+    ]
+    _append_journal(batch_folder, [{"batch": batch_id, "created": time.time(), "count": len(entries)}] + entries)
+
+    def move(entry: Dict) -> None:
+        src = get_absolute_path(entry["path"])
+        if os.path.lexists(src):
+            _move(src, os.path.join(batch_folder, entry["trash"]))
+
+    deleted = _parallel(move, entries, progress_callback, "Перемещение в корзину")
+    if deleted:
+        metadata_store.delete([entry["id"] for entry in deleted])
+        folder_tree_cache.invalidate()
+    _append_journal(batch_folder, [{"committed": True}])
+
+    if _remove_if_empty(batch_folder):
+        batch_id = None
+    logger.info(f"Удалено изображений: {len(deleted)} из {len(entries)}, пакет корзины: {batch_id}")
+    return {"batch": batch_id, "count": len(deleted)}
+
+
+def _restore_entries(batch_folder: str, entries: List[Dict],
+                     progress_callback: Optional[Callable[[int, int, str], None]] = None) -> int:
+    """Возвращает файлы пакета на место и восстанавливает метаданные, которых нет в БД"""
+    def move_back(entry: Dict) -> None:
+        dst = get_absolute_path(entry["path"])
+        if os.path.lexists(dst):
+            raise FileExistsError(errno.EEXIST, "Файл уже существует", dst)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        _move(os.path.join(batch_folder, entry["trash"]), dst)
+
+    in_trash = [entry for entry in entries if os.path.lexists(os.path.join(batch_folder, entry["trash"]))]
+    restored = _parallel(move_back, in_trash, progress_callback, "Восстановление из корзины")
+    if not restored:
+        return 0
+
+    existing = metadata_store.get_fields_by_ids([entry["id"] for entry in restored], ["image_path"])
+    missing = [
+        {**_journal_metadata(entry["metadata"]), "id": entry["id"], "image_path": entry["path"], "thumbnail_data": None}
+        for entry in restored if entry["id"] not in existing and entry["metadata"]
+    ]
+    if missing:
+        metadata_store.save(missing)
+    folder_tree_cache.invalidate()
+    return len(restored)
+
+
+def restore_batch(batch_id: str, progress_callback: Optional[Callable[[int, int, str], None]] = None) -> int:
+    """Отменяет удаление: возвращает файлы пакета и их метаданные. Возвращает количество восстановленных"""
+    with _lock:
+        batch_folder = batch_folder_of(batch_id)
+        _, entries, _ = _read_journal(batch_folder)
+        restored = _restore_entries(batch_folder, entries, progress_callback)
+        _remove_if_empty(batch_folder)
+    logger.info(f"Восстановлено из корзины {batch_id}: {restored}")
+    return restored
+
+
+def purge_batch(batch_id: str) -> None:
+    """Окончательно удаляет файлы пакета корзины"""
+    with _lock:
+        shutil.rmtree(batch_folder_of(batch_id))
+
+
+def list_trash() -> List[Dict]:
+    """Пакеты корзины, новые первыми: ID, время удаления и количество файлов в корзине"""
+    folder = trash_folder()
+    if not os.path.isdir(folder):
+        return []
+    batches = []
+    for batch_id in sorted(os.listdir(folder), reverse=True):
+        batch_folder = os.path.join(folder, batch_id)
+        if not os.path.isdir(batch_folder):
+            continue
+        header, _, committed = _read_journal(batch_folder)
+        batches.append({
+            "batch": batch_id,
+            "created": header.get("created"),
+            "count": sum(1 for name in os.listdir(batch_folder) if name != JOURNAL_NAME),
+            "committed": committed
+        })
+    return batches
+
+
+def recover_trash() -> None:
+    """
+    Доводит пакеты корзины до согласованного состояния после сбоя и удаляет устаревшие:
+    пакет без отметки commit откатывается, у пакета с отметкой удаляются оставшиеся метаданные
+    """
+    folder = trash_folder()
+    if not os.path.isdir(folder):
+        return
+    expire_before = time.time() - config.TRASH_RETENTION_DAYS * 86400
+
+    with _lock:
+        for batch_id in sorted(os.listdir(folder)):
+            batch_folder = os.path.join(folder, batch_id)
+            if not os.path.isdir(batch_folder):
+                continue
+            try:
+                header, entries, committed = _read_journal(batch_folder)
+                if not committed:
+                    restored = _restore_entries(batch_folder, entries)
+                    logger.warning(f"Прерванное удаление {batch_id} отменено: восстановлено {restored}")
+                    _remove_if_empty(batch_folder)
+                    continue
+
+                leftover = [
+                    entry["id"] for entry in entries
+                    if not os.path.lexists(get_absolute_path(entry["path"]))
+                ]
+                if leftover and metadata_store.delete(leftover):
+                    folder_tree_cache.invalidate()
+
+                if config.TRASH_RETENTION_DAYS > 0 and header.get("created", time.time()) < expire_before:
+                    shutil.rmtree(batch_folder, ignore_errors=True)
+                    logger.info(f"Удален устаревший пакет корзины {batch_id}")
+            except OSError as e:
+                logger.error(f"Ошибка восстановления пакета корзины {batch_id}: {e}")
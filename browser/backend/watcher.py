@@ -0,0 +1,296 @@
+import os
+import time
+import queue
+import logging
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+from config import config
+from image import ingest_images, forget_images, move_image, move_folder
+from paths import walk_images
+from metadata import metadata_store
+
+logger = logging.getLogger(__name__)
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+CREATED = "created"
+DELETED = "deleted"
+MOVED = "moved"
+
+
+def _is_image(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in config.ALLOWED_EXTENSIONS
+
+
+def _is_ignored(path: str, is_dir: bool = False) -> bool:
+    """Пропускает скрытые папки и папку метаданных"""
+    parts = os.path.relpath(path, config.IMAGE_FOLDER).split(os.sep)
+    if not is_dir:
+        parts = parts[:-1]
+    return any(part.startswith(".") or part.startswith(config.METADATA_FOLDER) for part in parts)
+
+
+class _EventHandler(FileSystemEventHandler):
+    """Передает события watchdog (inotify и др.) в FolderWatcher"""
+
+    def __init__(self, watcher: "FolderWatcher"):
+        super().__init__()
+        self._watcher = watcher
+
+    def on_created(self, event):
+        self._watcher.push(CREATED, event.src_path, is_dir=event.is_directory)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self._watcher.push(CREATED, event.src_path)
+
+    def on_closed(self, event):
+        self._watcher.push(CREATED, event.src_path)
+
+    def on_deleted(self, event):
+        self._watcher.push(DELETED, event.src_path, is_dir=event.is_directory)
+
+    def on_moved(self, event):
+        self._watcher.push(MOVED, event.src_path, event.dest_path, is_dir=event.is_directory)
+
+
+class FolderWatcher:
+    """
+    Следит за config.IMAGE_FOLDER и индексирует изменения без полного пересканирования.
+    События по одному пути объединяются и передаются в очередь обработки после debounce
+    секунд тишины (файл, который еще дописывается, обрабатывается после последней записи).
+    Использует watchdog (inotify в Linux), без него - опрос mtime папок.
+    Перемещения сохраняют метаданные: перемещенная папка переносится целиком по префиксу пути,
+    а пары удаление + создание файла с тем же размером и хешем (опрос, перемещение между томами)
+    обрабатываются как перемещение.
+    """
+
+    def __init__(self, root: str, debounce: float, poll_interval: float):
+        self._root = root
+        self._debounce = debounce
+        self._poll_interval = poll_interval
+        # путь -> (тип события, новый путь для перемещения, время последнего события)
+        self._pending: Dict[str, Tuple[str, Optional[str], float]] = {}
+        self._pending_lock = threading.Lock()
+        # Списки событий (тип, путь, новый путь, папка): события, готовые одновременно, попадают
+        # в очередь одним списком, чтобы удаление и создание при переименовании обработались вместе
+        self._ingest_queue: queue.Queue = queue.Queue()
+        self._stop = threading.Event()
+        self._observer = None
+
+    def start(self) -> None:
+        threading.Thread(target=self._debounce_loop, name="watcher-debounce", daemon=True).start()
+        threading.Thread(target=self._ingest_loop, name="watcher-ingest", daemon=True).start()
+
+        if Observer is not None:
+            try:
+                self._observer = Observer()
+                self._observer.schedule(_EventHandler(self), self._root, recursive=True)
+                self._observer.start()
+                logger.info(f"Отслеживание изменений в {self._root} (watchdog)")
+                return
+            except OSError as e:
+                logger.warning(f"Не удалось запустить watchdog, используется опрос: {e}")
+                self._observer = None
+
+        threading.Thread(target=self._poll_loop, name="watcher-poll", daemon=True).start()
+        logger.info(f"Отслеживание изменений в {self._root} (опрос каждые {self._poll_interval} с)")
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._observer is not None:
+            self._observer.stop()
+
+    def push(self, kind: str, path: str, dest_path: Optional[str] = None, is_dir: bool = False,
+             at: Optional[float] = None) -> None:
+        """Регистрирует событие файловой системы. at - время события (time.monotonic), по умолчанию текущее"""
+        if is_dir:
+            if kind == MOVED:
+                if _is_ignored(dest_path, is_dir=True):
+                    kind, dest_path = DELETED, None
+                elif _is_ignored(path, is_dir=True):
+                    kind, path, dest_path = CREATED, dest_path, None
+            # Папки обрабатываются сразу целиком: перемещенная переносит метаданные по префиксу пути
+            # до обработки событий ее файлов, изображения внутри созданной (и еще не известные
+            # внутри перемещенной) добавляются как созданные
+            if kind in (DELETED, MOVED):
+                self._ingest_queue.put([(kind, path, dest_path, True)])
+            if kind in (CREATED, MOVED):
+                target = dest_path or path
+                if not _is_ignored(target, is_dir=True):
+                    for image_path in walk_images(target):
+                        self.push(CREATED, image_path)
+            return
+
+        if kind == MOVED and not (_is_image(dest_path) and not _is_ignored(dest_path)):
+            kind, dest_path = DELETED, None
+        if not (_is_image(path) and not _is_ignored(path)):
+            if kind != MOVED:
+                return
+            kind, path, dest_path = CREATED, dest_path, None
+
+        with self._pending_lock:
+            self._pending[path] = (kind, dest_path, time.monotonic() if at is None else at)
+
+    def _debounce_loop(self) -> None:
+        while not self._stop.wait(min(self._debounce, 0.25)):
+            now = time.monotonic()
+            with self._pending_lock:
+                ready = [(path, event) for path, event in self._pending.items() if now - event[2] >= self._debounce]
+                for path, _ in ready:
+                    del self._pending[path]
+            if ready:
+                self._ingest_queue.put([(kind, path, dest_path, False) for path, (kind, dest_path, _) in ready])
+
+    def _ingest_loop(self) -> None:
+        while not self._stop.is_set():
+            batch = list(self._ingest_queue.get())
+            while True:
+                try:
+                    batch.extend(self._ingest_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._process(batch)
+            except Exception as e:
+                logger.error(f"Ошибка индексации изменений: {e}", exc_info=True)
+
+    def _process(self, batch) -> None:
+        created = [path for kind, path, _, _ in batch if kind == CREATED]
+        deleted = [path for kind, path, _, is_dir in batch if kind == DELETED and not is_dir]
+        deleted_dirs = [path for kind, path, _, is_dir in batch if kind == DELETED and is_dir]
+
+        for kind, path, dest_path, is_dir in batch:
+            if kind == MOVED and is_dir:
+                moved = move_folder(path, dest_path)
+                if moved:
+                    logger.info(f"Перенесено в индексе: {moved} ({path} -> {dest_path})")
+            elif kind == MOVED:
+                move_image(path, dest_path)
+        if deleted_dirs:
+            deleted.extend(self._indexed_paths_under(deleted_dirs))
+        if deleted and created:
+            for src_path, dst_path in self._match_moves(deleted, created):
+                move_image(src_path, dst_path)
+                deleted.remove(src_path)
+                created.remove(dst_path)
+        if deleted:
+            removed = forget_images(deleted)
+            if removed:
+                logger.info(f"Удалено из индекса: {removed}")
+        if created:
+            added = ingest_images(created)
+            if added:
+                logger.info(f"Добавлено в индекс: {added}")
+
+    @staticmethod
+    def _match_moves(deleted, created) -> List[Tuple[str, str]]:
+        """Пары (старый путь, новый путь): удаленный файл с метаданными и новый файл без них
+        с тем же размером и MD5. Хеш считается только у новых файлов с подходящим размером"""
+        by_key: Dict[Tuple[int, str], List[str]] = {}
+        for path, metadata in zip(deleted, metadata_store.get_by_paths(deleted)):
+            if metadata is not None and metadata.get("hash") and not os.path.exists(path):
+                by_key.setdefault((metadata["size"], metadata["hash"]), []).append(path)
+        if not by_key:
+            return []
+        sizes = {size for size, _ in by_key}
+
+        pairs = []
+        for path, metadata in zip(created, metadata_store.get_by_paths(created)):
+            if metadata is not None:
+                continue
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            if size not in sizes:
+                continue
+            candidates = by_key.get((size, metadata_store._calculate_file_hash(path)))
+            if candidates:
+                pairs.append((candidates.pop(), path))
+        return pairs
+
+    def _indexed_paths_under(self, folders) -> list:
+        """Абсолютные пути проиндексированных изображений внутри удаленных папок"""
+        paths = []
+        for folder in folders:
+            prefix = os.path.relpath(folder, self._root).replace("\\", "/") + "/"
+            paths.extend(os.path.join(self._root, rel_path) for rel_path in metadata_store.get_paths_under(prefix))
+        return paths
+
+    def _poll_loop(self) -> None:
+        """Опрос без watchdog: на каждом шаге stat каждой известной папки,
+        перечитываются только папки с изменившимся mtime. События одного шага получают одно время,
+        чтобы удаление и создание при переименовании прошли debounce вместе и сопоставились (_match_moves)"""
+        snapshot: Dict[str, Tuple[int, Set[str], Set[str]]] = {}
+        self._scan_dir(self._root, snapshot, emit=False, at=time.monotonic())
+
+        while not self._stop.wait(self._poll_interval):
+            at = time.monotonic()
+            for folder in list(snapshot):
+                if folder not in snapshot:
+                    continue
+                try:
+                    mtime = os.stat(folder).st_mtime_ns
+                except OSError:
+                    self._drop_dir(folder, snapshot, at)
+                    continue
+                if mtime != snapshot[folder][0]:
+                    self._scan_dir(folder, snapshot, emit=True, at=at)
+
+    def _scan_dir(self, folder: str, snapshot: Dict, emit: bool, at: float) -> None:
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+            files, dirs = set(), set()
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if not (entry.name.startswith(".") or entry.name.startswith(config.METADATA_FOLDER)):
+                            dirs.add(entry.path)
+                    elif _is_image(entry.name):
+                        files.add(entry.path)
+        except OSError as e:
+            logger.warning(f"Ошибка чтения директории {folder}: {e}")
+            return
+
+        _, old_files, old_dirs = snapshot.get(folder, (0, set(), set()))
+        snapshot[folder] = (mtime, files, dirs)
+        if emit:
+            for path in files - old_files:
+                self.push(CREATED, path, at=at)
+            for path in old_files - files:
+                self.push(DELETED, path, at=at)
+            for path in old_dirs - dirs:
+                self._drop_dir(path, snapshot, at)
+        for path in dirs - old_dirs:
+            self._scan_dir(path, snapshot, emit, at)
+
+    def _drop_dir(self, folder: str, snapshot: Dict, at: float) -> None:
+        entry = snapshot.pop(folder, None)
+        if entry is None:
+            return
+        _, files, dirs = entry
+        for path in files:
+            self.push(DELETED, path, at=at)
+        for path in dirs:
+            self._drop_dir(path, snapshot, at)
+
+
+folder_watcher: Optional[FolderWatcher] = None
+
+
+def start_watcher() -> Optional[FolderWatcher]:
+    """Запускает отслеживание config.IMAGE_FOLDER, если включено watch_enabled"""
+    global folder_watcher
+
+    if not config.WATCH_ENABLED or folder_watcher is not None:
+        return folder_watcher
+    folder_watcher = FolderWatcher(config.IMAGE_FOLDER, config.WATCH_DEBOUNCE_MS / 1000, config.WATCH_POLL_INTERVAL)
+    folder_watcher.start()
+    return folder_watcher
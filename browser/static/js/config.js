@@ -4,4 +4,7 @@ const SCROLL_TO_TOP_THRESHOLD = 300;
 const STARRED_SYMBOL = "★";
 const UNSTARRED_SYMBOL = "☆";
 const MAX_RATING = 5;
-
+const PREVIEW_SIZE = 1600;
+const THUMBNAIL_WAIT = 25;
+const THUMBNAIL_CACHE = "thumbnails-v1";
+const THUMBNAIL_CACHE_LIMIT = 5000;
@@ -39,7 +39,7 @@ const fullscreen = {
 
         const metadataId = data?.id || "";
 
-        if (DOM.fullscreenImg) DOM.fullscreenImg.src = `/images/${metadataId}`;
+        if (DOM.fullscreenImg) DOM.fullscreenImg.src = `/images/${metadataId}?size=${PREVIEW_SIZE}` + (data.thumbnail_version ? `&v=${data.thumbnail_version}` : "");
 
         if (DOM.fullscreenPrompt) {
             const promptText = data.prompt || "";
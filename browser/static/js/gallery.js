@@ -1,4 +1,6 @@
 const gallery = {
+    thumbnailCacheTrimTimer: null,
+
     async load() {
         state.loading = false;
         if (DOM.sortSelect) {
@@ -147,36 +149,138 @@ const gallery = {
         }
     },
 
-    async loadThumbnails(metadataIds) {
+    async loadThumbnails(metadataIds, wait = 0) {
         if (!metadataIds || metadataIds.length === 0) return;
         
         try {
+            const size = gallery.thumbnailSize();
+            // Cache Storage доступен только в защищенном контексте (https или localhost)
+            const cache = window.caches ? await caches.open(THUMBNAIL_CACHE) : null;
+            
+            let requestIds = metadataIds;
+            if (cache && wait === 0) {
+                // Миниатюры с известной версией адресуются по содержимому: повторный визит берет их из кэша
+                const cached = await Promise.all(metadataIds.map(async metadataId => {
+                    const key = gallery.thumbnailCacheKey(metadataId, size);
+                    return key ? cache.match(key) : null;
+                }));
+                requestIds = [];
+                await Promise.all(metadataIds.map(async (metadataId, i) => {
+                    if (cached[i]) {
+                        gallery.applyThumbnail(metadataId, await cached[i].blob());
+                    } else {
+                        requestIds.push(metadataId);
+                    }
+                }));
+                if (requestIds.length === 0) return;
+            }
+            
             const response = await fetch("/thumbnails", {
                 method: "POST",
                 headers: { "Content-Type": "application/json" },
-                body: JSON.stringify({ ids: metadataIds })
+                body: JSON.stringify({ ids: requestIds, size, wait })
             });
             
             if (!response.ok) {
                 throw new Error(`HTTP error! status: ${response.status}`);
             }
             
-            const thumbnails = await response.json();
+            const thumbnails = gallery.parseThumbnailBatch(await response.arrayBuffer());
             
-            metadataIds.forEach(metadataId => {
-                const thumbnailBase64 = thumbnails[metadataId];
-                if (thumbnailBase64) {
-                    const imgElements = document.querySelectorAll(`img[data-thumbnail-id="${metadataId}"]`);
-                    imgElements.forEach(img => {
-                        img.src = `data:image/avif;base64,${thumbnailBase64}`;
-                    });
+            const puts = [];
+            requestIds.forEach(metadataId => {
+                const thumbnail = thumbnails[metadataId];
+                if (thumbnail) {
+                    gallery.applyThumbnail(metadataId, thumbnail);
+                    const key = cache && gallery.thumbnailCacheKey(metadataId, size);
+                    if (key) {
+                        puts.push(cache.put(key, new Response(thumbnail, { headers: { "Content-Type": thumbnail.type } })).catch(() => {}));
+                    }
                 }
             });
+            if (puts.length) {
+                Promise.all(puts).then(() => gallery.scheduleThumbnailCacheTrim());
+            }
+            
+            // Остальные миниатюры создаются на сервере в фоне - дожидаемся их long-poll запросами,
+            // не блокируя подгрузку следующих страниц, пока сервер сообщает, что они еще в очереди
+            const missing = requestIds.filter(metadataId => !thumbnails[metadataId]);
+            const pending = Number(response.headers.get("X-Thumbnails-Pending") || 0);
+            if (missing.length && (wait === 0 || pending > 0)) {
+                gallery.loadThumbnails(missing, THUMBNAIL_WAIT);
+            }
         } catch (error) {
             console.error("Ошибка загрузки миниатюр:", error);
         }
     },
 
+    applyThumbnail(metadataId, blob) {
+        document.querySelectorAll(`img[data-thumbnail-id="${metadataId}"]`).forEach(img => {
+            const url = URL.createObjectURL(blob);
+            img.addEventListener("load", () => URL.revokeObjectURL(url), { once: true });
+            img.src = url;
+        });
+    },
+
+    scheduleThumbnailCacheTrim() {
+        if (gallery.thumbnailCacheTrimTimer) return;
+        gallery.thumbnailCacheTrimTimer = setTimeout(async () => {
+            gallery.thumbnailCacheTrimTimer = null;
+            try {
+                // Ключи возвращаются в порядке добавления: удаляются самые старые записи сверх лимита.
+                // Записи прежних версий миниатюр больше не запрашиваются и вытесняются так же
+                const cache = await caches.open(THUMBNAIL_CACHE);
+                const keys = await cache.keys();
+                await Promise.all(keys.slice(0, keys.length - THUMBNAIL_CACHE_LIMIT).map(key => cache.delete(key)));
+                // Кэши предыдущих форматов (другое имя THUMBNAIL_CACHE) удаляются целиком
+                const names = await caches.keys();
+                await Promise.all(names
+                    .filter(name => name.startsWith("thumbnails-") && name !== THUMBNAIL_CACHE)
+                    .map(name => caches.delete(name)));
+            } catch (error) {
+                console.error("Ошибка очистки кэша миниатюр:", error);
+            }
+        }, 5000);
+    },
+
+    thumbnailCacheKey(metadataId, size) {
+        const version = utils.findImageById(metadataId)?.thumbnail_version;
+        return version ? `/thumbnails/${encodeURIComponent(metadataId)}?size=${size}&v=${version}` : null;
+    },
+
+    parseThumbnailBatch(buffer) {
+        // Формат пакета: uint32 количество, индекс (uint16 длина ID, ID, uint8 длина MIME, MIME, uint32 длина данных),
+        // затем данные миниатюр подряд в порядке индекса. Все числа big-endian
+        const view = new DataView(buffer);
+        const decoder = new TextDecoder();
+        const count = view.getUint32(0);
+        let offset = 4;
+        const entries = [];
+        for (let i = 0; i < count; i++) {
+            const idLength = view.getUint16(offset);
+            const id = decoder.decode(new Uint8Array(buffer, offset + 2, idLength));
+            offset += 2 + idLength;
+            const mimeLength = view.getUint8(offset);
+            const mime = decoder.decode(new Uint8Array(buffer, offset + 1, mimeLength));
+            offset += 1 + mimeLength;
+            entries.push({ id, mime, length: view.getUint32(offset) });
+            offset += 4;
+        }
+        const thumbnails = {};
+        entries.forEach(({ id, mime, length }) => {
+            thumbnails[id] = new Blob([new Uint8Array(buffer, offset, length)], { type: mime });
+            offset += length;
+        });
+        return thumbnails;
+    },
+
+    thumbnailSize() {
+        // Запрашиваем уровень миниатюры по фактической ширине карточки с учетом плотности пикселей
+        const container = DOM.gallery?.querySelector(".image-container");
+        const width = container ? container.clientWidth : 300;
+        return Math.ceil(width * (window.devicePixelRatio || 1));
+    },
+
     renderCards(images, startIndex = null) {
         // Если startIndex не передан, используем state.offset для обратной совместимости
         const baseIndex = startIndex !== null ? startIndex : state.offset;
@@ -371,21 +475,24 @@ const gallery = {
             return;
         }
 
-        if (!confirm("Удалить все отмеченные изображения? Это действие нельзя отменить.")) {
+        if (!confirm("Удалить все отмеченные изображения? Файлы будут перемещены в корзину.")) {
             return;
         }
 
         try {
+            progressBar.showChecking("Удаление изображений...");
             const result = await utils.apiRequest("/images/checked", {
                 method: "DELETE",
                 body: JSON.stringify({ path: currentPath, search: searchQuery })
             });
 
-            if (result.success) {             
-                toast.show(`Удалено изображений: ${result.count || 0}`, null, 3000);
-                gallery.load();
+            if (result.success) {
+                // Удаление идет в фоне, прогресс и перезагрузка галереи - через progressBar
+                progressBar.taskId = result.task_id;
+                progressBar.connect();
             }
         } catch (error) {
+            progressBar.close();
             utils.showError("Ошибка удаления изображений", error);
         }
     },